@@ -0,0 +1,107 @@
+"""Compare ecoshard.calculate_hash against a plain read loop.
+
+Run with a path to a large file, ex:
+
+    python benchmark_calculate_hash.py big_raster.tif --hashalg md5
+
+Each method is run `--repeat` times and the best throughput is reported. Use
+a file larger than RAM, or drop the page cache between runs, to measure cold
+reads rather than memory bandwidth.
+"""
+import argparse
+import hashlib
+import logging
+import os
+import time
+
+import ecoshard
+
+logging.basicConfig(
+    level=logging.DEBUG,
+    format=(
+        '%(asctime)s (%(relativeCreated)d) %(processName)s %(levelname)s '
+        '%(name)s [%(funcName)s:%(lineno)d] %(message)s'))
+LOGGER = logging.getLogger(__name__)
+
+
+def read_loop_hash(file_path, hash_algorithm, buf_size=2**20):
+    """Hash `file_path` allocating a new bytes object on every read.
+
+    This is the loop `calculate_hash` used before buffer reuse.
+
+    Args:
+        file_path (str): path to file to hash.
+        hash_algorithm (str): hashlib algorithm id.
+        buf_size (int): number of bytes per read.
+
+    Returns:
+        hex digest of `file_path`.
+
+    """
+    hash_func = hashlib.new(hash_algorithm)
+    with open(file_path, 'rb') as f:
+        binary_data = f.read(buf_size)
+        while binary_data:
+            hash_func.update(binary_data)
+            binary_data = f.read(buf_size)
+    return hash_func.hexdigest()
+
+
+def time_method(label, func, file_size, repeat):
+    """Run `func` `repeat` times and log the best throughput.
+
+    Args:
+        label (str): name of the method to log.
+        func (callable): function with no arguments that returns a digest.
+        file_size (int): size of the file being hashed in bytes.
+        repeat (int): number of times to run `func`.
+
+    Returns:
+        the digest returned by the last call to `func`.
+
+    """
+    best_time = None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        digest = func()
+        elapsed = time.perf_counter() - start_time
+        if best_time is None or elapsed < best_time:
+            best_time = elapsed
+    LOGGER.info(
+        '%-28s %8.3fs %10.2fMB/s', label, best_time,
+        file_size / 2**20 / max(best_time, 1e-9))
+    return digest
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark ecoshard.calculate_hash.')
+    parser.add_argument('file_path', help='path to file to hash')
+    parser.add_argument(
+        '--hashalg', default='md5', help='hash algorithm to benchmark')
+    parser.add_argument(
+        '--repeat', type=int, default=3, help='number of runs per method')
+    args = parser.parse_args()
+
+    file_size = os.path.getsize(args.file_path)
+    LOGGER.info(
+        'hashing %s (%.2fMB) with %s', args.file_path, file_size / 2**20,
+        args.hashalg)
+
+    digest_set = set()
+    digest_set.add(time_method(
+        'read loop 1MB', lambda: read_loop_hash(
+            args.file_path, args.hashalg), file_size, args.repeat))
+    digest_set.add(time_method(
+        'calculate_hash auto buffer', lambda: ecoshard.calculate_hash(
+            args.file_path, args.hashalg), file_size, args.repeat))
+    digest_set.add(time_method(
+        'calculate_hash 1MB', lambda: ecoshard.calculate_hash(
+            args.file_path, args.hashalg, buf_size=2**20),
+        file_size, args.repeat))
+    digest_set.add(time_method(
+        'calculate_hash drop cache', lambda: ecoshard.calculate_hash(
+            args.file_path, args.hashalg, drop_page_cache=True),
+        file_size, args.repeat))
+    if len(digest_set) != 1:
+        raise RuntimeError(f'methods disagree on the digest: {digest_set}')
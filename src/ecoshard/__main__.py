@@ -1,12 +1,16 @@
 """Entry point for ecoshard."""
 import argparse
+import concurrent.futures
 import configparser
 import glob
 import hashlib
 import logging
+import logging.handlers
+import multiprocessing
 import os
 import sys
 import threading
+import time
 
 import ecoshard
 
@@ -155,10 +159,27 @@ def main():
         '--version', action='version', version='ecoshard version ' +
         ecoshard.__version__)
     process_subparser.add_argument(
-        '--hashalg', nargs=1, default='md5',
-        help='Choose one of: "%s"' % '|'.join(hashlib.algorithms_available))
+        '--hashalg', default=None, help=(
+            'Comma separated list of hash algorithms, all calculated in a '
+            'single read of the file. The first is used to name the '
+            'ecoshard (default md5). Choose from: "%s"' % '|'.join(
+                sorted(hashlib.algorithms_available) +
+                [ecoshard.ecoshard.TREE_HASH_ALGORITHM])))
     process_subparser.add_argument(
         '--compress', action='store_true', help='Compress the raster files.')
+    process_subparser.add_argument(
+        '--compression_algorithm', default='DEFLATE', help=(
+            'GDAL compression algorithm used with --compress, or "auto" to '
+            'sample tiles with several codecs, predictors and levels and '
+            'pick the best for --compression_objective.'))
+    process_subparser.add_argument(
+        '--compression_objective', default='balanced',
+        choices=ecoshard.ecoshard.COMPRESSION_OBJECTIVES, help=(
+            'What "auto" compression optimizes for.'))
+    process_subparser.add_argument(
+        '--minimize_dtype', action='store_true', help=(
+            'With --compress, write the raster with the smallest data type '
+            'that holds its values exactly, remapping nodata if needed.'))
     process_subparser.add_argument(
         '--buildoverviews', action='store_true',
         help='Build overviews on the raster files.')
@@ -166,6 +187,13 @@ def main():
         '--rename', action='store_true', help=(
             'If not compressing and hashing only, rename files rather than '
             'copy new ones.'))
+    process_subparser.add_argument(
+        '--materialize', default='copy',
+        choices=ecoshard.ecoshard.MATERIALIZE_STRATEGIES, help=(
+            'If not renaming, how to create the ecoshard file: a full copy, '
+            'a hardlink, a reflink that shares data blocks on filesystems '
+            'such as XFS and btrfs, or a symlink. Falls back to copy if the '
+            'filesystem does not support it.'))
     process_subparser.add_argument(
         '--interpolation_method', help=(
             'Used when building overviews, can be one of '
@@ -182,12 +210,43 @@ def main():
         '--force', action='store_true', help=(
             'force an ecoshard hash if the filename looks like an ecoshard. '
             'The new hash will be appended to the filename.'))
+    process_subparser.add_argument(
+        '--no_hash_cache', '--no-hash-cache', action='store_true', help=(
+            'Do not read or write the persistent hash cache when hashing or '
+            'validating.'))
+    process_subparser.add_argument(
+        '--reverify', action='store_true', help=(
+            'Recalculate hashes even if they are in the hash cache and '
+            'refresh the cache with the result.'))
+    process_subparser.add_argument(
+        '--workers', type=int, default=1, help=(
+            'Number of files to process in parallel, each in its own '
+            'process.'))
     process_subparser.add_argument(
         '--reduce_factor', help=(
             "Reduce size by [factor] with [method] to the same path but "
             "[target_suffix] appended. "
-            "[method] must be one of 'max', 'min', 'sum', 'average', 'mode'"),
+            "[method] must be one of 'max', 'min', 'sum', 'average', 'mode' "
+            "or a comma separated list of them to calculate in one read, "
+            "each written with _[method] appended to the suffix."),
         nargs=3)
+    process_subparser.add_argument(
+        '--convolve_kernel', help=(
+            "Smooth with a [kernel_type] kernel of [radius] pixels to the "
+            "same path but [target_suffix] appended. [kernel_type] must be "
+            "one of %s. Nodata is left out and the result renormalized "
+            "around it." % "|".join(ecoshard.ecoshard.KERNEL_TYPES)),
+        nargs=3)
+    process_subparser.add_argument(
+        '--use_overviews', action='store_true', help=(
+            'With --reduce_factor, copy an existing overview reduced by '
+            'the same factor with the same max or min resampling rather '
+            'than reducing the full resolution raster. Average, sum and '
+            'mode are always reduced from the full resolution raster.'))
+    process_subparser.add_argument(
+        '--reduce_workers', type=int, default=1, help=(
+            'Number of threads to read and reduce blocks with when using '
+            '--reduce_factor or --convolve_kernel.'))
 
     args = parser.parse_args()
 
@@ -207,74 +266,284 @@ def main():
             args.datetime, args.asset_id, args.catalog_list)
         return 0
 
-    for glob_pattern in args.filepath:
-        for file_path in glob.glob(glob_pattern):
-            working_file_path = file_path
-            LOGGER.info('processing %s', file_path)
-
-            if args.reduce_factor:
-                method = args.reduce_factor[1]
-                valid_methods = ["max", "min", "sum", "average", "mode"]
-                if method not in valid_methods:
-                    LOGGER.error(
-                        '--reduce_method must be one of %s' % valid_methods)
-                    sys.exit(-1)
-                target_reduced_raster_path = (
-                    f'%s{args.reduce_factor[2]}%s') % os.path.splitext(
-                    file_path)
-                if os.path.exists(target_reduced_raster_path):
-                    if args.force:
-                        LOGGER.warn(
-                            f'{target_reduced_raster_path} exists, but '
-                            f'overwriting because of --force')
-                    else:
-                        raise ValueError(
-                            f'reducing {file_path} to '
-                            f'{target_reduced_raster_path} but that file '
-                            f'already exists. Remove or use --force to '
-                            f'overwrite')
-                ecoshard.convolve_layer(
-                    file_path, int(args.reduce_factor[0]),
-                    args.reduce_factor[1],
-                    target_reduced_raster_path)
-                continue
-
-            if args.compress:
-                prefix, suffix = os.path.splitext(file_path)
-                compressed_filename = '%s_compressed%s' % (prefix, suffix)
-                ecoshard.compress_raster(
-                    file_path, compressed_filename,
-                    compression_algorithm='DEFLATE')
-                working_file_path = compressed_filename
-
-            if args.buildoverviews:
-                overview_token_path = '%s.OVERVIEWCOMPLETE' % (
-                    working_file_path)
-                ecoshard.build_overviews(
-                    working_file_path, target_token_path=overview_token_path,
-                    interpolation_method=args.interpolation_method)
-
-            if args.validate:
-                try:
-                    is_valid = ecoshard.validate(working_file_path)
-                    if is_valid:
-                        LOGGER.info('VALID ECOSHARD: %s', working_file_path)
-                    else:
-                        LOGGER.error(
-                            'got a False, but no ValueError on validate? '
-                            'that is not impobipible?')
-                except ValueError:
-                    LOGGER.error('INVALID ECOSHARD: %s', working_file_path)
-                    return_code = -1
-            elif args.hash_file:
-                hash_token_path = '%s.ECOSHARDCOMPLETE' % (
-                    working_file_path)
-                ecoshard.hash_file(
-                    working_file_path, target_token_path=hash_token_path,
-                    rename=args.rename, hash_algorithm=args.hashalg,
-                    force=args.force)
+    if args.reduce_factor:
+        valid_methods = list(ecoshard.ecoshard.REDUCE_METHODS)
+        for method in args.reduce_factor[1].split(','):
+            if method not in valid_methods:
+                LOGGER.error(
+                    '--reduce_method must be one of %s' % valid_methods)
+                sys.exit(-1)
+
+    if args.convolve_kernel:
+        if args.reduce_factor:
+            LOGGER.error(
+                '--convolve_kernel and --reduce_factor can not be used '
+                'together')
+            sys.exit(-1)
+        if args.convolve_kernel[0] not in ecoshard.ecoshard.KERNEL_TYPES:
+            LOGGER.error(
+                '--convolve_kernel type must be one of %s' % list(
+                    ecoshard.ecoshard.KERNEL_TYPES))
+            sys.exit(-1)
+
+    start_time = time.time()
+    file_path_list = [
+        file_path for glob_pattern in args.filepath
+        for file_path in glob.glob(glob_pattern)]
+    if args.workers > 1 and len(file_path_list) > 1:
+        result_list = _process_file_list_in_pool(file_path_list, args)
+    else:
+        result_list = [
+            _process_file_job(file_path, args)
+            for file_path in file_path_list]
+
+    _log_summary_table(result_list, time.time() - start_time)
+    for result in result_list:
+        if result['return_code'] != 0:
+            return_code = result['return_code']
+    return return_code
+
+
+def process_file(file_path, args):
+    """Run the `process` pipeline requested in `args` on one file.
+
+    Args:
+        file_path (str): path to the file to process.
+        args (argparse.Namespace): parsed `process` command line arguments.
+
+    Returns:
+        0 if the file processed successfully, -1 if it failed validation.
+
+    """
+    return_code = 0
+    working_file_path = file_path
+    LOGGER.info('processing %s', file_path)
+
+    if args.reduce_factor:
+        method_list = args.reduce_factor[1].split(',')
+        if len(method_list) == 1:
+            target_suffix_list = [args.reduce_factor[2]]
+        else:
+            target_suffix_list = [
+                f'{args.reduce_factor[2]}_{method}' for method in method_list]
+        target_reduced_raster_path_list = [
+            f'%s{target_suffix}%s' % os.path.splitext(file_path)
+            for target_suffix in target_suffix_list]
+        for target_reduced_raster_path in target_reduced_raster_path_list:
+            if os.path.exists(target_reduced_raster_path):
+                if args.force:
+                    LOGGER.warn(
+                        f'{target_reduced_raster_path} exists, but '
+                        f'overwriting because of --force')
+                else:
+                    raise ValueError(
+                        f'reducing {file_path} to '
+                        f'{target_reduced_raster_path} but that file '
+                        f'already exists. Remove or use --force to '
+                        f'overwrite')
+        ecoshard.convolve_layer(
+            file_path, int(args.reduce_factor[0]), method_list,
+            target_reduced_raster_path_list, n_workers=args.reduce_workers,
+            use_overviews=args.use_overviews)
+        return return_code
+
+    if args.convolve_kernel:
+        kernel_type, radius, target_suffix = args.convolve_kernel
+        target_convolved_raster_path = (
+            f'%s{target_suffix}%s' % os.path.splitext(file_path))
+        if os.path.exists(target_convolved_raster_path) and not args.force:
+            raise ValueError(
+                f'convolving {file_path} to '
+                f'{target_convolved_raster_path} but that file already '
+                f'exists. Remove or use --force to overwrite')
+        ecoshard.convolve_kernel(
+            file_path, ecoshard.make_kernel(kernel_type, int(radius)),
+            target_convolved_raster_path, n_workers=args.reduce_workers)
+        return return_code
+
+    if args.compress:
+        prefix, suffix = os.path.splitext(file_path)
+        compressed_filename = '%s_compressed%s' % (prefix, suffix)
+        ecoshard.compress_raster(
+            file_path, compressed_filename,
+            compression_algorithm=args.compression_algorithm,
+            compression_objective=args.compression_objective,
+            minimize_dtype=args.minimize_dtype)
+        working_file_path = compressed_filename
+
+    if args.buildoverviews:
+        overview_token_path = '%s.OVERVIEWCOMPLETE' % (
+            working_file_path)
+        ecoshard.build_overviews(
+            working_file_path, target_token_path=overview_token_path,
+            interpolation_method=args.interpolation_method)
+
+    if args.validate:
+        try:
+            is_valid = ecoshard.validate(
+                working_file_path,
+                additional_hash_algorithm_list=args.hashalg,
+                use_hash_cache=not args.no_hash_cache,
+                reverify=args.reverify)
+            if is_valid:
+                LOGGER.info('VALID ECOSHARD: %s', working_file_path)
+            else:
+                LOGGER.error(
+                    'got a False, but no ValueError on validate? '
+                    'that is not impobipible?')
+        except ValueError:
+            LOGGER.error('INVALID ECOSHARD: %s', working_file_path)
+            return_code = -1
+    elif args.hash_file:
+        hash_token_path = '%s.ECOSHARDCOMPLETE' % (
+            working_file_path)
+        hash_dict = ecoshard.hash_file(
+            working_file_path, target_token_path=hash_token_path,
+            rename=args.rename,
+            hash_algorithm=args.hashalg if args.hashalg else 'md5',
+            force=args.force, use_hash_cache=not args.no_hash_cache,
+            reverify=args.reverify, materialize=args.materialize)
+        for hash_algorithm, hash_val in hash_dict.items():
+            LOGGER.info(
+                '%s %s: %s', hash_algorithm, working_file_path,
+                hash_val)
     return return_code
 
 
+def _process_file_job(file_path, args):
+    """Process one file and return a summary of how it went.
+
+    Exceptions are logged rather than raised so one bad file does not stop
+    the rest of the batch.
+
+    Args:
+        file_path (str): path to the file to process.
+        args (argparse.Namespace): parsed `process` command line arguments.
+
+    Returns:
+        dictionary with 'file_path', 'status', 'return_code', 'elapsed'
+        seconds and 'bytes' of `file_path` processed.
+
+    """
+    start_time = time.time()
+    try:
+        n_bytes = os.path.getsize(file_path)
+    except OSError:
+        n_bytes = 0
+    try:
+        return_code = process_file(file_path, args)
+        status = 'ok' if return_code == 0 else 'invalid'
+    except Exception:
+        LOGGER.exception('error processing %s', file_path)
+        return_code = -1
+        status = 'error'
+    return {
+        'file_path': file_path,
+        'status': status,
+        'return_code': return_code,
+        'elapsed': time.time() - start_time,
+        'bytes': n_bytes,
+    }
+
+
+def _pool_worker_initializer(log_queue):
+    """Send all logging in a pool worker through `log_queue`.
+
+    Records are formatted and written by a single listener in the parent
+    process so lines from different workers are never interleaved.
+
+    """
+    root_logger = logging.getLogger()
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+    root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+
+
+def _pool_process_file_job(file_path, args):
+    """Run `_process_file_job` in a pool worker tagged by file name."""
+    # processName is in the log format, so this tags every record from this
+    # worker with the file it is working on
+    multiprocessing.current_process().name = os.path.basename(file_path)
+    return _process_file_job(file_path, args)
+
+
+def _process_file_list_in_pool(file_path_list, args):
+    """Process files in a pool of `args.workers` processes.
+
+    Args:
+        file_path_list (list): paths to files to process.
+        args (argparse.Namespace): parsed `process` command line arguments.
+
+    Returns:
+        list of `_process_file_job` results in the order of
+        `file_path_list`.
+
+    """
+    LOGGER.info(
+        'processing %d files with %d workers', len(file_path_list),
+        args.workers)
+    manager = multiprocessing.Manager()
+    log_queue = manager.Queue()
+    log_listener = logging.handlers.QueueListener(
+        log_queue, *logging.getLogger().handlers, respect_handler_level=True)
+    log_listener.start()
+    try:
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=args.workers,
+                initializer=_pool_worker_initializer,
+                initargs=(log_queue,)) as executor:
+            future_list = [
+                executor.submit(_pool_process_file_job, file_path, args)
+                for file_path in file_path_list]
+            result_list = []
+            for file_path, future in zip(file_path_list, future_list):
+                try:
+                    result_list.append(future.result())
+                except Exception:
+                    # only happens if the worker itself died
+                    LOGGER.exception('worker failed on %s', file_path)
+                    result_list.append({
+                        'file_path': file_path,
+                        'status': 'error',
+                        'return_code': -1,
+                        'elapsed': 0.0,
+                        'bytes': 0,
+                    })
+    finally:
+        log_listener.stop()
+        manager.shutdown()
+    return result_list
+
+
+def _log_summary_table(result_list, wall_time):
+    """Log a table of per file status, elapsed time and bytes processed.
+
+    Args:
+        result_list (list): list of `_process_file_job` results.
+        wall_time (float): seconds taken to process every file.
+
+    Returns:
+        None.
+
+    """
+    if not result_list:
+        LOGGER.info('no files matched, nothing processed')
+        return
+    path_width = max(
+        len('total'), *[len(result['file_path']) for result in result_list])
+    line_list = [
+        '%-*s %-10s %10s %12s' % (
+            path_width, 'file', 'status', 'time (s)', 'size (MB)')]
+    for result in result_list:
+        line_list.append('%-*s %-10s %10.1f %12.2f' % (
+            path_width, result['file_path'], result['status'],
+            result['elapsed'], result['bytes'] / 2**20))
+    n_failed = sum(1 for result in result_list if result['status'] != 'ok')
+    line_list.append('%-*s %-10s %10.1f %12.2f' % (
+        path_width, 'total', f'{n_failed} failed', wall_time,
+        sum(result['bytes'] for result in result_list) / 2**20))
+    LOGGER.info('processing summary:\n%s', '\n'.join(line_list))
+
+
 if __name__ == '__main__':
     sys.exit(main())
@@ -1,30 +1,153 @@
 """Main ecoshard module."""
+import concurrent.futures
+import contextlib
 import datetime
+import errno
 import hashlib
+import http.client
 import logging
 import json
 import os
+import queue
 import re
 import requests
+import requests.adapters
 import shutil
+import sqlite3
 import subprocess
+import tarfile
+import tempfile
+import threading
 import time
+import urllib.error
+import urllib.parse
 import urllib.request
 import zipfile
+import zlib
 
 from osgeo import gdal
 import numpy
 import pygeoprocessing
 import retrying
-import scipy.stats
+import scipy.ndimage
+import scipy.signal
+try:
+    import zstandard
+except ImportError:
+    # only needed to extract .tar.zst archives
+    zstandard = None
 
 LOGGER = logging.getLogger(__name__)
 
+# ecoshard hash id for a BLAKE2b tree hash over fixed size leaves, the leaves
+# can be hashed in parallel and the digest does not depend on worker count
+TREE_HASH_ALGORITHM = 'blake2btree'
+TREE_HASH_LEAF_SIZE = 2**24
+TREE_HASH_DIGEST_SIZE = 32
+
+# files modified more recently than this are not added to the hash cache
+# because a later write within the same mtime tick would go unnoticed
+HASH_CACHE_MIN_AGE_NS = 2 * 10**9
+
+# ways `hash_file` can create an ecoshard without renaming the base file
+MATERIALIZE_STRATEGIES = ('copy', 'hardlink', 'reflink', 'symlink')
+
+# Linux ioctl request to share a file's extents with another file
+FICLONE = 0x40049409
+
+# multi-connection downloads are split into chunks of at most this size so
+# an interrupted download only refetches the chunks it had not finished
+DOWNLOAD_CHUNK_SIZE = 2**26
+DOWNLOAD_TIMEOUT = 60.0
+# errors writing the download to disk that are not retried
+LOCAL_IO_ERRNO_SET = {
+    errno.ENOSPC, errno.EROFS, errno.EACCES, errno.EFBIG, errno.EIO,
+    getattr(errno, 'EDQUOT', errno.ENOSPC)}
+
+# integer blocks whose value range (max - min + 1) is at most this many
+# times the number of cells in a window have their mode counted with
+# numpy.bincount rather than by sorting each window, in chunks of about
+# MODE_BINCOUNT_CHUNK_SIZE counts at a time
+MODE_BINCOUNT_CLASS_RATIO = 4
+MODE_BINCOUNT_CHUNK_SIZE = 2**22
+
+# aggregation methods `convolve_layer` can reduce a raster with
+REDUCE_METHODS = ('max', 'min', 'sum', 'average', 'mode')
+
+# about how many bytes of the base raster are read at a time when streaming
+DEFAULT_MAX_BLOCK_BYTES = 2**27
+
+# creation options for rasters reduced by `convolve_layer`, compressed and
+# tiled so they can be published without rewriting them, and sparse so
+# blocks that are entirely nodata take no space
+DEFAULT_GTIFF_CREATION_TUPLE_OPTIONS = ('GTIFF', (
+    'TILED=YES', 'BIGTIFF=YES', 'COMPRESS=DEFLATE', 'BLOCKXSIZE=256',
+    'BLOCKYSIZE=256', 'NUM_THREADS=ALL_CPUS', 'SPARSE_OK=TRUE'))
+
+# creation option that sets the level of each compression algorithm that
+# `compress_raster` accepts a `compression_level` for
+COMPRESSION_LEVEL_OPTIONS = {
+    'DEFLATE': 'ZLEVEL',
+    'ZSTD': 'ZSTD_LEVEL',
+    'LZMA': 'LZMA_PRESET',
+}
+
+# what `compress_raster` optimizes for when `compression_algorithm='auto'`
+COMPRESSION_OBJECTIVES = ('smallest', 'fastest-decode', 'balanced')
+
+# (algorithm, level) candidates 'auto' compression tries, each with every
+# predictor that applies to the raster's type
+AUTO_COMPRESSION_CANDIDATES = (
+    ('LZW', None), ('DEFLATE', 6), ('DEFLATE', 9), ('ZSTD', 9),
+    ('ZSTD', 17))
+
+# number of tiles 'auto' compression samples to compare candidates
+AUTO_COMPRESSION_SAMPLE_TILES = 16
+
+# 'auto' compression keeps the fastest of this many decodes of the sample
+# and treats decode times within this fraction of the fastest as ties
+AUTO_COMPRESSION_DECODE_REPEATS = 7
+AUTO_COMPRESSION_DECODE_TOLERANCE = 0.1
+
+# (GDAL type, numpy type) `compress_raster` can shrink a raster to with
+# `minimize_dtype`, smallest first
+MINIMIZE_DTYPE_CANDIDATES = (
+    (gdal.GDT_Byte, numpy.uint8),
+    (gdal.GDT_UInt16, numpy.uint16),
+    (gdal.GDT_Int16, numpy.int16),
+    (gdal.GDT_UInt32, numpy.uint32),
+    (gdal.GDT_Int32, numpy.int32),
+    (gdal.GDT_Float32, numpy.float32))
+
+# metadata item 'auto' compression records the chosen profile in
+COMPRESSION_PROFILE_METADATA_KEY = 'ECOSHARD_COMPRESSION_PROFILE'
+
+# kernels `make_kernel` can build for `convolve_kernel`
+KERNEL_TYPES = ('gaussian', 'exponential')
+
+# `convolve_kernel` convolves directly with kernels up to this many pixels on
+# a side and with FFTs for larger ones, which is faster past about 7x7
+DIRECT_CONVOLUTION_MAX_KERNEL_SIZE = 7
+
+# `convolve_kernel` results with less kernel weight on valid pixels than this
+# are nodata, it is well above FFT round off for kernels that sum to 1
+CONVOLUTION_MIN_WEIGHT = 1e-9
+
+# `build_overviews` records its interpolation method in this metadata item
+OVERVIEW_RESAMPLING_METADATA_KEY = 'ECOSHARD_OVERVIEW_RESAMPLING'
+
+# `convolve_layer` methods that overviews built with the same resampling
+# calculate exactly, GDAL's average and mode round and break ties
+# differently
+OVERVIEW_COMPATIBLE_METHODS = ('max', 'min')
+
 
 class EcoshardLibrary(object):
     """Define server and login information to abstract ecoshard state."""
 
-    def __init__(self, library_server_url, api_key, cache_dir):
+    def __init__(
+            self, library_server_url, api_key, cache_dir,
+            max_cache_bytes=None):
         """Define base server parameters.
 
         Args:
@@ -32,6 +155,11 @@ class EcoshardLibrary(object):
                 requests made by this object.
             api_key (str): None or a valid API key to interact with the
                 ecoshard server.
+            cache_dir (str): directory of the local content addressed cache
+                of fetched ecoshards. It can be shared by several processes.
+            max_cache_bytes (int): if not None, least recently used ecoshards
+                that are not pinned are removed from the cache to keep it
+                under this many bytes.
 
         Returns:
             EcoshardLibrary object.
@@ -39,20 +167,79 @@ class EcoshardLibrary(object):
         """
         self.library_server_url = library_server_url
         self.api_key = api_key
+        self.cache_dir = cache_dir
+        self.max_cache_bytes = max_cache_bytes
+        for dir_path in [
+                os.path.join(cache_dir, 'blobs'),
+                os.path.join(cache_dir, 'tmp'),
+                os.path.join(cache_dir, 'locks')]:
+            os.makedirs(dir_path, exist_ok=True)
+        self._db_path = os.path.join(cache_dir, 'ecoshard_cache.sqlite')
+        with contextlib.closing(self._connect()) as connection:
+            with connection:
+                connection.execute(
+                    'CREATE TABLE IF NOT EXISTS blob ('
+                    'hash TEXT PRIMARY KEY, '
+                    'path TEXT NOT NULL, '
+                    'size INTEGER NOT NULL, '
+                    'last_access REAL NOT NULL, '
+                    'pinned INTEGER NOT NULL DEFAULT 0)')
+                connection.execute(
+                    'CREATE TABLE IF NOT EXISTS asset ('
+                    'catalog TEXT NOT NULL, '
+                    'asset_id TEXT NOT NULL, '
+                    'hash TEXT NOT NULL, '
+                    'PRIMARY KEY (catalog, asset_id))')
 
     def publish(self, file_path, catalog, asset_id, asset_type):
         """Publish a local file to the Ecoshard library."""
         pass
 
-    def fetch(self, catalog, asset_id, target_path):
-        """Retrieve an Ecoshard and store it in `target_path`."""
-        # 1) Search local DB for that file
-        # 1a) Download to cache_dir if not found
-        # 1b) Hash and store in local DB
-        # 2) Hard link the file to `target_path`.
-        pass
+    def fetch(self, catalog, asset_id, target_path, materialize='hardlink'):
+        """Retrieve an Ecoshard and store it in `target_path`.
+
+        The ecoshard is downloaded into the cache the first time it is
+        fetched and linked from there afterwards.
+
+        Args:
+            catalog (str): catalog the asset is located in.
+            asset_id (str): id of the asset in `catalog`.
+            target_path (str): path to place the ecoshard at, replaced if it
+                exists.
+            materialize (str): 'hardlink' or 'reflink' to share the cached
+                data with `target_path`, or 'copy' or 'symlink'. Hard links
+                and symlinks share the cached file itself, which is read
+                only to protect the cache. Falls back to a copy if the
+                filesystem cannot link.
+
+        Returns:
+            the hash of the ecoshard in the format [hash alg]_[hash val].
+
+        """
+        with self._lock('asset_%s_%s' % (catalog, asset_id)):
+            hash_id = self._lookup_asset(catalog, asset_id)
+            if hash_id is None or not self._materialize_blob(
+                    hash_id, target_path, materialize):
+                uri = fetch(
+                    self.library_server_url, self.api_key, catalog,
+                    asset_id, 'uri')['link']
+                hash_id = self._download_blob(uri, asset_id)
+                with contextlib.closing(self._connect()) as connection:
+                    with connection:
+                        connection.execute(
+                            'INSERT OR REPLACE INTO asset VALUES (?, ?, ?)',
+                            (catalog, asset_id, hash_id))
+                if not self._materialize_blob(
+                        hash_id, target_path, materialize):
+                    raise RuntimeError(
+                        'could not place %s:%s at %s, it was evicted from '
+                        'the cache while it was fetched' % (
+                            catalog, asset_id, target_path))
+        self._evict()
+        return hash_id
 
-    def fetch_by_hash(self, catalog, hash, target_path):
+    def fetch_by_hash(
+            self, catalog, hash, target_path, materialize='hardlink'):
         """Retrieve an ecoshard by unique hash.
 
         Will search the library for a file that hashes to `hash` in the
@@ -61,19 +248,205 @@ class EcoshardLibrary(object):
         Args:
             catalog (str): unique catalog string
             hash (str): a string in the format [hash alg]_[hash val].
+            target_path (str): path to place the ecoshard at.
+            materialize (str): how the cached ecoshard is placed at
+                `target_path`, see `fetch`.
 
         Returns:
             None.
         """
-        # 1) Search local DB for the hash
-        # 1a) If not found, search library for that hash
-        # 1b) If one result found, copy locally
-        pass
+        if self._materialize_blob(hash, target_path, materialize):
+            return
+        hash_value = hash.rsplit('_', 1)[-1]
+        feature_list = search(
+            self.library_server_url, self.api_key, None, None, None,
+            hash_value, catalog)
+        if len(feature_list) != 1:
+            raise ValueError(
+                'expected one asset with hash %s in %s, found %d' % (
+                    hash, catalog, len(feature_list)))
+        fetched_hash = self.fetch(
+            catalog, feature_list[0]['id'], target_path,
+            materialize=materialize)
+        if fetched_hash != hash:
+            raise ValueError(
+                'asset %s in %s has hash %s, expected %s' % (
+                    feature_list[0]['id'], catalog, fetched_hash, hash))
+
+    def pin(self, hash):
+        """Keep the ecoshard with `hash` in the cache regardless of size."""
+        self._set_pinned(hash, True)
+
+    def unpin(self, hash):
+        """Allow the ecoshard with `hash` to be evicted from the cache."""
+        self._set_pinned(hash, False)
+
+    def _set_pinned(self, hash, pinned):
+        """Set or clear the pinned flag of a cached ecoshard."""
+        with contextlib.closing(self._connect()) as connection:
+            with connection:
+                updated = connection.execute(
+                    'UPDATE blob SET pinned=? WHERE hash=?',
+                    (int(pinned), hash)).rowcount
+        if not updated:
+            raise ValueError('%s is not in the cache' % hash)
+
+    def _connect(self):
+        """Return a connection to the cache index."""
+        return sqlite3.connect(self._db_path, timeout=60.0)
+
+    @contextlib.contextmanager
+    def _lock(self, name):
+        """Hold an exclusive inter-process lock on `name` in the cache.
+
+        Serializes fetches of the same asset so concurrent processes do not
+        download it twice. Without `fcntl` no lock is taken, which is still
+        safe since blobs are written atomically, the asset may just be
+        downloaded twice.
+
+        """
+        try:
+            import fcntl
+        except ImportError:
+            yield
+            return
+        lock_path = os.path.join(
+            self.cache_dir, 'locks', '%s.lock' % hashlib.md5(
+                name.encode('utf-8')).hexdigest())
+        with open(lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _lookup_asset(self, catalog, asset_id):
+        """Return the cached hash of an asset or None."""
+        with contextlib.closing(self._connect()) as connection:
+            result = connection.execute(
+                'SELECT hash FROM asset WHERE catalog=? AND asset_id=?',
+                (catalog, asset_id)).fetchone()
+        return result[0] if result else None
+
+    def _materialize_blob(self, hash_id, target_path, materialize):
+        """Place the cached blob for `hash_id` at `target_path`.
+
+        Returns:
+            True if the blob was in the cache and placed, False otherwise.
+
+        """
+        with contextlib.closing(self._connect()) as connection:
+            with connection:
+                result = connection.execute(
+                    'SELECT path FROM blob WHERE hash=?',
+                    (hash_id,)).fetchone()
+                if result is None:
+                    return False
+                connection.execute(
+                    'UPDATE blob SET last_access=? WHERE hash=?',
+                    (time.time(), hash_id))
+        blob_path = os.path.join(self.cache_dir, result[0])
+        os.makedirs(
+            os.path.dirname(os.path.abspath(target_path)), exist_ok=True)
+        try:
+            used_strategy = _materialize_file(
+                blob_path, target_path, materialize)
+        except FileNotFoundError:
+            # another process evicted the blob after it was looked up
+            LOGGER.warning('%s was evicted from the cache', hash_id)
+            return False
+        LOGGER.info(
+            'placed cached %s at %s with %s', hash_id, target_path,
+            used_strategy)
+        return True
+
+    def _download_blob(self, uri, asset_id):
+        """Download `uri` into the cache and return its hash id.
+
+        If the basename of `uri` or `asset_id` is in ecoshard format the
+        download is verified against that hash, otherwise it is hashed with
+        md5 as it downloads.
+
+        """
+        if uri.startswith('gs://'):
+            uri = 'https://storage.googleapis.com/%s' % uri[len('gs://'):]
+        uri_filename = os.path.basename(urllib.parse.urlparse(uri).path)
+        extension = os.path.splitext(uri_filename)[1]
+        ecoshard_hash = (
+            _parse_ecoshard_hash(uri_filename) or
+            _parse_ecoshard_hash(asset_id + extension))
+        temp_path = os.path.join(
+            self.cache_dir, 'tmp', '%d_%s%s' % (
+                os.getpid(), threading.get_ident(), extension))
+        try:
+            if ecoshard_hash:
+                hash_algorithm = ecoshard_hash[0]
+                hash_dict = download_url(
+                    uri, temp_path, expected_hash='%s_%s' % ecoshard_hash)
+            else:
+                hash_algorithm = 'md5'
+                hash_dict = download_url(
+                    uri, temp_path, hash_algorithm_list=[hash_algorithm])
+            hash_value = hash_dict[hash_algorithm]
+            blob_relative_path = os.path.join(
+                'blobs', hash_algorithm, hash_value[:2],
+                hash_value + extension)
+            blob_path = os.path.join(self.cache_dir, blob_relative_path)
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            os.chmod(temp_path, 0o444)
+            os.replace(temp_path, blob_path)
+        finally:
+            for path in [temp_path, '%s.part' % temp_path]:
+                if os.path.exists(path):
+                    os.remove(path)
+        hash_id = '%s_%s' % (hash_algorithm, hash_value)
+        with contextlib.closing(self._connect()) as connection:
+            with connection:
+                connection.execute(
+                    'INSERT INTO blob (hash, path, size, last_access) '
+                    'VALUES (?, ?, ?, ?) ON CONFLICT(hash) DO UPDATE SET '
+                    'path=excluded.path, size=excluded.size, '
+                    'last_access=excluded.last_access',
+                    (hash_id, blob_relative_path, os.path.getsize(blob_path),
+                     time.time()))
+        return hash_id
+
+    def _evict(self):
+        """Remove least recently used unpinned blobs over the size limit."""
+        if self.max_cache_bytes is None:
+            return
+        with self._lock('evict'):
+            with contextlib.closing(self._connect()) as connection:
+                with connection:
+                    cache_size = connection.execute(
+                        'SELECT COALESCE(SUM(size), 0) FROM blob'
+                    ).fetchone()[0]
+                    evict_list = []
+                    for hash_id, path, size in connection.execute(
+                            'SELECT hash, path, size FROM blob WHERE '
+                            'pinned=0 ORDER BY last_access').fetchall():
+                        if cache_size <= self.max_cache_bytes:
+                            break
+                        evict_list.append((hash_id, path))
+                        cache_size -= size
+                    for hash_id, _ in evict_list:
+                        connection.execute(
+                            'DELETE FROM blob WHERE hash=?', (hash_id,))
+                        connection.execute(
+                            'DELETE FROM asset WHERE hash=?', (hash_id,))
+            for hash_id, path in evict_list:
+                LOGGER.info('evicting %s from the ecoshard cache', hash_id)
+                try:
+                    # files already placed with a hard link keep their data
+                    os.remove(os.path.join(self.cache_dir, path))
+                except FileNotFoundError:
+                    pass
 
 
 def hash_file(
         base_path, target_token_path=None, target_dir=None, rename=False,
-        hash_algorithm='md5', force=False):
+        hash_algorithm='md5', force=False, use_hash_cache=True,
+        reverify=False, materialize='copy'):
     """Ecoshard file by hashing it and appending hash to filename.
 
     An EcoShard is the hashing of a file and the rename to the following
@@ -90,20 +463,37 @@ def hash_file(
             directory. This value must be None if `rename` is True.
         rename (bool): if True, `base_path` is renamed to the ecoshard rather
             than a new file being created.
-        hash_algorithm (str): a hash function id that exists in
-            hashlib.algorithms_available.
+        hash_algorithm (str or list): a hash function id that exists in
+            hashlib.algorithms_available or TREE_HASH_ALGORITHM, or a list
+            (or comma separated string) of them. The first algorithm is used
+            to name the ecoshard and any others are calculated in the same
+            read pass.
         force (bool): if True and the base_path already is in ecoshard format
             the operation proceeds including the possibility that the
             base_path ecoshard file name is renamed to a new hash.
+        use_hash_cache (bool): if True, reuse digests from the persistent
+            hash cache if `base_path` has not changed since it was hashed.
+        reverify (bool): if True, recalculate the digests even if they are
+            in the hash cache.
+        materialize (str): how the ecoshard is created when `rename` is
+            False, one of 'copy', 'hardlink', 'reflink' (share the data
+            blocks of `base_path` on filesystems such as XFS and btrfs), or
+            'symlink'. Falls back to 'copy' if the filesystem cannot
+            link or clone `base_path`.
 
     Returns:
-        None.
+        a dictionary mapping each hash algorithm to the hex digest of
+        `base_path`.
 
     """
     if target_dir and rename:
         raise ValueError(
             "`target_dir` is defined, but rename is True, either set "
             "`target_dir` to None, or rename to False.")
+    if materialize not in MATERIALIZE_STRATEGIES:
+        raise ValueError(
+            'unknown materialize strategy %s, expected one of %s' % (
+                materialize, '|'.join(MATERIALIZE_STRATEGIES)))
 
     if target_dir and not os.path.isdir(target_dir):
         LOGGER.warning('target directory %s does not exist, creating it now')
@@ -118,7 +508,7 @@ def hash_file(
     prefix, extension = os.path.splitext(base_filename)
     match_result = re.match(
         '(.+)_(%s)_([0-9a-f])+%s' % (
-            '|'.join(hashlib.algorithms_available), extension), base_filename)
+            '|'.join(_available_hash_algorithms()), extension), base_filename)
     if match_result:
         if not force:
             raise ValueError(
@@ -131,23 +521,200 @@ def hash_file(
                 '`force` is True.', base_path)
             prefix = match_result.group(1)
 
-    LOGGER.debug('calculating hash for %s', base_path)
-    hash_val = calculate_hash(base_path, hash_algorithm)
-
+    hash_algorithm_list = _hash_algorithm_list(hash_algorithm)
+    hash_algorithm = hash_algorithm_list[0]
     if target_dir is None:
         target_dir = os.path.dirname(base_path)
-    ecoshard_path = os.path.join(target_dir, '%s_%s_%s%s' % (
-        prefix, hash_algorithm, hash_val, extension))
+
     if rename:
+        LOGGER.debug('calculating hash for %s', base_path)
+        hash_dict = calculate_hashes(
+            base_path, hash_algorithm_list, use_hash_cache=use_hash_cache,
+            reverify=reverify)
+        ecoshard_path = os.path.join(target_dir, '%s_%s_%s%s' % (
+            prefix, hash_algorithm, hash_dict[hash_algorithm], extension))
         LOGGER.info('renaming %s to %s', base_path, ecoshard_path)
         os.rename(base_path, ecoshard_path)
     else:
-        LOGGER.info('copying %s to %s', base_path, ecoshard_path)
-        shutil.copyfile(base_path, ecoshard_path)
+        # the ecoshard is built under a temporary name in `target_dir` and
+        # renamed once its hash is known, so an interrupted run never leaves
+        # a partial file with an ecoshard name
+        temp_fd, temp_path = tempfile.mkstemp(
+            dir=target_dir, prefix='.%s_' % prefix, suffix='.tmp')
+        os.close(temp_fd)
+        try:
+            hash_dict = None
+            if materialize != 'copy':
+                try:
+                    _materialize_file(
+                        base_path, temp_path, materialize,
+                        fallback_to_copy=False)
+                    LOGGER.debug('calculating hash for %s', base_path)
+                    hash_dict = calculate_hashes(
+                        base_path, hash_algorithm_list,
+                        use_hash_cache=use_hash_cache, reverify=reverify)
+                except (OSError, NotImplementedError) as error:
+                    LOGGER.warning(
+                        'could not %s %s (%s), copying instead',
+                        materialize, base_path, error)
+            if hash_dict is None:
+                LOGGER.info('copying and hashing %s', base_path)
+                hash_dict = _copy_and_hash(
+                    base_path, temp_path, hash_algorithm_list,
+                    use_hash_cache=use_hash_cache)
+            ecoshard_path = os.path.join(target_dir, '%s_%s_%s%s' % (
+                prefix, hash_algorithm, hash_dict[hash_algorithm],
+                extension))
+            if os.path.abspath(ecoshard_path) == os.path.abspath(base_path):
+                # `base_path` is already the ecoshard, replacing it would
+                # link it to itself or drop its data
+                LOGGER.info(
+                    '%s is already named with its hash, leaving it as is',
+                    base_path)
+                os.remove(temp_path)
+            else:
+                LOGGER.info('created %s from %s', ecoshard_path, base_path)
+                os.replace(temp_path, ecoshard_path)
+        except BaseException:
+            if os.path.lexists(temp_path):
+                os.remove(temp_path)
+            raise
 
     if target_token_path:
         with open(target_token_path, 'w') as target_token_file:
             target_token_file.write(str(datetime.datetime.now()))
+    return hash_dict
+
+
+def _copy_and_hash(
+        base_path, target_path, hash_algorithm_list, use_hash_cache=True):
+    """Copy `base_path` to `target_path` and hash it in the same read.
+
+    The permission bits of `base_path` are copied to `target_path`.
+
+    Args:
+        base_path (str): path to the file to copy.
+        target_path (str): path to write the copy to, overwritten if it
+            exists.
+        hash_algorithm_list (list): hash algorithms to calculate.
+        use_hash_cache (bool): if True, the digests of `base_path` are
+            stored in the persistent hash cache.
+
+    Returns:
+        a dictionary mapping each hash algorithm to the hex digest of
+        `base_path`.
+
+    """
+    base_stat = os.stat(base_path)
+    hash_func_list = [
+        (hash_algorithm, _new_hash(hash_algorithm))
+        for hash_algorithm in hash_algorithm_list]
+    with open(target_path, 'wb') as target_file:
+        for binary_view in _iter_file_buffers(base_path):
+            target_file.write(binary_view)
+            for _, hash_func in hash_func_list:
+                hash_func.update(binary_view)
+    shutil.copymode(base_path, target_path)
+    hash_dict = {
+        hash_algorithm: hash_func.hexdigest()
+        for hash_algorithm, hash_func in hash_func_list}
+    if use_hash_cache and _same_file_version(base_stat, os.stat(base_path)):
+        _hash_cache_store(base_stat, hash_dict)
+    return hash_dict
+
+
+def _materialize_file(
+        base_path, target_path, strategy, fallback_to_copy=True):
+    """Create `target_path` with the contents of `base_path`.
+
+    Any existing `target_path` is replaced.
+
+    Args:
+        base_path (str): path to an existing file.
+        target_path (str): path to create.
+        strategy (str): one of MATERIALIZE_STRATEGIES.
+        fallback_to_copy (bool): if True, strategies the filesystem or
+            platform cannot do fall back to a plain copy with a warning,
+            otherwise the error is raised.
+
+    Returns:
+        the strategy that was actually used.
+
+    """
+    if os.path.lexists(target_path):
+        os.remove(target_path)
+    try:
+        if strategy == 'hardlink':
+            os.link(base_path, target_path)
+            return strategy
+        if strategy == 'symlink':
+            os.symlink(os.path.abspath(base_path), target_path)
+            return strategy
+        if strategy == 'reflink':
+            _reflink_file(base_path, target_path)
+            return strategy
+    except (OSError, NotImplementedError) as error:
+        if not fallback_to_copy:
+            raise
+        LOGGER.warning(
+            'could not %s %s to %s (%s), copying instead', strategy,
+            base_path, target_path, error)
+        if os.path.lexists(target_path):
+            os.remove(target_path)
+    shutil.copyfile(base_path, target_path)
+    return 'copy'
+
+
+def _reflink_file(base_path, target_path):
+    """Clone `base_path` to `target_path` without copying its data.
+
+    Tries the FICLONE ioctl first, which shares extents on XFS, btrfs and
+    similar filesystems, then `os.copy_file_range` which lets the kernel or
+    a network filesystem server copy or clone without moving the data
+    through user space.
+
+    Args:
+        base_path (str): path to an existing file.
+        target_path (str): path to a file to create, must not exist.
+
+    Returns:
+        None.
+
+    Raises:
+        OSError if neither method is supported for these files, in which
+        case `target_path` is removed.
+
+    """
+    try:
+        import fcntl
+    except ImportError:
+        raise OSError(
+            errno.EOPNOTSUPP, 'reflinks are not supported on this platform')
+    with open(base_path, 'rb') as base_file, \
+            open(target_path, 'xb') as target_file:
+        try:
+            try:
+                fcntl.ioctl(target_file.fileno(), FICLONE, base_file.fileno())
+                return
+            except OSError as error:
+                if not hasattr(os, 'copy_file_range'):
+                    raise
+                LOGGER.debug(
+                    'FICLONE failed (%s), trying copy_file_range', error)
+            n_bytes_left = os.fstat(base_file.fileno()).st_size
+            while n_bytes_left > 0:
+                n_bytes = os.copy_file_range(
+                    base_file.fileno(), target_file.fileno(),
+                    min(n_bytes_left, 2**30))
+                if n_bytes == 0:
+                    raise OSError(
+                        errno.EIO, 'copy_file_range stopped before the end '
+                        'of %s' % base_path)
+                n_bytes_left -= n_bytes
+        except OSError:
+            target_file.close()
+            os.remove(target_path)
+            raise
 
 
 def build_overviews(
@@ -202,11 +769,21 @@ def build_overviews(
         LOGGER.info(
             'building overviews for %s at the following levels %s' % (
                 base_raster_path, overview_levels))
-        raster.BuildOverviews(
-            interpolation_method, overview_levels,
-            callback=_make_logger_callback(
-                'build overview for ' + os.path.basename(base_raster_path) +
-                '%.2f/1.0 complete'))
+        # don't write overview blocks that are entirely nodata
+        previous_sparse_ok = gdal.GetConfigOption('SPARSE_OK_OVERVIEW')
+        gdal.SetConfigOption('SPARSE_OK_OVERVIEW', 'ON')
+        try:
+            raster.BuildOverviews(
+                interpolation_method, overview_levels,
+                callback=_make_logger_callback(
+                    'build overview for ' +
+                    os.path.basename(base_raster_path) +
+                    '%.2f/1.0 complete'))
+        finally:
+            gdal.SetConfigOption('SPARSE_OK_OVERVIEW', previous_sparse_ok)
+        # lets `convolve_layer` reuse overviews built with its method
+        raster.SetMetadataItem(
+            OVERVIEW_RESAMPLING_METADATA_KEY, interpolation_method.lower())
     else:
         LOGGER.warn(
             'overviews already exist, set rebuild_if_exists=False to rebuild '
@@ -217,7 +794,9 @@ def build_overviews(
             token_file.write(str(datetime.datetime.now()))
 
 
-def validate(base_ecoshard_path):
+def validate(
+        base_ecoshard_path, additional_hash_algorithm_list=None,
+        use_hash_cache=True, reverify=False):
     """Validate ecoshard path, through its filename.
 
     If `base_ecoshard_path` matches an EcoShard pattern, and the hash matches
@@ -225,6 +804,13 @@ def validate(base_ecoshard_path):
 
     Args:
         base_ecoshard_path (str): path to an ecosharded file.
+        additional_hash_algorithm_list (list): if not None, a list of other
+            hash algorithms to calculate in the same read pass as the
+            validation hash. Their digests are logged.
+        use_hash_cache (bool): if True, reuse digests from the persistent
+            hash cache if the file has not changed since it was hashed.
+        reverify (bool): if True, recalculate the digests even if they are
+            in the hash cache.
 
     Returns:
         True if `base_ecoshard_path` matches .*_[hashalg]_[hash][extension]
@@ -232,15 +818,23 @@ def validate(base_ecoshard_path):
 
     """
     base_filename = os.path.basename(base_ecoshard_path)
-    prefix, extension = os.path.splitext(base_filename)
-    match_result = re.match(
-        '.+_([^_]+)_([0-9a-f]+)%s' % extension, base_filename)
-    if not match_result:
+    ecoshard_hash = _parse_ecoshard_hash(base_filename)
+    if not ecoshard_hash:
         raise ValueError("%s does not match an ecoshard" % base_filename)
-    hash_algorithm, hash_value = match_result.groups()
-    calculated_hash = calculate_hash(
-        base_ecoshard_path, hash_algorithm)
-    if calculated_hash != match_result.group(2):
+    hash_algorithm, hash_value = ecoshard_hash
+    hash_algorithm_list = [hash_algorithm]
+    if additional_hash_algorithm_list:
+        hash_algorithm_list += _hash_algorithm_list(
+            additional_hash_algorithm_list)
+    hash_dict = calculate_hashes(
+        base_ecoshard_path, hash_algorithm_list,
+        use_hash_cache=use_hash_cache, reverify=reverify)
+    for additional_algorithm in hash_algorithm_list[1:]:
+        LOGGER.info(
+            '%s digest for %s: %s', additional_algorithm, base_filename,
+            hash_dict[additional_algorithm])
+    calculated_hash = hash_dict[hash_algorithm]
+    if calculated_hash != hash_value:
         raise ValueError(
             'hash does not match, calculated %s and expected %s '
             'on %s' % (calculated_hash, hash_value, base_filename))
@@ -248,44 +842,542 @@ def validate(base_ecoshard_path):
     return True
 
 
-def calculate_hash(file_path, hash_algorithm, buf_size=2**20):
+def _parse_ecoshard_hash(filename):
+    """Return the hash algorithm and hash value in an ecoshard filename.
+
+    Args:
+        filename (str): a filename of the form
+            [base name]_[hashalg]_[hash][extension].
+
+    Returns:
+        (hash algorithm, hash value) tuple, or None if `filename` is not in
+        ecoshard format.
+
+    """
+    extension = os.path.splitext(filename)[1]
+    # match known algorithms since some, like sha3_256, contain a '_'
+    match_result = re.match(
+        '.+_(%s)_([0-9a-f]+)%s$' % (
+            '|'.join(re.escape(hash_algorithm) for hash_algorithm in
+                     _available_hash_algorithms()),
+            re.escape(extension)), filename)
+    if not match_result:
+        return None
+    return match_result.groups()
+
+
+def calculate_hash(
+        file_path, hash_algorithm, buf_size=None, drop_page_cache=False,
+        n_workers=None, use_hash_cache=True, reverify=False):
     """Return a hex digest of `file_path`.
 
     Args:
         file_path (string): path to file to hash.
         hash_algorithm (string): a hash function id that exists in
-            hashlib.algorithms_available.
+            hashlib.algorithms_available or TREE_HASH_ALGORITHM.
         buf_size (int): number of bytes to read from `file_path` at a time
-            for digesting.
+            for digesting. If None a size is chosen from the preferred I/O
+            block size and the size of `file_path`.
+        drop_page_cache (bool): if True, advise the kernel to drop pages of
+            `file_path` from the page cache once they are hashed so hashing a
+            large file does not evict other cached data.
+        n_workers (int): number of threads used to hash leaves when
+            `hash_algorithm` is TREE_HASH_ALGORITHM. If None uses the number
+            of CPUs. Ignored for other algorithms.
+        use_hash_cache (bool): if True, look the digest up in the persistent
+            hash cache before reading `file_path` and store it there after.
+        reverify (bool): if True, always read `file_path` and refresh the
+            hash cache, warning if the cached digest was different.
 
     Returns:
         a hex digest with hash algorithm `hash_algorithm` of the binary
         contents of `file_path`.
 
     """
-    hash_func = hashlib.new(hash_algorithm)
-    with open(file_path, 'rb') as f:
-        binary_data = f.read(buf_size)
-        while binary_data:
-            hash_func.update(binary_data)
-            binary_data = f.read(buf_size)
-    # We return the hash and CRC32 checksum in hexadecimal format
-    return hash_func.hexdigest()
+    return calculate_hashes(
+        file_path, [hash_algorithm], buf_size=buf_size,
+        drop_page_cache=drop_page_cache, n_workers=n_workers,
+        use_hash_cache=use_hash_cache, reverify=reverify)[hash_algorithm]
+
+
+def calculate_hashes(
+        file_path, hash_algorithm_list, buf_size=None, drop_page_cache=False,
+        n_workers=None, use_hash_cache=True, reverify=False):
+    """Return hex digests of `file_path` for several algorithms at once.
+
+    The file is read a single time and every buffer is fed to each of the
+    hash functions, so asking for a second digest costs CPU but no extra I/O.
+
+    Digests are also kept in a persistent cache keyed on the device, inode,
+    size and modification time of `file_path` so an unchanged file is not
+    read again on later calls. See `get_hash_cache_path` for its location.
+
+    Args:
+        file_path (string): path to file to hash.
+        hash_algorithm_list (list): list of hash function ids that exist in
+            hashlib.algorithms_available or TREE_HASH_ALGORITHM. A comma
+            separated string is also accepted.
+        buf_size (int): number of bytes to read from `file_path` at a time
+            for digesting. If None a size is chosen from the preferred I/O
+            block size and the size of `file_path`.
+        drop_page_cache (bool): if True, advise the kernel to drop pages of
+            `file_path` from the page cache once they are hashed.
+        n_workers (int): number of threads used to hash leaves when
+            TREE_HASH_ALGORITHM is the only algorithm requested. If None uses
+            the number of CPUs. When other algorithms are requested too the
+            tree hash is calculated in the same sequential read as them.
+        use_hash_cache (bool): if True, look digests up in the persistent
+            hash cache before reading `file_path` and store them there after.
+        reverify (bool): if True, always read `file_path` and refresh the
+            hash cache, warning if a cached digest was different.
+
+    Returns:
+        a dictionary mapping each algorithm in `hash_algorithm_list` to the
+        hex digest of the binary contents of `file_path`.
+
+    """
+    hash_algorithm_list = _hash_algorithm_list(hash_algorithm_list)
+    if not use_hash_cache:
+        return _read_hashes(
+            file_path, hash_algorithm_list, buf_size, drop_page_cache,
+            n_workers)
+
+    file_stat = os.stat(file_path)
+    cached_hash_dict = _hash_cache_lookup(file_stat, hash_algorithm_list)
+    if reverify:
+        missing_algorithm_list = hash_algorithm_list
+    else:
+        missing_algorithm_list = [
+            hash_algorithm for hash_algorithm in hash_algorithm_list
+            if hash_algorithm not in cached_hash_dict]
+    if not missing_algorithm_list:
+        LOGGER.debug('using cached hashes for %s', file_path)
+        return cached_hash_dict
+
+    hash_dict = _read_hashes(
+        file_path, missing_algorithm_list, buf_size, drop_page_cache,
+        n_workers)
+    for hash_algorithm, hash_val in hash_dict.items():
+        cached_hash_val = cached_hash_dict.get(hash_algorithm, hash_val)
+        if cached_hash_val != hash_val:
+            LOGGER.warning(
+                'cached %s hash %s for %s does not match the recalculated '
+                'hash %s, the file changed without changing its size or '
+                'modification time', hash_algorithm, cached_hash_val,
+                file_path, hash_val)
+    cached_hash_dict.update(hash_dict)
+    if _same_file_version(file_stat, os.stat(file_path)):
+        _hash_cache_store(file_stat, hash_dict)
+    else:
+        LOGGER.warning(
+            '%s changed while it was hashed, not caching its hash',
+            file_path)
+    return {
+        hash_algorithm: cached_hash_dict[hash_algorithm]
+        for hash_algorithm in hash_algorithm_list}
+
+
+def _read_hashes(
+        file_path, hash_algorithm_list, buf_size, drop_page_cache,
+        n_workers):
+    """Read `file_path` and return digests for `hash_algorithm_list`.
+
+    See `calculate_hashes` for a description of the arguments.
+
+    """
+    if hash_algorithm_list == [TREE_HASH_ALGORITHM]:
+        return {
+            TREE_HASH_ALGORITHM: _parallel_tree_hash(
+                file_path, n_workers=n_workers)}
+    hash_func_list = [
+        (hash_algorithm, _new_hash(hash_algorithm))
+        for hash_algorithm in hash_algorithm_list]
+    for binary_view in _iter_file_buffers(
+            file_path, buf_size=buf_size, drop_page_cache=drop_page_cache):
+        for _, hash_func in hash_func_list:
+            hash_func.update(binary_view)
+    return {
+        hash_algorithm: hash_func.hexdigest()
+        for hash_algorithm, hash_func in hash_func_list}
+
+
+def get_hash_cache_path():
+    """Return the path to the persistent hash cache database.
+
+    The cache lives in the directory named by the ``ECOSHARD_CACHE_DIR``
+    environment variable if set, otherwise in an ``ecoshard`` directory in
+    the user's cache directory.
+
+    Returns:
+        path to a SQLite database file, which may not exist yet.
+
+    """
+    cache_dir = os.environ.get('ECOSHARD_CACHE_DIR')
+    if not cache_dir:
+        if os.name == 'nt':
+            user_cache_dir = os.environ.get(
+                'LOCALAPPDATA', os.path.expanduser('~'))
+        else:
+            user_cache_dir = os.environ.get(
+                'XDG_CACHE_HOME', os.path.join(
+                    os.path.expanduser('~'), '.cache'))
+        cache_dir = os.path.join(user_cache_dir, 'ecoshard')
+    return os.path.join(cache_dir, 'hash_cache.sqlite')
+
+
+def _open_hash_cache():
+    """Return a connection to the hash cache or None if unavailable."""
+    hash_cache_path = get_hash_cache_path()
+    try:
+        os.makedirs(os.path.dirname(hash_cache_path), exist_ok=True)
+        connection = sqlite3.connect(hash_cache_path, timeout=60.0)
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS file_hash ('
+            'device INTEGER NOT NULL, '
+            'inode INTEGER NOT NULL, '
+            'size INTEGER NOT NULL, '
+            'mtime_ns INTEGER NOT NULL, '
+            'algorithm TEXT NOT NULL, '
+            'digest TEXT NOT NULL, '
+            'PRIMARY KEY (device, inode, size, mtime_ns, algorithm))')
+        return connection
+    except (OSError, sqlite3.Error):
+        LOGGER.warning(
+            'could not open hash cache at %s, hashes will not be cached',
+            hash_cache_path, exc_info=True)
+        return None
+
+
+def _same_file_version(file_stat_a, file_stat_b):
+    """Return True if two stats describe the same unmodified file."""
+    return (
+        (file_stat_a.st_dev, file_stat_a.st_ino, file_stat_a.st_size,
+         file_stat_a.st_mtime_ns) ==
+        (file_stat_b.st_dev, file_stat_b.st_ino, file_stat_b.st_size,
+         file_stat_b.st_mtime_ns))
+
+
+def _hash_cache_lookup(file_stat, hash_algorithm_list):
+    """Return a dictionary of cached digests for a file.
+
+    Args:
+        file_stat (os.stat_result): stat of the file to look up.
+        hash_algorithm_list (list): hash algorithms to look up.
+
+    Returns:
+        dictionary mapping algorithm to digest for the algorithms in
+        `hash_algorithm_list` that are in the cache.
+
+    """
+    connection = _open_hash_cache()
+    if connection is None:
+        return {}
+    try:
+        with connection:
+            result = connection.execute(
+                'SELECT algorithm, digest FROM file_hash WHERE device=? AND '
+                'inode=? AND size=? AND mtime_ns=? AND algorithm IN (%s)' % (
+                    ','.join('?' * len(hash_algorithm_list))),
+                (file_stat.st_dev, file_stat.st_ino, file_stat.st_size,
+                 file_stat.st_mtime_ns, *hash_algorithm_list)).fetchall()
+        return dict(result)
+    except sqlite3.Error:
+        LOGGER.warning('hash cache lookup failed', exc_info=True)
+        return {}
+    finally:
+        connection.close()
+
+
+def _hash_cache_store(file_stat, hash_dict):
+    """Store digests for a file in the hash cache.
+
+    Entries for older versions of the same file are removed. Nothing is
+    stored if the file was modified too recently to trust its mtime.
+
+    Args:
+        file_stat (os.stat_result): stat of the file before it was hashed.
+        hash_dict (dict): maps hash algorithm to digest.
+
+    Returns:
+        None.
+
+    """
+    if time.time_ns() - file_stat.st_mtime_ns < HASH_CACHE_MIN_AGE_NS:
+        return
+    connection = _open_hash_cache()
+    if connection is None:
+        return
+    try:
+        with connection:
+            connection.execute(
+                'DELETE FROM file_hash WHERE device=? AND inode=? AND '
+                '(size!=? OR mtime_ns!=?)',
+                (file_stat.st_dev, file_stat.st_ino, file_stat.st_size,
+                 file_stat.st_mtime_ns))
+            connection.executemany(
+                'INSERT OR REPLACE INTO file_hash VALUES (?, ?, ?, ?, ?, ?)',
+                [(file_stat.st_dev, file_stat.st_ino, file_stat.st_size,
+                  file_stat.st_mtime_ns, hash_algorithm, hash_val)
+                 for hash_algorithm, hash_val in hash_dict.items()])
+    except sqlite3.Error:
+        LOGGER.warning('hash cache store failed', exc_info=True)
+    finally:
+        connection.close()
+
+
+def _choose_buf_size(file_stat):
+    """Pick a read buffer size for a file.
+
+    Reads are a multiple of the filesystem's preferred I/O size, at least
+    1MB, and grow to 8MB for large files to amortize syscall overhead on
+    fast storage. Small files get a buffer no larger than the file itself.
+
+    Args:
+        file_stat (os.stat_result): result of `os.stat` on the file.
+
+    Returns:
+        buffer size in bytes.
+
+    """
+    block_size = getattr(file_stat, 'st_blksize', 0) or 2**12
+    buf_size = 2**20
+    if file_stat.st_size > 2**28:
+        buf_size = 2**23
+    buf_size = max(block_size, buf_size // block_size * block_size)
+    if file_stat.st_size < buf_size:
+        buf_size = max(
+            block_size, -(-file_stat.st_size // block_size) * block_size)
+    return buf_size
+
+
+def _iter_file_buffers(file_path, buf_size=None, drop_page_cache=False):
+    """Iterate over the contents of a file with a single reused buffer.
+
+    The file is read with `readinto` into one preallocated buffer and a
+    memoryview of the filled part is yielded, so no bytes objects are
+    allocated per read. The view is only valid until the next iteration.
+
+    Args:
+        file_path (str): path to the file to read.
+        buf_size (int): number of bytes per read, if None chosen by
+            `_choose_buf_size`.
+        drop_page_cache (bool): if True and the platform supports it, advise
+            the kernel to drop pages that have already been read.
+
+    Yields:
+        memoryview of the next chunk of `file_path`.
+
+    """
+    with open(file_path, 'rb', buffering=0) as f:
+        fd = f.fileno()
+        if buf_size is None:
+            buf_size = _choose_buf_size(os.fstat(fd))
+        has_fadvise = hasattr(os, 'posix_fadvise')
+        if has_fadvise:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        buffer = bytearray(buf_size)
+        buffer_view = memoryview(buffer)
+        offset = 0
+        while True:
+            n_bytes = f.readinto(buffer_view)
+            if not n_bytes:
+                break
+            yield buffer_view[:n_bytes]
+            if drop_page_cache and has_fadvise:
+                os.posix_fadvise(
+                    fd, offset, n_bytes, os.POSIX_FADV_DONTNEED)
+            offset += n_bytes
+
+
+def _hash_algorithm_list(hash_algorithm):
+    """Normalize a hash algorithm argument to a list of algorithm ids.
+
+    Args:
+        hash_algorithm (str or list): a single hash function id, a comma
+            separated string of ids, or a list of ids.
+
+    Returns:
+        list of unique hash function ids in the order they were given.
+
+    Raises:
+        ValueError if no algorithm is given or an algorithm is unknown.
+
+    """
+    if isinstance(hash_algorithm, str):
+        hash_algorithm = hash_algorithm.split(',')
+    hash_algorithm_list = []
+    for algorithm in hash_algorithm:
+        algorithm = algorithm.strip()
+        if algorithm and algorithm not in hash_algorithm_list:
+            hash_algorithm_list.append(algorithm)
+    if not hash_algorithm_list:
+        raise ValueError('no hash algorithm was provided')
+    available_algorithms = _available_hash_algorithms()
+    for algorithm in hash_algorithm_list:
+        if algorithm not in available_algorithms:
+            raise ValueError(
+                'unknown hash algorithm %s, expected one of %s' % (
+                    algorithm, '|'.join(available_algorithms)))
+    return hash_algorithm_list
+
+
+def _available_hash_algorithms():
+    """Return the list of hash ids that can be used in an ecoshard."""
+    return sorted(hashlib.algorithms_available) + [TREE_HASH_ALGORITHM]
+
+
+def _new_hash(hash_algorithm):
+    """Return a new hash object for an ecoshard hash id."""
+    if hash_algorithm == TREE_HASH_ALGORITHM:
+        return _Blake2bTreeHash()
+    return hashlib.new(hash_algorithm)
+
+
+def _tree_hash_node(node_offset, node_depth, last_node):
+    """Return a blake2b object for one node of the ecoshard tree hash.
+
+    The tree is two levels deep: leaves of TREE_HASH_LEAF_SIZE bytes at
+    depth 0 and a single root at depth 1 that hashes the concatenated leaf
+    digests, using BLAKE2b's own tree hashing parameters.
+
+    Args:
+        node_offset (int): index of the leaf, 0 for the root.
+        node_depth (int): 0 for a leaf, 1 for the root.
+        last_node (bool): True for the final leaf and for the root.
+
+    Returns:
+        hashlib.blake2b object.
+
+    """
+    return hashlib.blake2b(
+        digest_size=TREE_HASH_DIGEST_SIZE, fanout=0, depth=2,
+        leaf_size=TREE_HASH_LEAF_SIZE, node_offset=node_offset,
+        node_depth=node_depth, inner_size=TREE_HASH_DIGEST_SIZE,
+        last_node=last_node)
+
+
+def _tree_hash_root(leaf_digest_list):
+    """Return the hex digest of the root over the ordered leaf digests."""
+    root_hash = _tree_hash_node(0, 1, True)
+    for leaf_digest in leaf_digest_list:
+        root_hash.update(leaf_digest)
+    return root_hash.hexdigest()
+
+
+class _Blake2bTreeHash(object):
+    """Sequential hashlib-like interface to the ecoshard tree hash."""
+
+    def __init__(self):
+        """Start an empty tree hash."""
+        self._leaf_digest_list = []
+        self._leaf_data = bytearray()
+
+    def update(self, data):
+        """Add `data` to the hash, finishing leaves as they fill."""
+        data = memoryview(data).cast('B')
+        while len(data):
+            # a full leaf is only known not to be the last one once more
+            # data arrives, otherwise hexdigest finishes it as the last node
+            if len(self._leaf_data) == TREE_HASH_LEAF_SIZE:
+                self._finish_leaf(False)
+            n_bytes = min(
+                TREE_HASH_LEAF_SIZE - len(self._leaf_data), len(data))
+            self._leaf_data += data[:n_bytes]
+            data = data[n_bytes:]
+
+    def _finish_leaf(self, last_node):
+        """Hash the buffered leaf and start a new one."""
+        leaf_hash = _tree_hash_node(
+            len(self._leaf_digest_list), 0, last_node)
+        leaf_hash.update(self._leaf_data)
+        self._leaf_digest_list.append(leaf_hash.digest())
+        self._leaf_data = bytearray()
+
+    def hexdigest(self):
+        """Return the hex digest of the data hashed so far."""
+        leaf_digest_list = list(self._leaf_digest_list)
+        leaf_hash = _tree_hash_node(len(leaf_digest_list), 0, True)
+        leaf_hash.update(self._leaf_data)
+        leaf_digest_list.append(leaf_hash.digest())
+        return _tree_hash_root(leaf_digest_list)
+
+
+def _parallel_tree_hash(file_path, n_workers=None):
+    """Calculate the ecoshard tree hash of `file_path` with a thread pool.
+
+    Each worker reads its leaves with positional reads on a shared file
+    descriptor and hashlib releases the GIL while digesting, so this scales
+    with the number of cores until storage is saturated.
+
+    Args:
+        file_path (str): path to file to hash.
+        n_workers (int): number of threads, if None the number of CPUs.
+
+    Returns:
+        hex digest of the TREE_HASH_ALGORITHM hash of `file_path`.
+
+    """
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    file_size = os.path.getsize(file_path)
+    n_leaves = max(1, -(-file_size // TREE_HASH_LEAF_SIZE))
+    fd = os.open(file_path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    # platforms without pread fall back to a lock around seek and read
+    read_lock = threading.Lock()
+
+    def _read(n_bytes, offset):
+        if hasattr(os, 'pread'):
+            return os.pread(fd, n_bytes, offset)
+        with read_lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            return os.read(fd, n_bytes)
+
+    def _hash_leaf(leaf_index):
+        offset = leaf_index * TREE_HASH_LEAF_SIZE
+        leaf_size = max(0, min(TREE_HASH_LEAF_SIZE, file_size - offset))
+        # reads can come back short, on a signal or over NFS or FUSE, so
+        # keep reading until the leaf is whole
+        leaf_data = bytearray()
+        while len(leaf_data) < leaf_size:
+            data_buffer = _read(
+                leaf_size - len(leaf_data), offset + len(leaf_data))
+            if not data_buffer:
+                raise OSError(
+                    errno.EIO, '%s ended at %d bytes, expected %d' % (
+                        file_path, offset + len(leaf_data), file_size))
+            leaf_data += data_buffer
+        leaf_hash = _tree_hash_node(
+            leaf_index, 0, leaf_index == n_leaves - 1)
+        leaf_hash.update(leaf_data)
+        return leaf_hash.digest()
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=max(1, min(n_workers, n_leaves))) as executor:
+            leaf_digest_list = list(executor.map(_hash_leaf, range(n_leaves)))
+    finally:
+        os.close(fd)
+    return _tree_hash_root(leaf_digest_list)
 
 
-def _make_logger_callback(message):
+def _make_logger_callback(message, n_bytes=None):
     """Build a timed logger callback that prints ``message`` replaced.
 
     Args:
         message (string): a string that expects 2 placement %% variables,
             first for % complete from ``df_complete``, second from
             ``p_progress_arg[0]``.
+        n_bytes (int): if not None, the number of bytes the operation
+            processes in total, used to append its throughput to
+            ``message``.
 
     Returns:
         Function with signature:
             logger_callback(df_complete, psz_message, p_progress_arg)
 
     """
+    start_time = time.time()
+
     def logger_callback(df_complete, _, p_progress_arg):
         """Argument names come from the GDAL API for callbacks."""
         try:
@@ -298,7 +1390,12 @@ def _make_logger_callback(message):
                 # was an issue for some kind of GDAL race condition. So I'm
                 # guarding against it here and reporting an appropriate log
                 # if it occurs.
-                if p_progress_arg:
+                if p_progress_arg and n_bytes is not None:
+                    LOGGER.info(
+                        message + ' %.2fMB/s', df_complete * 100,
+                        p_progress_arg[0], df_complete * n_bytes / 2**20 /
+                        max(current_time - start_time, 1e-9))
+                elif p_progress_arg:
                     LOGGER.info(message, df_complete * 100, p_progress_arg[0])
                 else:
                     LOGGER.info(
@@ -315,7 +1412,9 @@ def _make_logger_callback(message):
 
 def compress_raster(
         base_raster_path, target_compressed_path, compression_algorithm='LZW',
-        compression_predictor=None):
+        compression_predictor=None, compression_level=None,
+        n_threads='ALL_CPUS', block_size=(256, 256), interleave=None,
+        compression_objective='balanced', minimize_dtype=False):
     """Compress base raster to target.
 
     Args:
@@ -324,10 +1423,32 @@ def compress_raster(
         target_compressed_path (str): the desired output raster path with the
             defined compression algorithm applied to it.
         compression_algorithm (str): a valid GDAL compression algorithm eg
-            'LZW', 'DEFLATE', and others defined in GDAL.
+            'LZW', 'DEFLATE', and others defined in GDAL. If 'auto' a sample
+            of tiles is compressed with each of
+            ``AUTO_COMPRESSION_CANDIDATES`` and predictor and the one that
+            best meets `compression_objective` is used.
         compression_predictor (int): if defined uses the predictor in whatever
             compression algorithm is used. In most cases this only applies to
-            LZW or DEFLATE.
+            LZW, DEFLATE or ZSTD. 2 is horizontal differencing and 3 is
+            floating point prediction, which is only valid for float rasters.
+        compression_level (int): if defined the ZLEVEL of DEFLATE, the
+            ZSTD_LEVEL of ZSTD or the LZMA_PRESET of LZMA compression. Higher
+            levels are smaller and slower to write.
+        n_threads (int or str): number of threads GDAL compresses blocks
+            with, 'ALL_CPUS' to use every core.
+        block_size (tuple): (x, y) size of the target's tiles, each a
+            multiple of 16.
+        interleave (str): 'PIXEL' or 'BAND' to set how bands of a
+            multiband raster are interleaved, None uses GDAL's default.
+        compression_objective (str): one of ``COMPRESSION_OBJECTIVES``, what
+            'auto' compression picks a candidate for, 'smallest' file,
+            'fastest-decode' or 'balanced' between the two. The chosen
+            profile is recorded as JSON in the target's
+            ``COMPRESSION_PROFILE_METADATA_KEY`` metadata item.
+        minimize_dtype (bool): if True the target is written with the
+            smallest of ``MINIMIZE_DTYPE_CANDIDATES`` that holds every valid
+            value of the base exactly, see `_minimal_lossless_type`. Nodata
+            is remapped if the base's nodata does not fit in that type.
 
     Returns:
         None.
@@ -335,71 +1456,1216 @@ def compress_raster(
     """
     gtiff_driver = gdal.GetDriverByName('GTiff')
     base_raster = gdal.OpenEx(base_raster_path, gdal.OF_RASTER)
-    LOGGER.info('compress %s to %s' % (
-        base_raster_path, target_compressed_path))
-    compressed_raster = gtiff_driver.CreateCopy(
-        target_compressed_path, base_raster, options=(
-            'TILED=YES', 'BIGTIFF=YES', 'COMPRESS=%s' % compression_algorithm,
-            'BLOCKXSIZE=256', 'BLOCKYSIZE=256'))
+    data_type = base_raster.GetRasterBand(1).DataType
+    n_bytes = (
+        base_raster.RasterXSize * base_raster.RasterYSize *
+        base_raster.RasterCount * gdal.GetDataTypeSize(data_type) // 8)
+    minimal_type = None
+    if minimize_dtype:
+        minimal_type = _minimal_lossless_type(base_raster_path)
+    if minimal_type is not None:
+        data_type = minimal_type[0]
+        LOGGER.info(
+            'writing %s as %s with nodata %s', base_raster_path,
+            gdal.GetDataTypeName(data_type), minimal_type[2])
+    compression_profile = None
+    if compression_algorithm.lower() == 'auto':
+        if compression_predictor is not None or (
+                compression_level is not None):
+            raise ValueError(
+                'compression_predictor and compression_level are chosen by '
+                "'auto' compression and cannot be set with it")
+        compression_profile = _select_compression_profile(
+            base_raster, block_size, interleave, compression_objective,
+            minimal_type=minimal_type)
+        compression_algorithm = compression_profile['algorithm']
+        compression_predictor = compression_profile['predictor']
+        compression_level = compression_profile['level']
+    option_list = _compression_option_list(
+        data_type, compression_algorithm, compression_predictor,
+        compression_level, n_threads, block_size, interleave)
+
+    LOGGER.info('compress %s to %s with %s' % (
+        base_raster_path, target_compressed_path, option_list))
+    start_time = time.time()
+    logger_callback = _make_logger_callback(
+        'compress %.1f%% complete %s', n_bytes=n_bytes)
+    if minimal_type is None:
+        compressed_raster = gtiff_driver.CreateCopy(
+            target_compressed_path, base_raster, options=option_list,
+            callback=logger_callback, callback_data=[target_compressed_path])
+    else:
+        _, numpy_type, target_nodata_list = minimal_type
+        compressed_raster = gtiff_driver.Create(
+            target_compressed_path, base_raster.RasterXSize,
+            base_raster.RasterYSize, base_raster.RasterCount, data_type,
+            options=option_list)
+        compressed_raster.SetGeoTransform(base_raster.GetGeoTransform())
+        compressed_raster.SetProjection(base_raster.GetProjection())
+        compressed_raster.SetMetadata(base_raster.GetMetadata())
+        band_pair_list = []
+        for band_index, target_nodata in enumerate(target_nodata_list):
+            base_band = base_raster.GetRasterBand(band_index+1)
+            compressed_band = compressed_raster.GetRasterBand(band_index+1)
+            _copy_band_properties(base_band, compressed_band)
+            if target_nodata is not None:
+                compressed_band.SetNoDataValue(target_nodata)
+            band_pair_list.append((
+                base_band, base_band.GetNoDataValue(), compressed_band,
+                target_nodata))
+        offset_list = plan_blocks(
+            base_raster_path, target_block_size=block_size)
+        for block_index, offset_dict in enumerate(offset_list):
+            for (base_band, nodata, compressed_band,
+                    target_nodata) in band_pair_list:
+                compressed_band.WriteArray(
+                    _cast_block(
+                        base_band.ReadAsArray(**offset_dict), nodata,
+                        target_nodata, numpy_type),
+                    xoff=offset_dict['xoff'], yoff=offset_dict['yoff'])
+            logger_callback(
+                (block_index+1) / len(offset_list), '',
+                [target_compressed_path])
+        base_band = None
+        compressed_band = None
+        band_pair_list = None
+    if compression_profile is not None:
+        compressed_raster.SetMetadataItem(
+            COMPRESSION_PROFILE_METADATA_KEY, json.dumps(compression_profile))
     del compressed_raster
+    base_raster = None
+    elapsed_time = max(time.time() - start_time, 1e-9)
+    LOGGER.info(
+        'compressed %s in %.2fs (%.2fMB/s) to %.1f%% of its uncompressed '
+        'size', base_raster_path, elapsed_time, n_bytes / 2**20 / elapsed_time,
+        100 * os.path.getsize(target_compressed_path) / max(n_bytes, 1))
+    _log_sparse_blocks(target_compressed_path)
 
 
-def download_url(url, target_path, skip_if_target_exists=False):
-    """Download `url` to `target_path`.
+def _minimal_lossless_type(base_raster_path):
+    """Find the smallest type that holds a raster's valid values exactly.
+
+    Bands are scanned block by block for their range, whether they are all
+    integers and whether they survive a round trip through float32. If
+    every band of an integer raster has STATISTICS_MINIMUM and
+    STATISTICS_MAXIMUM metadata that no smaller type holds the scan is
+    skipped, statistics may be stale or approximate so they only ever rule
+    out shrinking a raster. Pixels equal to nodata are
+    left out and are written as a nodata value the type can hold: the
+    base's if it fits, otherwise the type's maximum or minimum if no valid
+    value uses it.
 
     Args:
-        url (str): url path to a file.
-        target_path (str): desired output target path.
-        skip_if_target_exists (bool): if True will not download a file if the
-            path already exists on disk.
+        base_raster_path (str): path to raster to shrink.
 
     Returns:
-        None.
+        (GDAL type, numpy type, list of nodata per band) of the smallest of
+        ``MINIMIZE_DTYPE_CANDIDATES`` smaller than the base's type that
+        fits, or None if there is none.
 
     """
-    if skip_if_target_exists and os.path.exists(target_path):
-        return
-    with open(target_path, 'wb') as target_file:
-        last_download_size = 0
-        start_time = time.time()
-        with urllib.request.urlopen(url) as url_stream:
-            meta = url_stream.info()
-            file_size = int(meta["Content-Length"])
-            LOGGER.info(
-                "Downloading: %s Bytes: %s" % (target_path, file_size))
-
-            downloaded_so_far = 0
-            block_size = 2**20
-            last_log_time = time.time()
-            while True:
-                data_buffer = url_stream.read(block_size)
-                if not data_buffer:
-                    break
-                downloaded_so_far += len(data_buffer)
-                target_file.write(data_buffer)
-                time_since_last_log = time.time() - last_log_time
-                if time_since_last_log > 5.0:
-                    download_rate = (
-                        (downloaded_so_far - last_download_size)/2**20) / (
-                            float(time_since_last_log))
-                    last_download_size = downloaded_so_far
-                    status = r"%10dMB  [%3.2f%% @ %5.2fMB/s]" % (
-                        downloaded_so_far/2**20, downloaded_so_far * 100. /
-                        file_size, download_rate)
-                    LOGGER.info(status)
-                    last_log_time = time.time()
-        total_time = time.time() - start_time
-        final_download_rate = downloaded_so_far/2**20 / float(total_time)
-        status = r"%10dMB  [%3.2f%% @ %5.2fMB/s]" % (
-            downloaded_so_far/2**20, downloaded_so_far * 100. /
-            file_size, final_download_rate)
-        LOGGER.info(status)
-        target_file.flush()
-        os.fsync(target_file.fileno())
+    base_raster = gdal.OpenEx(base_raster_path, gdal.OF_RASTER)
+    base_type = base_raster.GetRasterBand(1).DataType
+    band_stats_list = []
+    statistics_list = []
+    for band_index in range(base_raster.RasterCount):
+        band = base_raster.GetRasterBand(band_index+1)
+        band_stats = {
+            'nodata': band.GetNoDataValue(), 'min': None, 'max': None,
+            'integer': True,
+            'float32': base_type in (gdal.GDT_Float32, gdal.GDT_Float64)}
+        band_stats_list.append(band_stats)
+        stats_min = band.GetMetadataItem('STATISTICS_MINIMUM')
+        stats_max = band.GetMetadataItem('STATISTICS_MAXIMUM')
+        if stats_min is not None and stats_max is not None:
+            statistics_list.append(dict(
+                band_stats, min=float(stats_min), max=float(stats_max)))
+    band = None
+    if base_type not in (gdal.GDT_Float32, gdal.GDT_Float64) and len(
+            statistics_list) == len(band_stats_list) and (
+            _smallest_fitting_type(base_type, statistics_list) is None):
+        LOGGER.info(
+            'statistics of %s show no smaller type holds it',
+            base_raster_path)
+        base_raster = None
+        return None
 
+    LOGGER.info('scanning %s for the smallest lossless type', base_raster_path)
+    for offset_dict in plan_blocks(base_raster_path):
+        for band_index, band_stats in enumerate(band_stats_list):
+            block_data = base_raster.GetRasterBand(
+                band_index+1).ReadAsArray(**offset_dict)
+            nodata = band_stats['nodata']
+            # nodata is matched exactly so every other value is kept
+            if nodata is None:
+                valid_array = block_data.ravel()
+            elif numpy.isnan(nodata):
+                valid_array = block_data[~numpy.isnan(block_data)]
+            else:
+                valid_array = block_data[block_data != nodata]
+            if valid_array.size == 0:
+                continue
+            if numpy.issubdtype(valid_array.dtype, numpy.floating):
+                if band_stats['integer'] and not (
+                        numpy.isfinite(valid_array).all() and
+                        (numpy.trunc(valid_array) == valid_array).all()):
+                    band_stats['integer'] = False
+                if band_stats['float32'] and not numpy.array_equal(
+                        valid_array.astype(numpy.float32), valid_array,
+                        equal_nan=True):
+                    band_stats['float32'] = False
+                # NaN is a valid value here only if it's not nodata, it
+                # keeps the band floating point so leave it out of the range
+                valid_array = valid_array[~numpy.isnan(valid_array)]
+                if valid_array.size == 0:
+                    continue
+            block_min = float(valid_array.min())
+            block_max = float(valid_array.max())
+            if band_stats['min'] is None or block_min < band_stats['min']:
+                band_stats['min'] = block_min
+            if band_stats['max'] is None or block_max > band_stats['max']:
+                band_stats['max'] = block_max
+    base_raster = None
+    return _smallest_fitting_type(base_type, band_stats_list)
 
-def download_and_unzip(url, target_dir, target_token_path=None):
-    """Download `url` to `target_dir` and touch `target_token_path`.
+
+def _smallest_fitting_type(base_type, band_stats_list):
+    """Find the smallest type bands fit in, see `_minimal_lossless_type`.
+
+    Args:
+        base_type (int): GDAL type of the raster the bands are from.
+        band_stats_list (list): dict per band, see `_fit_type`.
+
+    Returns:
+        (GDAL type, numpy type, list of nodata per band) or None.
+
+    """
+    base_item_size = gdal.GetDataTypeSize(base_type)
+    for gdal_type, numpy_type in MINIMIZE_DTYPE_CANDIDATES:
+        if gdal.GetDataTypeSize(gdal_type) >= base_item_size:
+            break
+        target_nodata_list = [
+            _fit_type(band_stats, numpy_type)
+            for band_stats in band_stats_list]
+        if all(target_nodata is not False
+               for target_nodata in target_nodata_list):
+            return gdal_type, numpy_type, target_nodata_list
+    return None
+
+
+def _fit_type(band_stats, numpy_type):
+    """Check a band from `_minimal_lossless_type` fits in `numpy_type`.
+
+    Args:
+        band_stats (dict): 'nodata', 'min', 'max', 'integer' and 'float32'
+            of a band.
+        numpy_type (numpy.dtype): type to check.
+
+    Returns:
+        the nodata value to write the band with in `numpy_type`, None if
+        the band has no nodata, or False if the band does not fit.
+
+    """
+    nodata = band_stats['nodata']
+    if numpy.issubdtype(numpy_type, numpy.floating):
+        if not band_stats['float32']:
+            return False
+        if nodata is not None and not numpy.isnan(nodata) and (
+                numpy.float32(nodata) != nodata):
+            return False
+        return nodata
+    if not band_stats['integer']:
+        return False
+    type_info = numpy.iinfo(numpy_type)
+    if band_stats['min'] is not None and (
+            band_stats['min'] < type_info.min or
+            band_stats['max'] > type_info.max):
+        return False
+    if nodata is None:
+        return None
+    if not numpy.isnan(nodata) and float(nodata).is_integer() and (
+            type_info.min <= nodata <= type_info.max):
+        return int(nodata)
+    if band_stats['max'] is None or band_stats['max'] < type_info.max:
+        return int(type_info.max)
+    if band_stats['min'] > type_info.min:
+        return int(type_info.min)
+    return False
+
+
+def _cast_block(block_data, nodata, target_nodata, numpy_type):
+    """Cast a block to `numpy_type` and remap its nodata.
+
+    Args:
+        block_data (numpy.ndarray): block of raster values.
+        nodata (numeric): nodata of `block_data` or None.
+        target_nodata (numeric): nodata to write in place of `nodata`.
+        numpy_type (numpy.dtype): type to cast to, chosen by
+            `_minimal_lossless_type` so valid values are unchanged.
+
+    Returns:
+        `block_data` as `numpy_type`.
+
+    Raises:
+        ValueError if a valid value is out of the range of an integer
+        `numpy_type`, rather than letting it wrap around.
+
+    """
+    if nodata is None:
+        nodata_mask = None
+    elif numpy.isnan(nodata):
+        nodata_mask = numpy.isnan(block_data)
+    else:
+        nodata_mask = block_data == nodata
+    if numpy.issubdtype(numpy_type, numpy.integer):
+        valid_array = (
+            block_data if nodata_mask is None else block_data[~nodata_mask])
+        type_info = numpy.iinfo(numpy_type)
+        if valid_array.size and (
+                valid_array.min() < type_info.min or
+                valid_array.max() > type_info.max):
+            raise ValueError(
+                'values from %s to %s do not fit in %s' % (
+                    valid_array.min(), valid_array.max(),
+                    numpy.dtype(numpy_type).name))
+    if nodata_mask is None or nodata == target_nodata:
+        return block_data.astype(numpy_type)
+    # remap before casting so a NaN nodata is never cast to an integer
+    return numpy.where(nodata_mask, target_nodata, block_data).astype(
+        numpy_type)
+
+
+def _copy_band_properties(base_band, target_band):
+    """Copy what CreateCopy would of a band other than its pixels and nodata.
+
+    Args:
+        base_band (gdal.Band): band to copy from.
+        target_band (gdal.Band): band to copy to.
+
+    Returns:
+        None.
+
+    """
+    target_band.SetMetadata(base_band.GetMetadata())
+    target_band.SetDescription(base_band.GetDescription())
+    target_band.SetRasterColorInterpretation(
+        base_band.GetRasterColorInterpretation())
+    # scale and offset give the values their meaning
+    if base_band.GetScale() is not None:
+        target_band.SetScale(base_band.GetScale())
+    if base_band.GetOffset() is not None:
+        target_band.SetOffset(base_band.GetOffset())
+    if base_band.GetUnitType():
+        target_band.SetUnitType(base_band.GetUnitType())
+    color_table = base_band.GetRasterColorTable()
+    if color_table is not None:
+        target_band.SetRasterColorTable(color_table)
+    category_name_list = base_band.GetCategoryNames()
+    if category_name_list:
+        target_band.SetCategoryNames(category_name_list)
+    attribute_table = base_band.GetDefaultRAT()
+    if attribute_table is not None:
+        target_band.SetDefaultRAT(attribute_table)
+
+
+def _compression_option_list(
+        data_type, compression_algorithm, compression_predictor,
+        compression_level, n_threads, block_size, interleave):
+    """Build GeoTIFF creation options for `compress_raster`.
+
+    Args:
+        data_type (int): GDAL type of the raster to compress.
+        compression_algorithm, compression_predictor, compression_level,
+        n_threads, block_size, interleave: see `compress_raster`.
+
+    Returns:
+        list of GeoTIFF creation option strings.
+
+    """
+    if any(size <= 0 or size % 16 != 0 for size in block_size):
+        raise ValueError(
+            'block_size must be multiples of 16, got %s' % (block_size,))
+    option_list = [
+        'TILED=YES', 'BIGTIFF=YES', 'COMPRESS=%s' % compression_algorithm,
+        'BLOCKXSIZE=%d' % block_size[0], 'BLOCKYSIZE=%d' % block_size[1],
+        'SPARSE_OK=TRUE', 'NUM_THREADS=%s' % n_threads]
+    if compression_predictor is not None:
+        if compression_predictor not in (1, 2, 3):
+            raise ValueError(
+                'compression_predictor must be 1, 2 or 3, got %s' %
+                compression_predictor)
+        if compression_predictor == 3 and data_type not in (
+                gdal.GDT_Float32, gdal.GDT_Float64):
+            raise ValueError(
+                'floating point predictor 3 cannot be used on a %s raster' %
+                gdal.GetDataTypeName(data_type))
+        option_list.append('PREDICTOR=%d' % compression_predictor)
+    if compression_level is not None:
+        level_option = COMPRESSION_LEVEL_OPTIONS.get(
+            compression_algorithm.upper())
+        if level_option is None:
+            raise ValueError(
+                'compression_level is not supported for %s, only %s' % (
+                    compression_algorithm,
+                    ', '.join(COMPRESSION_LEVEL_OPTIONS)))
+        option_list.append('%s=%d' % (level_option, compression_level))
+    if interleave is not None:
+        if interleave.upper() not in ('PIXEL', 'BAND'):
+            raise ValueError(
+                "interleave must be 'PIXEL' or 'BAND', got %s" % interleave)
+        option_list.append('INTERLEAVE=%s' % interleave.upper())
+    return option_list
+
+
+def _select_compression_profile(
+        base_raster, block_size, interleave, compression_objective,
+        minimal_type=None):
+    """Pick the compression for a raster by compressing a sample of it.
+
+    A stratified sample of ``AUTO_COMPRESSION_SAMPLE_TILES`` tiles, one
+    from each equal run of tiles in raster order, is compressed in /vsimem/
+    with each of ``AUTO_COMPRESSION_CANDIDATES`` and predictor. The
+    compressed size and the fastest of ``AUTO_COMPRESSION_DECODE_REPEATS``
+    decodes are measured for each, see `_pick_compression_candidate` for
+    how they are weighed.
+
+    Args:
+        base_raster (gdal.Dataset): raster to compress.
+        block_size (tuple): (x, y) size of the tiles to compress.
+        interleave (str): see `compress_raster`.
+        compression_objective (str): one of ``COMPRESSION_OBJECTIVES``.
+        minimal_type (tuple): if not None the result of
+            `_minimal_lossless_type` to cast the sampled tiles with.
+
+    Returns:
+        dict with the chosen 'algorithm', 'predictor' and 'level', the
+        'objective', and the 'sample_compression_ratio' and
+        'sample_decode_seconds' it measured.
+
+    """
+    if compression_objective not in COMPRESSION_OBJECTIVES:
+        raise ValueError(
+            'compression_objective must be one of %s, got %s' % (
+                COMPRESSION_OBJECTIVES, compression_objective))
+    data_type = base_raster.GetRasterBand(1).DataType
+    if minimal_type is not None:
+        data_type = minimal_type[0]
+    n_bands = base_raster.RasterCount
+    block_xsize, block_ysize = block_size
+    n_block_cols = int(numpy.ceil(base_raster.RasterXSize / block_xsize))
+    n_block_rows = int(numpy.ceil(base_raster.RasterYSize / block_ysize))
+    n_blocks = n_block_cols * n_block_rows
+    n_sample_tiles = min(AUTO_COMPRESSION_SAMPLE_TILES, n_blocks)
+    random_state = numpy.random.RandomState(n_blocks)
+    tile_index_list = [
+        random_state.choice(stratum) for stratum in numpy.array_split(
+            numpy.arange(n_blocks), n_sample_tiles)]
+
+    # tiles are stacked vertically, edge tiles are padded by repeating
+    # their last pixels to a full tile
+    band_tile_list = [[] for _ in range(n_bands)]
+    for tile_index in tile_index_list:
+        xoff = (tile_index % n_block_cols) * block_xsize
+        yoff = (tile_index // n_block_cols) * block_ysize
+        win_xsize = min(block_xsize, base_raster.RasterXSize - xoff)
+        win_ysize = min(block_ysize, base_raster.RasterYSize - yoff)
+        for band_index in range(n_bands):
+            band = base_raster.GetRasterBand(band_index+1)
+            tile_array = band.ReadAsArray(
+                xoff=xoff, yoff=yoff, win_xsize=win_xsize,
+                win_ysize=win_ysize)
+            if minimal_type is not None:
+                tile_array = _cast_block(
+                    tile_array, band.GetNoDataValue(),
+                    minimal_type[2][band_index], minimal_type[1])
+            band_tile_list[band_index].append(numpy.pad(tile_array, (
+                (0, block_ysize-win_ysize), (0, block_xsize-win_xsize)),
+                mode='edge'))
+    sample_array = numpy.stack([
+        numpy.concatenate(tile_list) for tile_list in band_tile_list])
+
+    gtiff_driver = gdal.GetDriverByName('GTiff')
+    creation_option_list = (
+        gtiff_driver.GetMetadataItem('DMD_CREATIONOPTIONLIST') or '')
+    predictor_list = [1, 2]
+    if data_type in (gdal.GDT_Float32, gdal.GDT_Float64):
+        predictor_list.append(3)
+    candidate_list = []
+    for algorithm, level in AUTO_COMPRESSION_CANDIDATES:
+        if creation_option_list and algorithm not in creation_option_list:
+            LOGGER.info('%s compression is not available, skipping', algorithm)
+            continue
+        for predictor in predictor_list:
+            sample_path = '/vsimem/ecoshard_auto_compression_%d_%d.tif' % (
+                os.getpid(), threading.get_ident())
+            sample_raster = gtiff_driver.Create(
+                sample_path, block_xsize, sample_array.shape[1], n_bands,
+                data_type, options=_compression_option_list(
+                    data_type, algorithm, predictor, level, 1, block_size,
+                    interleave))
+            for band_index in range(n_bands):
+                sample_raster.GetRasterBand(band_index+1).WriteArray(
+                    sample_array[band_index])
+            sample_raster = None
+            compressed_size = gdal.VSIStatL(sample_path).size
+            # only the reads are timed, the block cache is dropped between
+            # them so every read decodes the tiles again
+            sample_raster = gdal.OpenEx(sample_path, gdal.OF_RASTER)
+            band_list = [
+                sample_raster.GetRasterBand(band_index+1)
+                for band_index in range(n_bands)]
+            decode_time = None
+            for _ in range(AUTO_COMPRESSION_DECODE_REPEATS):
+                sample_raster.FlushCache()
+                start_time = time.perf_counter()
+                for band in band_list:
+                    band.ReadAsArray()
+                elapsed_time = time.perf_counter() - start_time
+                if decode_time is None or elapsed_time < decode_time:
+                    decode_time = elapsed_time
+            band_list = None
+            sample_raster = None
+            gdal.Unlink(sample_path)
+            LOGGER.debug(
+                '%s predictor %d level %s: %d bytes, decoded in %.4fs',
+                algorithm, predictor, level, compressed_size, decode_time)
+            candidate_list.append(
+                (algorithm, predictor, level, compressed_size, decode_time))
+
+    algorithm, predictor, level, compressed_size, decode_time = (
+        _pick_compression_candidate(candidate_list, compression_objective))
+    compression_profile = {
+        'algorithm': algorithm,
+        'predictor': predictor,
+        'level': level,
+        'objective': compression_objective,
+        'sample_compression_ratio': compressed_size / sample_array.nbytes,
+        'sample_decode_seconds': decode_time,
+    }
+    LOGGER.info(
+        'chose %s compression from %d candidates on %d sampled tiles',
+        compression_profile, len(candidate_list), n_sample_tiles)
+    return compression_profile
+
+
+def _pick_compression_candidate(candidate_list, compression_objective):
+    """Pick the compression candidate that best meets an objective.
+
+    Decode times are compared as a ratio to the fastest candidate's, less
+    ``AUTO_COMPRESSION_DECODE_TOLERANCE`` so that candidates within that
+    fraction of the fastest tie with it. Sample decodes take milliseconds
+    and this keeps timer noise from deciding between them. 'smallest'
+    ranks by size then decode ratio, 'fastest-decode' by decode ratio then
+    size, and 'balanced' by the size relative to the smallest candidate's
+    plus the decode ratio. Candidates that still tie keep the order of
+    ``AUTO_COMPRESSION_CANDIDATES``.
+
+    Args:
+        candidate_list (list): (algorithm, predictor, level, compressed
+            size, decode seconds) tuples.
+        compression_objective (str): one of ``COMPRESSION_OBJECTIVES``.
+
+    Returns:
+        the chosen tuple from `candidate_list`.
+
+    """
+    min_size = max(min(candidate[3] for candidate in candidate_list), 1)
+    min_decode_time = max(
+        min(candidate[4] for candidate in candidate_list), 1e-9)
+    score_list = []
+    for _, _, _, size, decode_time in candidate_list:
+        decode_ratio = max(1.0, decode_time / min_decode_time / (
+            1 + AUTO_COMPRESSION_DECODE_TOLERANCE))
+        if compression_objective == 'smallest':
+            score_list.append((size, decode_ratio))
+        elif compression_objective == 'fastest-decode':
+            score_list.append((decode_ratio, size))
+        else:
+            score_list.append((size / min_size + decode_ratio,))
+    return candidate_list[score_list.index(min(score_list))]
+
+
+def _log_sparse_blocks(raster_path):
+    """Log the fraction of a GeoTIFF's blocks that were never written.
+
+    With SPARSE_OK=TRUE GDAL leaves blocks that are entirely nodata out of
+    the file, these have no BLOCK_OFFSET in the TIFF metadata domain.
+
+    Args:
+        raster_path (str): path to a GeoTIFF.
+
+    Returns:
+        fraction of the blocks of the first band that are sparse.
+
+    """
+    raster = gdal.OpenEx(raster_path, gdal.OF_RASTER)
+    band = raster.GetRasterBand(1)
+    block_xsize, block_ysize = band.GetBlockSize()
+    n_block_cols = int(numpy.ceil(raster.RasterXSize / block_xsize))
+    n_block_rows = int(numpy.ceil(raster.RasterYSize / block_ysize))
+    n_sparse = sum(
+        1 for block_row in range(n_block_rows)
+        for block_col in range(n_block_cols)
+        if not band.GetMetadataItem(
+            'BLOCK_OFFSET_%d_%d' % (block_col, block_row), 'TIFF'))
+    band = None
+    raster = None
+    sparse_fraction = n_sparse / (n_block_cols * n_block_rows)
+    LOGGER.info(
+        'skipped %d of %d blocks of %s that were entirely nodata (%.1f%%)',
+        n_sparse, n_block_cols * n_block_rows, raster_path,
+        100 * sparse_fraction)
+    return sparse_fraction
+
+
+def download_url(
+        url, target_path, skip_if_target_exists=False,
+        hash_algorithm_list=None, expected_hash=None,
+        rename_to_ecoshard=False, n_connections=1, n_retries=5):
+    """Download `url` to `target_path`.
+
+    Data is written to `target_path` + '.part' and renamed when complete. If
+    the server supports HTTP Range requests a dropped connection is resumed
+    where it stopped, both within this call and on a later call that finds
+    the '.part' file.
+
+    Any requested hashes are calculated from the data as it is written so
+    the downloaded file does not need to be read again to hash or validate
+    it. The exception is a multi-connection download, which is hashed once
+    it is complete.
+
+    Args:
+        url (str): url path to a file.
+        target_path (str): desired output target path.
+        skip_if_target_exists (bool): if True will not download a file if the
+            path already exists on disk. If hashes are requested they are
+            calculated from the existing file.
+        hash_algorithm_list (list): if not None, a list (or comma separated
+            string) of hash algorithms to calculate while downloading.
+        expected_hash (str): if not None, either a string in the format
+            [hash alg]_[hash val] or 'ecoshard' to take the expected hash
+            from the ecoshard formatted basename of `url`. If the downloaded
+            data does not match, `target_path` is removed and a ValueError
+            is raised.
+        rename_to_ecoshard (bool): if True, the downloaded file is renamed
+            to [target base name]_[hashalg]_[hash][target extension] using
+            the first algorithm in `hash_algorithm_list`, or the algorithm
+            of `expected_hash` if no list is given, or md5.
+        n_connections (int): number of concurrent connections to split the
+            download across. Falls back to a single stream if the server
+            does not support Range requests.
+        n_retries (int): number of times to retry after a network error
+            before giving up.
+
+    Returns:
+        a dictionary mapping each calculated hash algorithm to the hex digest
+        of the downloaded file, empty if no hash was requested.
+
+    """
+    hash_algorithm_list = (
+        _hash_algorithm_list(hash_algorithm_list)
+        if hash_algorithm_list else [])
+    if expected_hash == 'ecoshard':
+        url_filename = os.path.basename(urllib.parse.urlparse(url).path)
+        ecoshard_hash = _parse_ecoshard_hash(url_filename)
+        if not ecoshard_hash:
+            raise ValueError(
+                '%s does not match an ecoshard, cannot infer the expected '
+                'hash' % url_filename)
+    elif expected_hash:
+        # the hash value has no '_' but algorithms like sha3_256 do
+        ecoshard_hash = expected_hash.rsplit('_', 1)
+        if len(ecoshard_hash) != 2:
+            raise ValueError(
+                'expected hash %s is not in the format '
+                '[hash alg]_[hash val]' % expected_hash)
+    else:
+        ecoshard_hash = None
+    if ecoshard_hash and ecoshard_hash[0] not in hash_algorithm_list:
+        hash_algorithm_list.append(ecoshard_hash[0])
+    if rename_to_ecoshard and not hash_algorithm_list:
+        hash_algorithm_list.append('md5')
+    hash_algorithm_list = (
+        _hash_algorithm_list(hash_algorithm_list)
+        if hash_algorithm_list else [])
+
+    if skip_if_target_exists and os.path.exists(target_path):
+        if not hash_algorithm_list:
+            return {}
+        hash_dict = calculate_hashes(target_path, hash_algorithm_list)
+    else:
+        hash_dict = _download_and_hash(
+            url, target_path, hash_algorithm_list, n_connections, n_retries)
+
+    if ecoshard_hash:
+        calculated_hash = hash_dict[ecoshard_hash[0]]
+        if calculated_hash != ecoshard_hash[1]:
+            os.remove(target_path)
+            raise ValueError(
+                'hash does not match, calculated %s and expected %s '
+                'on %s downloaded from %s' % (
+                    calculated_hash, ecoshard_hash[1], target_path, url))
+
+    if rename_to_ecoshard:
+        prefix, extension = os.path.splitext(target_path)
+        ecoshard_path = '%s_%s_%s%s' % (
+            prefix, hash_algorithm_list[0],
+            hash_dict[hash_algorithm_list[0]], extension)
+        LOGGER.info('renaming %s to %s', target_path, ecoshard_path)
+        os.replace(target_path, ecoshard_path)
+    return hash_dict
+
+
+def download_many(
+        url_target_pairs, max_workers=8, per_host_limit=4, n_retries=5,
+        skip_if_target_exists=False):
+    """Download many urls concurrently over pooled keep-alive connections.
+
+    Connections are reused across files through a shared `requests`
+    session, so batches of small files are not dominated by TCP and TLS
+    handshakes. A failed file is retried and then reported in the result
+    rather than stopping the rest of the batch. Aggregate throughput and an
+    ETA are logged every few seconds.
+
+    Args:
+        url_target_pairs (list): list of (url, target path) tuples.
+        max_workers (int): maximum number of concurrent downloads.
+        per_host_limit (int): maximum number of concurrent downloads from
+            any one host.
+        n_retries (int): number of times to retry a file after a transient
+            error before marking it failed.
+        skip_if_target_exists (bool): if True, urls whose target path
+            already exists are not downloaded.
+
+    Returns:
+        list of dictionaries in the order of `url_target_pairs`, each with
+        keys 'url', 'target_path', 'status' (one of 'ok', 'skipped' or
+        'failed'), 'bytes' downloaded, 'elapsed' seconds, 'attempts' and
+        'error' (None unless the status is 'failed').
+
+    """
+    url_target_pairs = list(url_target_pairs)
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=max(1, max_workers),
+        pool_maxsize=max(1, max_workers))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    host_semaphore_dict = {}
+    state_lock = threading.Lock()
+    progress = {
+        'downloaded': 0,
+        'n_done': 0,
+        'expected_bytes': {},
+    }
+    start_time = time.time()
+    logger_callback = _make_logger_callback(
+        'download_many %.2f%% complete %s')
+    # the first call only starts the callback's timer
+    logger_callback(0.0, None, [''])
+
+    def _log_progress():
+        """Log aggregate progress, must be called holding `state_lock`."""
+        elapsed_time = max(time.time() - start_time, 1e-6)
+        rate = progress['downloaded'] / elapsed_time
+        expected_bytes_list = list(progress['expected_bytes'].values())
+        if expected_bytes_list:
+            # files not started yet are assumed to be the average size
+            estimated_total = sum(expected_bytes_list) + (
+                len(url_target_pairs) - len(expected_bytes_list)) * (
+                sum(expected_bytes_list) / len(expected_bytes_list))
+        else:
+            estimated_total = 0
+        estimated_total = max(estimated_total, progress['downloaded'], 1)
+        eta = (estimated_total - progress['downloaded']) / max(rate, 1e-6)
+        logger_callback(
+            min(1.0, progress['downloaded'] / estimated_total), None, [
+                '(%d of %d files, %.2fMB @ %.2fMB/s, ETA %ds)' % (
+                    progress['n_done'], len(url_target_pairs),
+                    progress['downloaded'] / 2**20, rate / 2**20, eta)])
+
+    def _download(index_url_target):
+        index, (url, target_path) = index_url_target
+        result = {
+            'url': url,
+            'target_path': target_path,
+            'status': 'ok',
+            'bytes': 0,
+            'elapsed': 0.0,
+            'attempts': 0,
+            'error': None,
+        }
+        file_start_time = time.time()
+        if skip_if_target_exists and os.path.exists(target_path):
+            result['status'] = 'skipped'
+        else:
+            host = urllib.parse.urlparse(url).netloc
+            with state_lock:
+                if host not in host_semaphore_dict:
+                    host_semaphore_dict[host] = threading.Semaphore(
+                        max(1, per_host_limit))
+                host_semaphore = host_semaphore_dict[host]
+            with host_semaphore:
+                while True:
+                    result['attempts'] += 1
+                    try:
+                        result['bytes'] = _session_download(
+                            session, url, target_path, index, progress,
+                            state_lock, _log_progress)
+                        break
+                    except (requests.RequestException, OSError) as error:
+                        response = getattr(error, 'response', None)
+                        retryable = response is None or (
+                            response.status_code >= 500 or
+                            response.status_code in (408, 429))
+                        if error.errno in LOCAL_IO_ERRNO_SET:
+                            retryable = False
+                        if not retryable or result['attempts'] > n_retries:
+                            LOGGER.error(
+                                'failed to download %s: %s', url, error)
+                            result['status'] = 'failed'
+                            result['error'] = str(error)
+                            break
+                        wait_time = min(2**result['attempts'], 30)
+                        LOGGER.warning(
+                            'error downloading %s (%s), retry %d of %d in '
+                            '%ds', url, error, result['attempts'],
+                            n_retries, wait_time)
+                        time.sleep(wait_time)
+        result['elapsed'] = time.time() - file_start_time
+        with state_lock:
+            progress['n_done'] += 1
+            _log_progress()
+        return result
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=max(1, max_workers)) as executor:
+            result_list = list(executor.map(
+                _download, enumerate(url_target_pairs)))
+    finally:
+        session.close()
+
+    elapsed_time = max(time.time() - start_time, 1e-6)
+    total_bytes = sum(result['bytes'] for result in result_list)
+    LOGGER.info(
+        'download_many complete: %d ok, %d skipped, %d failed, %.2fMB in '
+        '%.1fs @ %.2fMB/s',
+        sum(result['status'] == 'ok' for result in result_list),
+        sum(result['status'] == 'skipped' for result in result_list),
+        sum(result['status'] == 'failed' for result in result_list),
+        total_bytes / 2**20, elapsed_time, total_bytes / 2**20 / elapsed_time)
+    return result_list
+
+
+def _session_download(
+        session, url, target_path, index, progress, state_lock,
+        log_progress):
+    """Download one `download_many` file through `session`.
+
+    Data is written to `target_path` + '.part' and renamed when complete.
+    The body is requested and saved without any content decoding so the
+    file matches what `download_url` would write.
+    Bytes from an attempt that fails are taken back out of the progress
+    count so retries are not counted twice.
+
+    Returns:
+        number of bytes downloaded.
+
+    """
+    part_path = '%s.part' % target_path
+    n_bytes = 0
+    try:
+        # save the bytes as sent so they match `download_url` and
+        # Content-Length, requests would otherwise decode gzip transfers
+        with session.get(
+                url, stream=True, timeout=DOWNLOAD_TIMEOUT,
+                headers={'Accept-Encoding': 'identity'}) as response:
+            response.raise_for_status()
+            content_length = int(response.headers.get('Content-Length', 0))
+            with state_lock:
+                progress['expected_bytes'][index] = content_length
+            with open(part_path, 'wb') as part_file:
+                for data_buffer in response.raw.stream(
+                        2**20, decode_content=False):
+                    part_file.write(data_buffer)
+                    n_bytes += len(data_buffer)
+                    with state_lock:
+                        progress['downloaded'] += len(data_buffer)
+                        log_progress()
+        if content_length and n_bytes != content_length:
+            raise requests.exceptions.ChunkedEncodingError(
+                'expected %d bytes from %s but got %d' % (
+                    content_length, url, n_bytes))
+        os.replace(part_path, target_path)
+    except BaseException:
+        with state_lock:
+            progress['downloaded'] -= n_bytes
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+    return n_bytes
+
+
+def _download_and_hash(
+        url, target_path, hash_algorithm_list, n_connections, n_retries):
+    """Download `url` to `target_path` through a resumable '.part' file.
+
+    Args:
+        url (str): url path to a file.
+        target_path (str): desired output target path.
+        hash_algorithm_list (list): list of hash algorithms to calculate.
+        n_connections (int): number of concurrent ranged connections to use.
+        n_retries (int): number of times to retry after a network error.
+
+    Returns:
+        a dictionary mapping each algorithm in `hash_algorithm_list` to the
+        hex digest of the downloaded data.
+
+    """
+    part_path = '%s.part' % target_path
+    if n_connections > 1:
+        file_size = _range_download_size(url)
+        if file_size:
+            _download_ranges(
+                url, part_path, file_size, n_connections, n_retries)
+            os.replace(part_path, target_path)
+            if not hash_algorithm_list:
+                return {}
+            return calculate_hashes(
+                target_path, hash_algorithm_list, use_hash_cache=False)
+        LOGGER.info(
+            '%s does not support range requests, downloading with a single '
+            'connection', url)
+    hash_dict = _download_stream(
+        url, part_path, hash_algorithm_list, n_retries)
+    os.replace(part_path, target_path)
+    return hash_dict
+
+
+def _is_retryable_download_error(error):
+    """Return True if a download error is worth retrying."""
+    if isinstance(error, urllib.error.HTTPError):
+        return error.code >= 500 or error.code in (408, 429)
+    if isinstance(error, OSError) and error.errno in LOCAL_IO_ERRNO_SET:
+        # the local disk failed, fetching the data again will not help
+        return False
+    return isinstance(error, (
+        urllib.error.URLError, http.client.HTTPException, OSError))
+
+
+def _wait_to_retry(url, error, attempt, n_retries):
+    """Sleep before retry `attempt` or raise `error` if out of retries."""
+    if attempt > n_retries or not _is_retryable_download_error(error):
+        raise error
+    wait_time = min(2**attempt, 30)
+    LOGGER.warning(
+        'error downloading %s (%s), retry %d of %d in %ds', url, error,
+        attempt, n_retries, wait_time)
+    time.sleep(wait_time)
+
+
+def _log_download_progress(
+        downloaded_so_far, file_size, last_download_size, elapsed_time):
+    """Log download progress in the `download_url` status format."""
+    download_rate = (
+        (downloaded_so_far - last_download_size)/2**20) / max(
+            float(elapsed_time), 1e-6)
+    LOGGER.info(r"%10dMB  [%3.2f%% @ %5.2fMB/s]" % (
+        downloaded_so_far/2**20, downloaded_so_far * 100. /
+        max(file_size, downloaded_so_far, 1), download_rate))
+
+
+def _download_stream(url, part_path, hash_algorithm_list, n_retries):
+    """Download `url` to `part_path` over a single connection.
+
+    If `part_path` already has data the download resumes after it with a
+    Range request, or starts over if the server ignores the range.
+
+    Args:
+        url (str): url path to a file.
+        part_path (str): path to write the download to.
+        hash_algorithm_list (list): list of hash algorithms to calculate.
+        n_retries (int): number of times to retry after a network error.
+
+    Returns:
+        a dictionary mapping each algorithm in `hash_algorithm_list` to the
+        hex digest of the downloaded data.
+
+    """
+    # a leftover multi-connection download is not a contiguous prefix
+    if os.path.exists('%s.json' % part_path):
+        os.remove('%s.json' % part_path)
+        if os.path.exists(part_path):
+            os.remove(part_path)
+    hash_func_list = [
+        (hash_algorithm, _new_hash(hash_algorithm))
+        for hash_algorithm in hash_algorithm_list]
+    downloaded_so_far = 0
+    if os.path.exists(part_path):
+        # the digests have to cover the data that is already on disk
+        for binary_view in _iter_file_buffers(part_path):
+            for _, hash_func in hash_func_list:
+                hash_func.update(binary_view)
+            downloaded_so_far += len(binary_view)
+
+    start_time = time.time()
+    start_size = downloaded_so_far
+    attempt = 0
+    with open(part_path, 'r+b' if downloaded_so_far else 'wb') as part_file:
+        while True:
+            request = urllib.request.Request(url)
+            if downloaded_so_far:
+                request.add_header('Range', 'bytes=%d-' % downloaded_so_far)
+            try:
+                with urllib.request.urlopen(
+                        request, timeout=DOWNLOAD_TIMEOUT) as url_stream:
+                    if downloaded_so_far and url_stream.status != 206:
+                        LOGGER.warning(
+                            'server did not honor the range request for %s, '
+                            'starting over', url)
+                        downloaded_so_far = 0
+                        hash_func_list = [
+                            (hash_algorithm, _new_hash(hash_algorithm))
+                            for hash_algorithm in hash_algorithm_list]
+                    elif downloaded_so_far:
+                        LOGGER.info(
+                            'resuming %s at %d bytes', url, downloaded_so_far)
+                    part_file.seek(downloaded_so_far)
+                    part_file.truncate()
+                    file_size = downloaded_so_far + int(
+                        url_stream.headers['Content-Length'] or 0)
+                    LOGGER.info(
+                        "Downloading: %s Bytes: %s" % (part_path, file_size))
+
+                    block_size = 2**20
+                    last_log_time = time.time()
+                    last_download_size = downloaded_so_far
+                    while True:
+                        data_buffer = url_stream.read(block_size)
+                        if not data_buffer:
+                            break
+                        downloaded_so_far += len(data_buffer)
+                        part_file.write(data_buffer)
+                        for _, hash_func in hash_func_list:
+                            hash_func.update(data_buffer)
+                        time_since_last_log = time.time() - last_log_time
+                        if time_since_last_log > 5.0:
+                            _log_download_progress(
+                                downloaded_so_far, file_size,
+                                last_download_size, time_since_last_log)
+                            last_download_size = downloaded_so_far
+                            last_log_time = time.time()
+                    if downloaded_so_far < file_size:
+                        raise http.client.IncompleteRead(
+                            b'', file_size - downloaded_so_far)
+                break
+            except urllib.error.HTTPError as error:
+                if error.code == 416 and downloaded_so_far and (
+                        error.headers.get('Content-Range', '') ==
+                        'bytes */%d' % downloaded_so_far):
+                    # the '.part' file was already complete
+                    break
+                attempt += 1
+                _wait_to_retry(url, error, attempt, n_retries)
+            except (
+                    urllib.error.URLError, http.client.HTTPException,
+                    OSError) as error:
+                attempt += 1
+                _wait_to_retry(url, error, attempt, n_retries)
+        _log_download_progress(
+            downloaded_so_far, downloaded_so_far, start_size,
+            time.time() - start_time)
+        part_file.flush()
+        os.fsync(part_file.fileno())
+    return {
+        hash_algorithm: hash_func.hexdigest()
+        for hash_algorithm, hash_func in hash_func_list}
+
+
+def _range_download_size(url):
+    """Return the size of `url` if its server supports Range requests.
+
+    Args:
+        url (str): url path to a file.
+
+    Returns:
+        size of the file in bytes, or None if the server does not answer a
+        Range request with a partial response or the file is empty.
+
+    """
+    request = urllib.request.Request(url, headers={'Range': 'bytes=0-0'})
+    try:
+        with urllib.request.urlopen(
+                request, timeout=DOWNLOAD_TIMEOUT) as response:
+            if response.status != 206:
+                return None
+            match_result = re.match(
+                r'bytes\s+0-0/(\d+)',
+                response.headers.get('Content-Range', ''))
+    except urllib.error.HTTPError as error:
+        if error.code == 416:
+            return None
+        raise
+    if not match_result:
+        return None
+    return int(match_result.group(1))
+
+
+def _download_ranges(url, part_path, file_size, n_connections, n_retries):
+    """Download `url` to `part_path` over concurrent Range requests.
+
+    The file is preallocated and split into chunks of at most
+    DOWNLOAD_CHUNK_SIZE that are fetched by `n_connections` threads and
+    written in place. Finished chunks are synced to disk and recorded in
+    `part_path` + '.json' so an interrupted download only fetches the
+    missing chunks next time. The record is discarded if `part_path` is
+    missing or shorter than `file_size`.
+
+    Args:
+        url (str): url path to a file.
+        part_path (str): path to write the download to.
+        file_size (int): size of the file at `url` in bytes.
+        n_connections (int): number of concurrent connections.
+        n_retries (int): number of times to retry each chunk after a network
+            error.
+
+    Returns:
+        None.
+
+    """
+    chunk_size = min(
+        DOWNLOAD_CHUNK_SIZE, max(2**20, -(-file_size // n_connections)))
+    n_chunks = -(-file_size // chunk_size)
+    state_path = '%s.json' % part_path
+    done_chunk_set = set()
+    if os.path.exists(state_path):
+        with open(state_path, 'r') as state_file:
+            state = json.load(state_file)
+        # without its full size '.part' file the chunk record is stale
+        if (state['file_size'], state['chunk_size']) == (
+                file_size, chunk_size) and os.path.exists(part_path) and (
+                    os.path.getsize(part_path) >= file_size):
+            done_chunk_set = set(state['done'])
+        else:
+            os.remove(state_path)
+    elif os.path.exists(part_path):
+        # a single stream download left a contiguous prefix behind
+        prefix_size = os.path.getsize(part_path)
+        done_chunk_set = {
+            chunk_index for chunk_index in range(n_chunks)
+            if min((chunk_index+1) * chunk_size, file_size) <= prefix_size}
+    if done_chunk_set:
+        LOGGER.info(
+            'resuming %s with %d of %d chunks already downloaded', url,
+            len(done_chunk_set), n_chunks)
+
+    state_lock = threading.Lock()
+    progress = {
+        'downloaded': sum(
+            min(chunk_size, file_size - chunk_index * chunk_size)
+            for chunk_index in done_chunk_set),
+        'last_log_time': time.time(),
+    }
+    progress['last_download_size'] = progress['downloaded']
+
+    def _write_state():
+        with open('%s.tmp' % state_path, 'w') as state_file:
+            json.dump({
+                'file_size': file_size, 'chunk_size': chunk_size,
+                'done': sorted(done_chunk_set)}, state_file)
+        os.replace('%s.tmp' % state_path, state_path)
+
+    with open(part_path, 'r+b' if os.path.exists(part_path) else 'wb') as (
+            part_file):
+        part_file.truncate(file_size)
+        if hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(part_file.fileno(), 0, file_size)
+            except OSError:
+                # not every filesystem can preallocate, sparse is fine
+                pass
+        _write_state()
+        fd = part_file.fileno()
+
+        def _fetch_chunk(chunk_index):
+            offset = chunk_index * chunk_size
+            last_byte = min(offset + chunk_size, file_size) - 1
+            attempt = 0
+            while offset <= last_byte:
+                request = urllib.request.Request(
+                    url, headers={
+                        'Range': 'bytes=%d-%d' % (offset, last_byte)})
+                try:
+                    with urllib.request.urlopen(
+                            request, timeout=DOWNLOAD_TIMEOUT) as url_stream:
+                        if url_stream.status != 206:
+                            raise http.client.HTTPException(
+                                'expected a partial response, got %d' % (
+                                    url_stream.status))
+                        while offset <= last_byte:
+                            data_buffer = url_stream.read(min(
+                                2**20, last_byte - offset + 1))
+                            if not data_buffer:
+                                raise http.client.IncompleteRead(
+                                    b'', last_byte - offset + 1)
+                            if hasattr(os, 'pwrite'):
+                                os.pwrite(fd, data_buffer, offset)
+                            else:
+                                with state_lock:
+                                    os.lseek(fd, offset, os.SEEK_SET)
+                                    os.write(fd, data_buffer)
+                            offset += len(data_buffer)
+                            with state_lock:
+                                progress['downloaded'] += len(data_buffer)
+                                time_since_last_log = (
+                                    time.time() - progress['last_log_time'])
+                                if time_since_last_log > 5.0:
+                                    _log_download_progress(
+                                        progress['downloaded'], file_size,
+                                        progress['last_download_size'],
+                                        time_since_last_log)
+                                    progress['last_download_size'] = (
+                                        progress['downloaded'])
+                                    progress['last_log_time'] = time.time()
+                except (
+                        urllib.error.URLError, http.client.HTTPException,
+                        OSError) as error:
+                    attempt += 1
+                    _wait_to_retry(url, error, attempt, n_retries)
+            # the chunk is only recorded once its data is on disk
+            os.fsync(fd)
+            with state_lock:
+                done_chunk_set.add(chunk_index)
+                _write_state()
+
+        LOGGER.info(
+            "Downloading: %s Bytes: %s with %d connections" % (
+                part_path, file_size, n_connections))
+        start_time = time.time()
+        start_size = progress['downloaded']
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=n_connections) as executor:
+            list(executor.map(_fetch_chunk, [
+                chunk_index for chunk_index in range(n_chunks)
+                if chunk_index not in done_chunk_set]))
+        _log_download_progress(
+            file_size, file_size, start_size, time.time() - start_time)
+        part_file.flush()
+        os.fsync(fd)
+    os.remove(state_path)
+
+
+def download_and_unzip(
+        url, target_dir, target_token_path=None, n_workers=None,
+        incremental=True):
+    """Download `url` to `target_dir` and touch `target_token_path`.
+
+    Zip files are downloaded then extracted by a pool of `n_workers`
+    threads. Tar archives (.tar, .tar.gz, .tgz, .tar.bz2, .tar.xz, .tar.zst
+    and .tzst) are extracted while they download and are not kept on disk;
+    .tar.zst needs the `zstandard` package.
 
     Args:
         url (str): url to file to download
@@ -412,23 +2678,186 @@ def download_and_unzip(url, target_dir, target_token_path=None):
             an operation is complete. It may be complicated to list the files
             that are unzipped, so instead this file is created and contains
             the timestamp of when this function completed.
+        n_workers (int): number of threads extracting zip members, if None
+            the number of CPUs.
+        incremental (bool): if True, members that are already in
+            `target_dir` are not extracted again. A zip member is skipped if
+            the existing file has the same size and CRC32, a tar member if it
+            has the same size and modification time.
 
     Returns:
         None.
 
     """
-    zipfile_path = os.path.join(target_dir, os.path.basename(url))
-    LOGGER.info('download %s, to: %s', url, zipfile_path)
-    download_url(url, zipfile_path)
-
-    LOGGER.info('unzip %s', zipfile_path)
-    with zipfile.ZipFile(zipfile_path, 'r') as zip_ref:
-        zip_ref.extractall(target_dir)
+    archive_filename = os.path.basename(urllib.parse.urlparse(url).path)
+    tar_mode = _streaming_tar_mode(archive_filename)
+    if tar_mode:
+        LOGGER.info('download and extract %s, to: %s', url, target_dir)
+        _download_and_untar(url, target_dir, tar_mode, incremental)
+        archive_path = url
+    else:
+        archive_path = os.path.join(target_dir, os.path.basename(url))
+        LOGGER.info('download %s, to: %s', url, archive_path)
+        download_url(url, archive_path)
+        LOGGER.info('unzip %s', archive_path)
+        _parallel_unzip(archive_path, target_dir, n_workers, incremental)
 
     if target_token_path:
         with open(target_token_path, 'w') as touchfile:
-            touchfile.write(f'unzipped {zipfile_path}')
-    LOGGER.info('download an unzip for %s complete', zipfile_path)
+            touchfile.write(f'unzipped {archive_path}')
+    LOGGER.info('download an unzip for %s complete', archive_path)
+
+
+def _streaming_tar_mode(archive_filename):
+    """Return the streaming tarfile mode for a filename or None if not tar.
+
+    The mode 'r|zst' is not a tarfile mode, it indicates the stream must be
+    decompressed with zstandard before it is read as 'r|'.
+
+    """
+    archive_filename = archive_filename.lower()
+    for suffix_tuple, mode in [
+            (('.tar.gz', '.tgz'), 'r|gz'),
+            (('.tar.bz2', '.tbz2'), 'r|bz2'),
+            (('.tar.xz', '.txz'), 'r|xz'),
+            (('.tar.zst', '.tzst'), 'r|zst'),
+            (('.tar',), 'r|')]:
+        if archive_filename.endswith(suffix_tuple):
+            return mode
+    return None
+
+
+def _download_and_untar(url, target_dir, tar_mode, incremental):
+    """Extract a tar archive from `url` into `target_dir` as it downloads.
+
+    Args:
+        url (str): url to a tar archive.
+        target_dir (str): directory to extract into.
+        tar_mode (str): result of `_streaming_tar_mode`.
+        incremental (bool): if True, skip members already in `target_dir`
+            with the same size and modification time.
+
+    Returns:
+        None.
+
+    """
+    os.makedirs(target_dir, exist_ok=True)
+    with urllib.request.urlopen(url, timeout=DOWNLOAD_TIMEOUT) as url_stream:
+        stream = url_stream
+        if tar_mode == 'r|zst':
+            if zstandard is None:
+                raise ImportError(
+                    'the zstandard package is required to extract %s' % url)
+            stream = zstandard.ZstdDecompressor().stream_reader(url_stream)
+            tar_mode = 'r|'
+        extract_kwargs = {}
+        if hasattr(tarfile, 'data_filter'):
+            # reject absolute paths, links out of target_dir and the like
+            extract_kwargs['filter'] = 'data'
+        n_extracted = 0
+        n_skipped = 0
+        with tarfile.open(fileobj=stream, mode=tar_mode) as tar_ref:
+            for member in tar_ref:
+                if 'filter' not in extract_kwargs and (
+                        os.path.isabs(member.name) or
+                        '..' in member.name.replace('\\', '/').split('/')):
+                    raise ValueError(
+                        'refusing to extract %s outside of %s' % (
+                            member.name, target_dir))
+                member_path = os.path.join(target_dir, member.name)
+                if incremental and member.isfile() and os.path.isfile(
+                        member_path):
+                    member_stat = os.stat(member_path)
+                    if (member_stat.st_size == member.size and
+                            int(member_stat.st_mtime) == int(member.mtime)):
+                        n_skipped += 1
+                        continue
+                tar_ref.extract(member, target_dir, **extract_kwargs)
+                n_extracted += 1
+    LOGGER.info(
+        'extracted %d members from %s, skipped %d already on disk',
+        n_extracted, url, n_skipped)
+
+
+def _parallel_unzip(zipfile_path, target_dir, n_workers, incremental):
+    """Extract the members of a zip file with a pool of threads.
+
+    Each thread opens its own handle to the zip file so members are
+    decompressed concurrently; zlib releases the GIL while it works.
+
+    Args:
+        zipfile_path (str): path to a zip file.
+        target_dir (str): directory to extract into.
+        n_workers (int): number of threads, if None the number of CPUs.
+        incremental (bool): if True, skip members already in `target_dir`
+            with the same size and CRC32.
+
+    Returns:
+        None.
+
+    """
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    with zipfile.ZipFile(zipfile_path, 'r') as zip_ref:
+        member_list = zip_ref.infolist()
+    thread_local = threading.local()
+    zip_ref_list = []
+    zip_ref_list_lock = threading.Lock()
+
+    def _extract_member(member):
+        if not hasattr(thread_local, 'zip_ref'):
+            thread_local.zip_ref = zipfile.ZipFile(zipfile_path, 'r')
+            with zip_ref_list_lock:
+                zip_ref_list.append(thread_local.zip_ref)
+        if incremental and not member.is_dir() and _zip_member_on_disk(
+                member, target_dir):
+            return False
+        try:
+            thread_local.zip_ref.extract(member, target_dir)
+        except FileExistsError:
+            # another thread created a shared parent directory between the
+            # existence check and makedirs in zipfile, it exists now
+            thread_local.zip_ref.extract(member, target_dir)
+        return True
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=max(1, n_workers)) as executor:
+            extracted_list = list(executor.map(_extract_member, member_list))
+    finally:
+        for zip_ref in zip_ref_list:
+            zip_ref.close()
+    n_extracted = sum(extracted_list)
+    LOGGER.info(
+        'extracted %d members from %s, skipped %d already on disk',
+        n_extracted, zipfile_path, len(member_list) - n_extracted)
+
+
+def _zip_member_on_disk(member, target_dir):
+    """Return True if a zip member is already extracted in `target_dir`.
+
+    Args:
+        member (zipfile.ZipInfo): the member to look for.
+        target_dir (str): directory the zip is extracted into.
+
+    Returns:
+        True if a file at the member's path has its size and CRC32.
+
+    """
+    member_path = os.path.abspath(os.path.join(
+        target_dir, *member.filename.split('/')))
+    if not member_path.startswith(os.path.abspath(target_dir) + os.sep):
+        # leave unusual paths to zipfile's own sanitizing in extract
+        return False
+    try:
+        if os.path.getsize(member_path) != member.file_size:
+            return False
+    except OSError:
+        return False
+    crc = 0
+    for binary_view in _iter_file_buffers(member_path):
+        crc = zlib.crc32(binary_view, crc)
+    return crc == member.CRC
 
 
 def copy_to_bucket(base_path, target_gs_path, target_token_path=None):
@@ -458,36 +2887,81 @@ def copy_to_bucket(base_path, target_gs_path, target_token_path=None):
 
 
 def convolve_layer(
-        base_raster_path, integer_factor, method, target_raster_path):
+        base_raster_path, integer_factor, method, target_raster_path,
+        n_workers=1, max_block_bytes=DEFAULT_MAX_BLOCK_BYTES,
+        use_overviews=False,
+        raster_driver_creation_tuple=DEFAULT_GTIFF_CREATION_TUPLE_OPTIONS):
     """Convolve a raster to a lower size.
 
     Args:
         base_raster_path (str): base raster.
         integer_factor (int): integer number of pixels to aggregate by.
             i.e. 2 -- makes 2x2 into a 1x1, 3-- 3x3 to a 1x1.
-        method (str): one of 'max', 'min', 'sum', 'average', 'mode'.
-        target_raster_path (str): based off of `base_raster_path` with size
-            reduced by `integer_factor`.
+        method (str or list): one of 'max', 'min', 'sum', 'average', 'mode'
+            or a list of them to calculate in a single read of
+            `base_raster_path`.
+        target_raster_path (str or list): based off of `base_raster_path`
+            with size reduced by `integer_factor`. If `method` is a list
+            this is either a list of paths, one per method, or a single
+            path to a raster with one band per method.
+        n_workers (int): number of threads that read and reduce blocks of
+            `base_raster_path` in parallel. Reduced blocks are written in
+            order by a single writer thread and at most a few blocks per
+            worker are held in memory at once.
+        max_block_bytes (int): about how many bytes of `base_raster_path`
+            to read at a time, see `plan_blocks`. Reducing a block takes
+            working memory of a few times its size.
+        use_overviews (bool): if True and `base_raster_path` has an
+            overview reduced by exactly `integer_factor` with the same
+            'max' or 'min' resampling as `method`, the overview is copied
+            rather than reduced again. Only rasters without nodata whose
+            size `integer_factor` divides are copied, GDAL skips nodata
+            and handles partial edge windows differently. 'average', 'sum'
+            and 'mode' are never taken from overviews since GDAL rounds and
+            breaks ties differently, and why an overview was not used is
+            logged. The resampling is
+            taken from the overview's RESAMPLING metadata or the metadata
+            `build_overviews` writes, which is wrong if the overviews were
+            since rebuilt by another tool with a different method.
+        raster_driver_creation_tuple (tuple): a tuple containing a GDAL
+            driver name string as the first element and a GDAL creation
+            options tuple/list as the second, ex: add 'PREDICTOR=3' for
+            floating point rasters. Reduced blocks are written a whole
+            number of the target's tiles at a time so compressed tiles are
+            never rewritten.
 
     Return:
         None.
 
     """
+    method_list = [method] if isinstance(method, str) else list(method)
+    for method_id in method_list:
+        if method_id not in REDUCE_METHODS:
+            raise ValueError("unknown method: %s" % method_id)
+    if isinstance(target_raster_path, str):
+        target_path_list = [target_raster_path]
+    else:
+        target_path_list = list(target_raster_path)
+        if len(target_path_list) != len(method_list):
+            raise ValueError(
+                'expected one target raster per method, got %d paths for '
+                '%s' % (len(target_path_list), method_list))
     base_raster_info = pygeoprocessing.get_raster_info(base_raster_path)
-    n_cols, n_rows = numpy.ceil(base_raster_info['raster_size']).astype(
-        numpy.int)
+    n_cols, n_rows = base_raster_info['raster_size']
     n_cols_reduced = int(numpy.ceil(n_cols / integer_factor))
     n_rows_reduced = int(numpy.ceil(n_rows / integer_factor))
     nodata = base_raster_info['nodata'][0]
-    pygeoprocessing.new_raster_from_base(
-        base_raster_path, target_raster_path, base_raster_info['datatype'],
-        [nodata], n_rows=n_rows_reduced, n_cols=n_cols_reduced)
+    n_bands = len(method_list) // len(target_path_list)
+    for path in target_path_list:
+        pygeoprocessing.new_raster_from_base(
+            base_raster_path, path, base_raster_info['datatype'],
+            [nodata] * n_bands, n_rows=n_rows_reduced,
+            n_cols=n_cols_reduced,
+            raster_driver_creation_tuple=raster_driver_creation_tuple)
 
     base_raster = gdal.OpenEx(base_raster_path, gdal.OF_RASTER)
     base_band = base_raster.GetRasterBand(1)
     base_geotransform = base_raster.GetGeoTransform()
-    target_raster = gdal.OpenEx(
-        target_raster_path, gdal.OF_RASTER | gdal.GA_Update)
     target_geotransform = [
         base_geotransform[0],
         base_geotransform[1]*integer_factor,
@@ -495,108 +2969,1045 @@ def convolve_layer(
         base_geotransform[3],
         base_geotransform[4]*integer_factor,
         base_geotransform[5]*integer_factor]
-    target_raster.SetGeoTransform(target_geotransform)
+    target_raster_list = []
+    for path in target_path_list:
+        target_raster = gdal.OpenEx(path, gdal.OF_RASTER | gdal.GA_Update)
+        target_raster.SetGeoTransform(target_geotransform)
+        target_raster_list.append(target_raster)
+    # one band per method, in the order of `method_list`
+    target_band_list = [
+        target_raster.GetRasterBand(band_index)
+        for target_raster in target_raster_list
+        for band_index in range(1, n_bands+1)]
 
-    target_band = target_raster.GetRasterBand(1)
+    overview_band = None
+    if use_overviews and len(set(method_list)) != 1:
+        LOGGER.info(
+            'not reducing %s from its overviews: more than one method %s',
+            base_raster_path, method_list)
+    elif use_overviews:
+        overview_band = _matching_overview(
+            base_raster, integer_factor, method_list[0])
+    if overview_band is not None:
+        LOGGER.info(
+            'reducing %s by %d with %s from its existing overview rather '
+            'than the full resolution raster', base_raster_path,
+            integer_factor, method_list[0])
+        # write whole rows of target tiles at a time
+        target_block_ysize = target_band_list[0].GetBlockSize()[1]
+        rows_per_stripe = max(1, max_block_bytes // max(1, (
+            overview_band.XSize * numpy.dtype(
+                base_raster_info['numpy_type']).itemsize)) //
+            target_block_ysize) * target_block_ysize
+        for row_offset in range(0, overview_band.YSize, rows_per_stripe):
+            overview_array = overview_band.ReadAsArray(
+                xoff=0, yoff=row_offset, win_xsize=overview_band.XSize,
+                win_ysize=min(
+                    rows_per_stripe, overview_band.YSize - row_offset))
+            for target_band in target_band_list:
+                target_band.WriteArray(overview_array, xoff=0, yoff=row_offset)
+        overview_band = None
+        target_band_list = None
+        target_raster_list = None
+        return
 
-    block = base_band.GetBlockSize()
-    cols_per_block = min(
-        n_cols, max(1, block[0] // integer_factor) * integer_factor * 10)
-    rows_per_block = min(
-        n_rows, max(1, block[1] // integer_factor) * integer_factor * 10)
-    n_col_blocks = int(numpy.ceil(n_cols / float(cols_per_block)))
-    n_row_blocks = int(numpy.ceil(n_rows / float(rows_per_block)))
-    for row_block_index in range(n_row_blocks):
-        row_offset = row_block_index * rows_per_block
-        row_block_width = n_rows - row_offset
-        LOGGER.info('step %d of %d', row_block_index+1, n_row_blocks)
-        if row_block_width > rows_per_block:
-            row_block_width = rows_per_block
-        for col_block_index in range(n_col_blocks):
-            col_offset = col_block_index * cols_per_block
-            col_block_width = n_cols - col_offset
-            if col_block_width > cols_per_block:
-                col_block_width = cols_per_block
-
-            offset_dict = {
-                'xoff': int(col_offset),
-                'yoff': int(row_offset),
-                'win_xsize': int(col_block_width),
-                'win_ysize': int(row_block_width),
-            }
-
-            target_offset_x = offset_dict['xoff'] // integer_factor
-            target_offset_y = offset_dict['yoff'] // integer_factor
-
-            block_data = base_band.ReadAsArray(**offset_dict)
-
-            rw = int(numpy.ceil(
-                col_block_width / integer_factor) * integer_factor)
-            rh = int(numpy.ceil(
-                row_block_width / integer_factor) * integer_factor)
-            w_pad = rw - col_block_width
-            h_pad = rh - row_block_width
-            j = rw // integer_factor
-            k = rh // integer_factor
-            if method == 'max':
-                block_data_pad = numpy.pad(
-                    block_data, ((0, h_pad), (0, w_pad)), mode='edge')
-                reduced_block_data = block_data_pad.reshape(
-                    k, integer_factor, j, integer_factor).max(axis=(-1, -3))
-            elif method == 'min':
-                block_data_pad = numpy.pad(
-                    block_data, ((0, h_pad), (0, w_pad)), mode='edge')
-                reduced_block_data = block_data_pad.reshape(
-                    k, integer_factor, j, integer_factor).min(axis=(-1, -3))
-            elif method == 'mode':
-                block_data_pad = numpy.pad(
-                    block_data, ((0, h_pad), (0, w_pad)), mode='edge')
-                reduced_block_data = scipy.stats.mode(
-                    block_data_pad.reshape(
-                        k, integer_factor, j, integer_factor).swapaxes(
-                            1, 2).reshape(k, j, integer_factor**2),
-                    axis=2).mode.reshape(k, j)
-            elif method == 'average':
-                block_data_pad = numpy.pad(
-                    block_data, ((0, h_pad), (0, w_pad)), mode='edge')
-                block_data_pad_copy = block_data_pad.copy()
-                # set any nodata to 0 so we don't average it strangely
-                block_data_pad[numpy.isclose(block_data_pad, nodata)] = 0.0
-                # straight average
-                reduced_block_data = block_data_pad.reshape(
-                    k, integer_factor, j, integer_factor).mean(
-                    axis=(-1, -3))
-                # this one is used to restore any nodata areas because they'll
-                # still be nodata when it's done
-                min_block_data = block_data_pad_copy.reshape(
-                    k, integer_factor, j, integer_factor).min(
-                    axis=(-1, -3))
-                reduced_block_data[
-                    numpy.isclose(min_block_data, nodata)] = nodata
-            elif method == 'sum':
-                block_data_pad = numpy.pad(
-                    block_data, ((0, h_pad), (0, w_pad)), mode='edge')
-                nodata_mask = numpy.isclose(block_data_pad, nodata)
-                block_data_pad_copy = block_data_pad.copy()
-                # set any nodata to 0 so we don't sum it strangely
-                block_data_pad[nodata_mask] = 0.0
-                # straight sum
-                reduced_block_data = block_data_pad.reshape(
-                    k, integer_factor, j, integer_factor).sum(
-                    axis=(-1, -3))
-                # this one is used to restore any nodata areas because they'll
-                # still be nodata when it's done
-                max_block_data = block_data_pad_copy.reshape(
-                    k, integer_factor, j, integer_factor).max(
-                    axis=(-1, -3))
-                reduced_block_data[
-                    numpy.isclose(max_block_data, nodata)] = nodata
-            else:
-                raise ValueError("unknown method: %s" % method)
+    offset_list = plan_blocks(
+        base_raster_path, max_block_bytes=max_block_bytes,
+        integer_factor=integer_factor,
+        target_block_size=target_band_list[0].GetBlockSize())
+    rows_per_block = offset_list[0]['win_ysize']
+    n_row_blocks = int(numpy.ceil(n_rows / rows_per_block))
+
+    thread_local = threading.local()
 
+    def _read_and_reduce(offset_dict):
+        if n_workers > 1:
+            # GDAL datasets can't be shared between threads
+            if not hasattr(thread_local, 'band'):
+                thread_local.raster = gdal.OpenEx(
+                    base_raster_path, gdal.OF_RASTER)
+                thread_local.band = thread_local.raster.GetRasterBand(1)
+            band = thread_local.band
+        else:
+            band = base_band
+        # each thread reuses its buffers from block to block
+        if not hasattr(thread_local, 'buffer_dict'):
+            thread_local.buffer_dict = {}
+        block_shape = (offset_dict['win_ysize'], offset_dict['win_xsize'])
+        block_data = band.ReadAsArray(
+            **offset_dict, buf_obj=_block_buffer(
+                thread_local.buffer_dict, 'block', block_shape,
+                base_raster_info['numpy_type']))
+        if _all_nodata(block_data, nodata, thread_local.buffer_dict):
+            # every method reduces this to nodata, which is what the
+            # unwritten blocks of the target already read as
+            return None
+        return _reduce_block(
+            block_data, integer_factor, method_list, nodata,
+            buffer_dict=thread_local.buffer_dict)
+
+    n_skipped_blocks = 0
+
+    def _write(offset_dict, reduced_block_list):
+        nonlocal n_skipped_blocks
+        if offset_dict['xoff'] == 0:
+            LOGGER.info(
+                'step %d of %d', offset_dict['yoff'] // rows_per_block + 1,
+                n_row_blocks)
+        if reduced_block_list is None:
+            n_skipped_blocks += 1
+            return
+        for target_band, reduced_block_data in zip(
+                target_band_list, reduced_block_list):
             target_band.WriteArray(
-                reduced_block_data, xoff=target_offset_x, yoff=target_offset_y)
+                reduced_block_data,
+                xoff=offset_dict['xoff'] // integer_factor,
+                yoff=offset_dict['yoff'] // integer_factor)
+
+    _process_blocks_in_order(
+        offset_list, _read_and_reduce, _write, n_workers)
+    LOGGER.info(
+        'skipped %d of %d blocks of %s that were entirely nodata (%.1f%%)',
+        n_skipped_blocks, len(offset_list), base_raster_path,
+        100 * n_skipped_blocks / len(offset_list))
+    target_band_list = None
+    target_raster_list = None
+
+
+def _matching_overview(base_raster, integer_factor, method):
+    """Return an overview of `base_raster` that `method` would reproduce.
+
+    Args:
+        base_raster (gdal.Dataset): raster to look for overviews in.
+        integer_factor (int): factor the overview must be reduced by.
+        method (str): `convolve_layer` method the overview's resampling must
+            match.
+
+    Returns:
+        the overview band of the first band of `base_raster` reduced by
+        `integer_factor` and resampled with `method`, or None if there is
+        none or GDAL's resampling might differ from `_reduce_block`. The
+        reason no overview is used is logged.
+
+    """
+    base_path = base_raster.GetDescription()
+    if method not in OVERVIEW_COMPATIBLE_METHODS:
+        LOGGER.info(
+            'not reducing %s from its overviews: GDAL resamples %s '
+            'differently, only %s are exact', base_path, method,
+            OVERVIEW_COMPATIBLE_METHODS)
+        return None
+    base_band = base_raster.GetRasterBand(1)
+    if base_band.GetNoDataValue() is not None:
+        LOGGER.info(
+            'not reducing %s from its overviews: it has nodata, which GDAL '
+            'skips differently', base_path)
+        return None
+    if (base_raster.RasterXSize % integer_factor or
+            base_raster.RasterYSize % integer_factor):
+        LOGGER.info(
+            'not reducing %s from its overviews: its size %dx%d is not a '
+            'multiple of %d', base_path, base_raster.RasterXSize,
+            base_raster.RasterYSize, integer_factor)
+        return None
+    overview_size = (
+        int(numpy.ceil(base_raster.RasterXSize / integer_factor)),
+        int(numpy.ceil(base_raster.RasterYSize / integer_factor)))
+    dataset_resampling = base_raster.GetMetadataItem(
+        OVERVIEW_RESAMPLING_METADATA_KEY)
+    for overview_index in range(base_band.GetOverviewCount()):
+        overview_band = base_band.GetOverview(overview_index)
+        if (overview_band.XSize, overview_band.YSize) != overview_size:
             continue
+        resampling = (
+            overview_band.GetMetadataItem('RESAMPLING') or
+            dataset_resampling)
+        if resampling and resampling.lower() == method:
+            return overview_band
+    LOGGER.info(
+        'not reducing %s from its overviews: none is reduced by %d with %s '
+        'resampling', base_path, integer_factor, method)
+    return None
+
+
+def make_kernel(kernel_type, radius, scale=None):
+    """Make a normalized, circular kernel for `convolve_kernel`.
+
+    Args:
+        kernel_type (str): 'gaussian' for exp(-d^2 / (2 * scale^2)) or
+            'exponential' for the decay exp(-d / scale) with distance d in
+            pixels.
+        radius (int): the kernel is zero beyond this many pixels from its
+            center and is 2 * radius + 1 pixels on a side.
+        scale (float): the gaussian's standard deviation or the
+            exponential's decay distance in pixels, defaults to a third of
+            `radius`.
+
+    Returns:
+        2D float64 array that sums to 1.
+
+    """
+    if kernel_type not in KERNEL_TYPES:
+        raise ValueError(
+            'unknown kernel type %s, expected one of %s' % (
+                kernel_type, KERNEL_TYPES))
+    if radius < 0:
+        raise ValueError('radius must not be negative, got %s' % radius)
+    if scale is None:
+        scale = max(radius / 3, 1e-3)
+    offset_array = numpy.arange(-radius, radius+1)
+    distance_array = numpy.hypot(
+        offset_array[:, numpy.newaxis], offset_array[numpy.newaxis, :])
+    if kernel_type == 'gaussian':
+        kernel_array = numpy.exp(-distance_array**2 / (2 * scale**2))
+    else:
+        kernel_array = numpy.exp(-distance_array / scale)
+    kernel_array[distance_array > radius] = 0
+    return kernel_array / kernel_array.sum()
+
+
+def convolve_kernel(
+        base_raster_path, kernel_array, target_raster_path, n_workers=1,
+        max_block_bytes=DEFAULT_MAX_BLOCK_BYTES, mask_nodata=True,
+        raster_driver_creation_tuple=DEFAULT_GTIFF_CREATION_TUPLE_OPTIONS):
+    """Convolve a raster with a kernel in bounded memory.
+
+    The raster is convolved a window at a time, each read with a halo of
+    the kernel's radius around it, so rasters much larger than memory can
+    be convolved. Nodata pixels and pixels beyond the raster's edge are
+    left out and the result is renormalized by the kernel weight of the
+    valid pixels, so a smoothed value near nodata is a weighted mean of
+    its valid neighbors rather than pulled toward 0. Kernels larger than
+    `DIRECT_CONVOLUTION_MAX_KERNEL_SIZE` on a side are convolved with FFTs.
+
+    Args:
+        base_raster_path (str): raster to convolve, its first band is used.
+        kernel_array (numpy.ndarray): 2D kernel with an odd number of rows
+            and columns, ex: from `make_kernel`.
+        target_raster_path (str): path to the float32 convolved raster
+            created with the size and projection of `base_raster_path`. Its
+            nodata is the smallest float32, which marks pixels with no valid
+            pixels under the kernel.
+        n_workers (int): number of threads that read and convolve windows
+            in parallel, results are written in order by a single thread.
+        max_block_bytes (int): about how many bytes of `base_raster_path`
+            to convolve at a time, not counting the halo. Each window takes
+            working memory of several times its size with its halo.
+        mask_nodata (bool): if True, pixels that are nodata in
+            `base_raster_path` are nodata in the result, otherwise they are
+            filled with the weighted mean of their valid neighbors.
+        raster_driver_creation_tuple (tuple): GDAL driver name and creation
+            options for the target raster, see `convolve_layer`.
+
+    Return:
+        None.
+
+    """
+    kernel_array = numpy.asarray(kernel_array, dtype=numpy.float64)
+    if kernel_array.ndim != 2 or not all(
+            size % 2 == 1 for size in kernel_array.shape):
+        raise ValueError(
+            'kernel must be 2D with an odd number of rows and columns, got '
+            'a shape of %s' % (kernel_array.shape,))
+    kernel_sum = kernel_array.sum()
+    if kernel_sum <= 0:
+        raise ValueError('kernel must have a positive sum')
+    kernel_array = kernel_array / kernel_sum
+    row_radius, col_radius = (size // 2 for size in kernel_array.shape)
+    use_fft = max(kernel_array.shape) > DIRECT_CONVOLUTION_MAX_KERNEL_SIZE
+
+    base_raster_info = pygeoprocessing.get_raster_info(base_raster_path)
+    n_cols, n_rows = base_raster_info['raster_size']
+    nodata = base_raster_info['nodata'][0]
+    target_nodata = float(numpy.finfo(numpy.float32).min)
+    pygeoprocessing.new_raster_from_base(
+        base_raster_path, target_raster_path, gdal.GDT_Float32,
+        [target_nodata],
+        raster_driver_creation_tuple=raster_driver_creation_tuple)
+    target_raster = gdal.OpenEx(
+        target_raster_path, gdal.OF_RASTER | gdal.GA_Update)
+    target_band = target_raster.GetRasterBand(1)
+    offset_list = plan_blocks(
+        base_raster_path, max_block_bytes=max_block_bytes,
+        target_block_size=target_band.GetBlockSize())
+    LOGGER.info(
+        'convolving %s with a %dx%d kernel %s in %d windows',
+        base_raster_path, kernel_array.shape[1], kernel_array.shape[0],
+        'with FFTs' if use_fft else 'directly', len(offset_list))
+
+    thread_local = threading.local()
+
+    def _convolve_window(offset_dict):
+        if not hasattr(thread_local, 'band'):
+            # GDAL datasets can't be shared between threads
+            thread_local.raster = gdal.OpenEx(
+                base_raster_path, gdal.OF_RASTER)
+            thread_local.band = thread_local.raster.GetRasterBand(1)
+        # read the window with its halo, clipped to the raster
+        xmin = max(0, offset_dict['xoff'] - col_radius)
+        ymin = max(0, offset_dict['yoff'] - row_radius)
+        xmax = min(
+            n_cols,
+            offset_dict['xoff'] + offset_dict['win_xsize'] + col_radius)
+        ymax = min(
+            n_rows,
+            offset_dict['yoff'] + offset_dict['win_ysize'] + row_radius)
+        halo_array = thread_local.band.ReadAsArray(
+            xoff=xmin, yoff=ymin, win_xsize=xmax-xmin, win_ysize=ymax-ymin)
+        # pixels beyond the raster's edge are zero valued and invalid
+        halo_shape = (
+            offset_dict['win_ysize'] + 2 * row_radius,
+            offset_dict['win_xsize'] + 2 * col_radius)
+        halo_slice = (
+            slice(ymin - offset_dict['yoff'] + row_radius,
+                  ymax - offset_dict['yoff'] + row_radius),
+            slice(xmin - offset_dict['xoff'] + col_radius,
+                  xmax - offset_dict['xoff'] + col_radius))
+        valid_array = numpy.zeros(halo_shape, dtype=numpy.float64)
+        valid_array[halo_slice] = _valid_mask(halo_array, nodata)
+        if not valid_array.any():
+            # the result is entirely nodata, leave the target block empty
+            return None
+        value_array = numpy.zeros(halo_shape, dtype=numpy.float64)
+        numpy.copyto(
+            value_array[halo_slice], halo_array, casting='unsafe',
+            where=valid_array[halo_slice].astype(bool))
+        halo_array = None
+
+        if use_fft:
+            value_sum = scipy.signal.fftconvolve(
+                value_array, kernel_array, mode='valid')
+            weight_sum = scipy.signal.fftconvolve(
+                valid_array, kernel_array, mode='valid')
+        else:
+            core_slice = (
+                slice(row_radius, halo_shape[0] - row_radius),
+                slice(col_radius, halo_shape[1] - col_radius))
+            value_sum = scipy.ndimage.convolve(
+                value_array, kernel_array, mode='constant')[core_slice]
+            weight_sum = scipy.ndimage.convolve(
+                valid_array, kernel_array, mode='constant')[core_slice]
+        # FFT round off leaves tiny weights where there are no valid pixels
+        no_weight_mask = weight_sum <= CONVOLUTION_MIN_WEIGHT
+        result = value_sum / numpy.where(no_weight_mask, 1, weight_sum)
+        result[no_weight_mask] = target_nodata
+        if mask_nodata:
+            result[valid_array[
+                row_radius:halo_shape[0]-row_radius,
+                col_radius:halo_shape[1]-col_radius] == 0] = target_nodata
+        return result.astype(numpy.float32)
+
+    n_skipped_blocks = 0
+
+    def _write(offset_dict, result):
+        nonlocal n_skipped_blocks
+        if result is None:
+            n_skipped_blocks += 1
+            return
+        target_band.WriteArray(
+            result, xoff=offset_dict['xoff'], yoff=offset_dict['yoff'])
+
+    _process_blocks_in_order(
+        offset_list, _convolve_window, _write, n_workers)
+    LOGGER.info(
+        'skipped %d of %d windows of %s with no valid pixels (%.1f%%)',
+        n_skipped_blocks, len(offset_list), base_raster_path,
+        100 * n_skipped_blocks / len(offset_list))
+    target_band = None
+    target_raster = None
+
+
+def convolve_layer_pyramid(
+        base_raster_path, integer_factor_list, method,
+        target_raster_path_list, max_block_bytes=DEFAULT_MAX_BLOCK_BYTES,
+        raster_driver_creation_tuple=DEFAULT_GTIFF_CREATION_TUPLE_OPTIONS):
+    """Reduce a raster to several lower sizes in one read.
+
+    The base raster is streamed once in full width stripes. The first level
+    is reduced from the stripes and each coarser level from the reduced
+    rows of the level before it, buffered until there are enough rows to
+    reduce. Averages carry their sum and count of valid pixels between
+    levels so they match reducing the base raster directly. 'mode' is the
+    mode of the previous level's modes, an approximation of the mode of the
+    base pixels.
+
+    Args:
+        base_raster_path (str): base raster.
+        integer_factor_list (list): increasing integer factors to reduce
+            by, each a multiple of the one before it, ex: [2, 4, 8, 16].
+        method (str): one of 'max', 'min', 'sum', 'average', 'mode'.
+        target_raster_path_list (list): path to the reduced raster for each
+            factor in `integer_factor_list`.
+        max_block_bytes (int): about how many bytes of `base_raster_path`
+            to read at a time, see `plan_blocks`.
+        raster_driver_creation_tuple (tuple): GDAL driver name and creation
+            options for the target rasters, see `convolve_layer`.
+
+    Return:
+        None.
+
+    """
+    if method not in REDUCE_METHODS:
+        raise ValueError("unknown method: %s" % method)
+    if len(integer_factor_list) != len(target_raster_path_list):
+        raise ValueError(
+            'expected one target raster per factor, got %d paths for %s' % (
+                len(target_raster_path_list), integer_factor_list))
+    ratio_list = []
+    previous_factor = 1
+    for integer_factor in integer_factor_list:
+        if (integer_factor <= previous_factor or
+                integer_factor % previous_factor != 0):
+            raise ValueError(
+                'integer factors must increase and each be a multiple of the '
+                'one before it, got %s' % (integer_factor_list,))
+        ratio_list.append(integer_factor // previous_factor)
+        previous_factor = integer_factor
+
+    base_raster_info = pygeoprocessing.get_raster_info(base_raster_path)
+    n_cols, n_rows = base_raster_info['raster_size']
+    nodata = base_raster_info['nodata'][0]
+    base_geotransform = base_raster_info['geotransform']
+    target_band_list = []
+    target_raster_list = []
+    for integer_factor, target_raster_path in zip(
+            integer_factor_list, target_raster_path_list):
+        pygeoprocessing.new_raster_from_base(
+            base_raster_path, target_raster_path,
+            base_raster_info['datatype'], [nodata],
+            n_rows=int(numpy.ceil(n_rows / integer_factor)),
+            n_cols=int(numpy.ceil(n_cols / integer_factor)),
+            raster_driver_creation_tuple=raster_driver_creation_tuple)
+        target_raster = gdal.OpenEx(
+            target_raster_path, gdal.OF_RASTER | gdal.GA_Update)
+        target_raster.SetGeoTransform([
+            base_geotransform[0],
+            base_geotransform[1]*integer_factor,
+            base_geotransform[2]*integer_factor,
+            base_geotransform[3],
+            base_geotransform[4]*integer_factor,
+            base_geotransform[5]*integer_factor])
+        target_raster_list.append(target_raster)
+        target_band_list.append(target_raster.GetRasterBand(1))
+
+    n_levels = len(integer_factor_list)
+    # rows of each level's input that are waiting for enough rows to reduce
+    pending_list = [None] * n_levels
+    # reduced rows of each level waiting to fill a row of target tiles
+    unwritten_list = [[] for _ in range(n_levels)]
+    target_row_list = [0] * n_levels
+
+    def _write(level, reduced_array, final):
+        unwritten_list[level].append(reduced_array)
+        block_ysize = target_band_list[level].GetBlockSize()[1]
+        n_unwritten = sum(array.shape[0] for array in unwritten_list[level])
+        n_write = n_unwritten if final else (
+            n_unwritten // block_ysize * block_ysize)
+        if not n_write:
+            return
+        unwritten_array = numpy.concatenate(unwritten_list[level])
+        target_band_list[level].WriteArray(
+            unwritten_array[:n_write], xoff=0, yoff=target_row_list[level])
+        target_row_list[level] += n_write
+        unwritten_list[level] = [unwritten_array[n_write:]]
+
+    def _push(level, carry, final):
+        if pending_list[level] is not None:
+            carry = tuple(
+                numpy.concatenate([pending_array, carry_array])
+                for pending_array, carry_array in zip(
+                    pending_list[level], carry))
+        ratio = ratio_list[level]
+        n_carry_rows = carry[0].shape[0]
+        n_ready = n_carry_rows if final else n_carry_rows // ratio * ratio
+        pending_list[level] = tuple(
+            carry_array[n_ready:] for carry_array in carry)
+        reduced_carry = _pyramid_reduce(
+            tuple(carry_array[:n_ready] for carry_array in carry), ratio,
+            method, nodata)
+        if n_ready or final:
+            _write(
+                level, _pyramid_result(reduced_carry, method, nodata), final)
+        if level + 1 < n_levels and (n_ready or final):
+            _push(level + 1, reduced_carry, final)
+
+    # read stripes whose height is a multiple of the first factor
+    base_raster = gdal.OpenEx(base_raster_path, gdal.OF_RASTER)
+    base_band = base_raster.GetRasterBand(1)
+    stripe_list = plan_blocks(
+        base_raster_path, max_block_bytes=max_block_bytes,
+        integer_factor=integer_factor_list[0], full_width=True)
+    for stripe_index, offset_dict in enumerate(stripe_list):
+        LOGGER.info('step %d of %d', stripe_index+1, len(stripe_list))
+        _push(
+            0, _pyramid_carry(
+                base_band.ReadAsArray(**offset_dict), method, nodata),
+            stripe_index == len(stripe_list) - 1)
+    base_band = None
+    base_raster = None
+    target_band_list = None
+    target_raster_list = None
+
+
+def _pyramid_carry(block_data, method, nodata):
+    """Return the values `_pyramid_reduce` carries for a block of pixels.
+
+    Args:
+        block_data (numpy.ndarray): 2D block of the base raster.
+        method (str): one of `REDUCE_METHODS`.
+        nodata (numeric): nodata value of the block or None.
+
+    Returns:
+        tuple of the block for 'max', 'min' and 'mode', otherwise a tuple
+        of the valid pixels, 0 elsewhere, in the block's type and the bool
+        mask of valid pixels. `_pyramid_reduce` widens them as it sums.
+
+    """
+    if method not in ('sum', 'average'):
+        return (block_data,)
+    valid_mask = _valid_mask(block_data, nodata)
+    return (numpy.where(valid_mask, block_data, 0), valid_mask)
+
+
+def _pyramid_reduce(carry, ratio, method, nodata):
+    """Reduce `ratio` square windows of carried pyramid values.
+
+    Rows and columns are padded up to a multiple of `ratio` in a way that
+    doesn't change the result.
+
+    Args:
+        carry (tuple): values from `_pyramid_carry` or a previous call.
+        ratio (int): width and height of the windows to reduce.
+        method (str): one of `REDUCE_METHODS`.
+        nodata (numeric): nodata value of the base raster or None.
+
+    Returns:
+        tuple of the reduced values in the same form as `carry`.
+
+    """
+    n_rows, n_cols = carry[0].shape
+    k = int(numpy.ceil(n_rows / ratio))
+    j = int(numpy.ceil(n_cols / ratio))
+    pad_width = ((0, k * ratio - n_rows), (0, j * ratio - n_cols))
+    if method in ('sum', 'average'):
+        # sums of integers and counts are int64, others float64
+        return tuple(
+            numpy.pad(carry_array, pad_width, mode='constant').reshape(
+                k, ratio, j, ratio).sum(axis=(-1, -3), dtype=(
+                    numpy.float64 if numpy.issubdtype(
+                        carry_array.dtype, numpy.floating)
+                    else numpy.int64))
+            for carry_array in carry)
+    if method == 'mode':
+        return (_mode_reduce(carry[0], ratio, nodata),)
+    if not carry[0].size:
+        return (carry[0][:k, :j],)
+    # repeating edge pixels doesn't change a max or min
+    carry_pad = numpy.pad(carry[0], pad_width, mode='edge').reshape(
+        k, ratio, j, ratio)
+    if method == 'max':
+        return (carry_pad.max(axis=(-1, -3)),)
+    return (carry_pad.min(axis=(-1, -3)),)
+
+
+def _pyramid_result(carry, method, nodata):
+    """Return the reduced raster values from carried pyramid values."""
+    if method not in ('sum', 'average'):
+        return carry[0]
+    value_sum, valid_count = carry
+    if method == 'sum':
+        result = value_sum.copy()
+    else:
+        result = value_sum / numpy.maximum(valid_count, 1)
+    if nodata is not None:
+        result[valid_count == 0] = nodata
+    return result
+
+
+def plan_blocks(
+        raster_path, max_block_bytes=DEFAULT_MAX_BLOCK_BYTES,
+        integer_factor=1, full_width=False, band_index=1,
+        target_block_size=None):
+    """Plan the windows to stream a raster band in.
+
+    Windows are aligned to the band's native blocks and to
+    `integer_factor` so reads cover whole tiles or strips and reductions by
+    `integer_factor` never straddle two windows. Full width windows are
+    preferred when a row of blocks fits in `max_block_bytes`, otherwise
+    windows are one row of blocks tall and as wide as fits. If a single
+    aligned block doesn't fit, as when large blocks and factors share no
+    divisors, windows are aligned to `integer_factor` alone and may read
+    partial blocks.
+
+    Args:
+        raster_path (str): path to the raster to plan windows over.
+        max_block_bytes (int): windows are at most about this many bytes of
+            raster data.
+        integer_factor (int): window offsets are multiples of this in both
+            dimensions.
+        full_width (bool): if True windows span the full width of the
+            raster however tall `max_block_bytes` allows, at least one row
+            of blocks.
+        band_index (int): band whose block size and type to plan with.
+        target_block_size (tuple): if not None, the (x, y) block size of a
+            raster reduced by `integer_factor` that windows are written to.
+            Windows are also aligned so their reduction fills whole target
+            blocks, unless that is over `max_block_bytes` in which case
+            target blocks may be written in parts.
+
+    Returns:
+        list of dicts with 'xoff', 'yoff', 'win_xsize' and 'win_ysize' keys
+        in row major order, these can be passed to ``ReadAsArray``.
+
+    """
+    raster = gdal.OpenEx(raster_path, gdal.OF_RASTER)
+    band = raster.GetRasterBand(band_index)
+    n_cols, n_rows = raster.RasterXSize, raster.RasterYSize
+    block_xsize, block_ysize = band.GetBlockSize()
+    pixel_bytes = gdal.GetDataTypeSize(band.DataType) // 8
+    band = None
+    raster = None
+
+    # smallest window dimensions aligned to both the blocks and the factor,
+    # or to the factor alone if that's over budget since reductions must
+    # never straddle two windows
+    col_alignment, row_alignment = integer_factor, integer_factor
+    if target_block_size is not None:
+        col_alignment *= target_block_size[0]
+        row_alignment *= target_block_size[1]
+    max_pixels = max(1, max_block_bytes // pixel_bytes)
+    unit_list = [
+        (int(numpy.lcm(block_xsize, col_alignment)),
+         int(numpy.lcm(block_ysize, row_alignment))),
+        (int(numpy.lcm(block_xsize, integer_factor)),
+         int(numpy.lcm(block_ysize, integer_factor))),
+        (integer_factor, integer_factor)]
+    for col_unit, row_unit in unit_list:
+        col_unit = min(col_unit, n_cols)
+        row_unit = min(row_unit, n_rows)
+        if (n_cols if full_width else col_unit) * row_unit <= max_pixels:
+            break
+    else:
+        LOGGER.warning(
+            'windows of %s aligned to a factor of %d are over the %d byte '
+            'budget', raster_path, integer_factor, max_block_bytes)
+    if full_width or n_cols * row_unit <= max_pixels:
+        win_xsize = n_cols
+        win_ysize = max(1, max_pixels // n_cols // row_unit) * row_unit
+    else:
+        win_ysize = row_unit
+        win_xsize = max(1, max_pixels // row_unit // col_unit) * col_unit
+    win_xsize = min(win_xsize, n_cols)
+    win_ysize = min(win_ysize, n_rows)
+
+    offset_list = []
+    for yoff in range(0, n_rows, win_ysize):
+        for xoff in range(0, n_cols, win_xsize):
+            offset_list.append({
+                'xoff': xoff,
+                'yoff': yoff,
+                'win_xsize': min(win_xsize, n_cols - xoff),
+                'win_ysize': min(win_ysize, n_rows - yoff),
+            })
+    return offset_list
+
+
+def _process_blocks_in_order(block_list, process_func, write_func, n_workers):
+    """Process blocks in a thread pool and write the results in order.
+
+    Args:
+        block_list (list): blocks to process, in the order to write them.
+        process_func (callable): called with a block from `block_list` in a
+            worker thread, returns the result to write.
+        write_func (callable): called with a block and its result from a
+            single writer thread in the order of `block_list`.
+        n_workers (int): number of worker threads, if 1 or less blocks are
+            processed and written in the calling thread.
+
+    Returns:
+        None.
+
+    """
+    if n_workers <= 1:
+        for block in block_list:
+            write_func(block, process_func(block))
+        return
+
+    # bounds the number of blocks processed but not yet written
+    write_queue = queue.Queue(maxsize=2 * n_workers)
+    writer_error_list = []
+
+    def _writer():
+        while True:
+            payload = write_queue.get()
+            if payload is None:
+                return
+            block, future = payload
+            try:
+                result = future.result()
+                if not writer_error_list:
+                    write_func(block, result)
+            except Exception as error:
+                # keep draining the queue so the submitting thread can't
+                # block on a full queue
+                writer_error_list.append(error)
+
+    writer_thread = threading.Thread(target=_writer, daemon=True)
+    writer_thread.start()
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=n_workers) as executor:
+        try:
+            for block in block_list:
+                if writer_error_list:
+                    break
+                write_queue.put((block, executor.submit(process_func, block)))
+        finally:
+            write_queue.put(None)
+            writer_thread.join()
+    if writer_error_list:
+        raise writer_error_list[0]
+
+
+def _reduce_block(
+        block_data, integer_factor, method_list, nodata, buffer_dict=None):
+    """Reduce `integer_factor` square windows of a block with each method.
+
+    The padded block and its valid pixel mask are calculated once and
+    shared by all the methods in `method_list`. 'sum' and 'average' only
+    include valid pixels, the average is over the valid pixels in each
+    window and windows without any are nodata.
+
+    Args:
+        block_data (numpy.ndarray): 2D block of the base raster, it is
+            padded up to a multiple of `integer_factor` in each dimension.
+        integer_factor (int): width and height of the windows to reduce.
+        method_list (list): methods in `REDUCE_METHODS` to reduce with.
+        nodata (numeric): nodata value of the block or None.
+        buffer_dict (dict): if not None, working arrays are kept here and
+            reused by later calls with the same `buffer_dict`. Only use it
+            from one thread at a time.
+
+    Returns:
+        list of the reduced block for each method in `method_list`.
+
+    """
+    row_block_width, col_block_width = block_data.shape
+    rw = int(numpy.ceil(col_block_width / integer_factor) * integer_factor)
+    rh = int(numpy.ceil(row_block_width / integer_factor) * integer_factor)
+    w_pad = rw - col_block_width
+    h_pad = rh - row_block_width
+    j = rw // integer_factor
+    k = rh // integer_factor
+    reduced_dict = {}
+    block_data_pad = None
+    value_sum = None
+
+    def _windows(array):
+        return array.reshape(k, integer_factor, j, integer_factor)
+
+    for method in method_list:
+        if method in reduced_dict:
+            continue
+        if method in ('max', 'min') and block_data_pad is None:
+            block_data_pad = numpy.pad(
+                block_data, ((0, h_pad), (0, w_pad)), mode='edge')
+        if method == 'max':
+            reduced_dict[method] = _windows(block_data_pad).max(
+                axis=(-1, -3))
+        elif method == 'min':
+            reduced_dict[method] = _windows(block_data_pad).min(
+                axis=(-1, -3))
+        elif method == 'mode':
+            reduced_dict[method] = _mode_reduce(
+                block_data, integer_factor, nodata)
+        elif method in ('average', 'sum'):
+            if value_sum is None:
+                value_sum, valid_count = _valid_sum_and_count(
+                    block_data, integer_factor, nodata, buffer_dict)
+            if method == 'sum':
+                reduced_block_data = value_sum.copy()
+            else:
+                reduced_block_data = value_sum / numpy.maximum(
+                    valid_count, 1)
+            if nodata is not None:
+                reduced_block_data[valid_count == 0] = nodata
+            reduced_dict[method] = reduced_block_data
+    return [reduced_dict[method] for method in method_list]
+
+
+def _valid_sum_and_count(block_data, integer_factor, nodata, buffer_dict):
+    """Sum and count the valid pixels in square windows of a block.
+
+    The block is copied into a zeroed working array padded up to a multiple
+    of `integer_factor`, only where its pixels are valid, so the padding
+    and nodata add nothing to the sums or counts. Integer blocks are copied
+    in their own type and only widened to int64 as each window is summed,
+    so the working array is no larger than the block.
+
+    Args:
+        block_data (numpy.ndarray): 2D block of the base raster.
+        integer_factor (int): width and height of the windows to reduce.
+        nodata (numeric): nodata value of the block or None.
+        buffer_dict (dict): working arrays to reuse or None, see
+            `_block_buffer`.
+
+    Returns:
+        (sum, count) tuple of arrays of each window's valid pixels. Sums of
+        integer blocks are int64, others float64.
+
+    """
+    n_rows, n_cols = block_data.shape
+    k = int(numpy.ceil(n_rows / integer_factor))
+    j = int(numpy.ceil(n_cols / integer_factor))
+    if numpy.issubdtype(block_data.dtype, numpy.integer):
+        value_type = block_data.dtype
+        sum_type = numpy.int64
+    else:
+        value_type = numpy.float64
+        sum_type = numpy.float64
+    padded_shape = (k * integer_factor, j * integer_factor)
+    value_array = _block_buffer(
+        buffer_dict, 'value', padded_shape, value_type)
+    valid_array = _block_buffer(buffer_dict, 'valid', padded_shape, bool)
+    valid_array[n_rows:, :] = False
+    valid_array[:n_rows, n_cols:] = False
+    _valid_mask(
+        block_data, nodata, out=valid_array[:n_rows, :n_cols],
+        work_array=value_array[:n_rows, :n_cols])
+    value_array.fill(0)
+    numpy.copyto(
+        value_array[:n_rows, :n_cols], block_data, casting='unsafe',
+        where=valid_array[:n_rows, :n_cols])
+    return (
+        value_array.reshape(
+            k, integer_factor, j, integer_factor).sum(
+                axis=(-1, -3), dtype=sum_type),
+        valid_array.reshape(
+            k, integer_factor, j, integer_factor).sum(axis=(-1, -3)))
+
+
+def _all_nodata(block_data, nodata, buffer_dict=None):
+    """Return True if every pixel in `block_data` is nodata.
+
+    Args:
+        block_data (numpy.ndarray): block of raster values.
+        nodata (numeric): nodata value or None, in which case no block is
+            nodata since unwritten blocks would read back as 0.
+        buffer_dict (dict): working arrays to reuse or None, see
+            `_block_buffer`.
+
+    Returns:
+        True if no pixel of `block_data` is valid.
+
+    """
+    if nodata is None:
+        return False
+    work_array = None
+    if numpy.issubdtype(block_data.dtype, numpy.floating):
+        # only floating point blocks are compared with a tolerance
+        work_array = _block_buffer(
+            buffer_dict, 'sparse_work', block_data.shape, numpy.float64)
+    return not _valid_mask(
+        block_data, nodata,
+        out=_block_buffer(buffer_dict, 'sparse', block_data.shape, bool),
+        work_array=work_array).any()
+
+
+def _valid_mask(block_data, nodata, out=None, work_array=None):
+    """Return a mask of the pixels in `block_data` that are not nodata.
+
+    Integer nodata is compared exactly. Floating point nodata is matched
+    with the tolerance of ``numpy.isclose`` and NaN pixels are never valid,
+    so a NaN nodata needs no special handling.
+
+    Args:
+        block_data (numpy.ndarray): block of raster values.
+        nodata (numeric): nodata value or None.
+        out (numpy.ndarray): if not None, a bool array of the same shape as
+            `block_data` to write the mask to.
+        work_array (numpy.ndarray): if not None, a float array of the same
+            shape as `block_data` used to compare floating point blocks
+            without allocating.
+
+    Returns:
+        bool array that is True where `block_data` is valid.
+
+    """
+    if out is None:
+        out = numpy.empty(block_data.shape, dtype=bool)
+    if numpy.issubdtype(block_data.dtype, numpy.integer):
+        if nodata is None or not float(nodata).is_integer():
+            out.fill(True)
+        else:
+            numpy.not_equal(block_data, nodata, out=out)
+        return out
+    if nodata is None or numpy.isnan(nodata):
+        numpy.isnan(block_data, out=out)
+        numpy.logical_not(out, out=out)
+        return out
+    if work_array is None or not numpy.issubdtype(
+            work_array.dtype, numpy.floating):
+        work_array = numpy.empty(block_data.shape, dtype=numpy.float64)
+    # same as ~numpy.isclose(block_data, nodata) and False for NaN
+    numpy.subtract(block_data, nodata, out=work_array)
+    numpy.abs(work_array, out=work_array)
+    numpy.greater(work_array, 1e-8 + 1e-5 * abs(nodata), out=out)
+    return out
+
+
+def _block_buffer(buffer_dict, key, shape, dtype):
+    """Return a working array of `shape` that is reused between blocks.
+
+    Args:
+        buffer_dict (dict): holds the buffers by `key`, if None a new array
+            is returned.
+        key (str): name of the buffer in `buffer_dict`.
+        shape (tuple): shape of the array to return.
+        dtype (numpy.dtype): type of the array to return.
+
+    Returns:
+        contiguous array of `shape` and `dtype` with undefined contents.
+
+    """
+    size = int(numpy.prod(shape))
+    buffer_array = None if buffer_dict is None else buffer_dict.get(key)
+    if (buffer_array is None or buffer_array.size < size or
+            buffer_array.dtype != numpy.dtype(dtype)):
+        buffer_array = numpy.empty(size, dtype=dtype)
+        if buffer_dict is not None:
+            buffer_dict[key] = buffer_array
+    return buffer_array[:size].reshape(shape)
+
+
+def _mode_uses_bincount(n_classes, integer_factor):
+    """Return True if `_mode_reduce` should count windows with bincount.
+
+    Counting costs about `n_classes` bins per window where sorting costs
+    about `integer_factor`**2 log `integer_factor`**2 comparisons, so
+    counting is only used when the value range is a small multiple of the
+    window size.
+
+    Args:
+        n_classes (int): span of the integer values, max - min + 1.
+        integer_factor (int): width and height of the windows to reduce.
+
+    Returns:
+        True to count with ``numpy.bincount``, False to sort.
+
+    """
+    return n_classes <= MODE_BINCOUNT_CLASS_RATIO * integer_factor**2
+
+
+def _mode_reduce(block_array, integer_factor, nodata):
+    """Reduce `integer_factor` square windows of an array to their mode.
+
+    Integer arrays whose value range is small next to the window size, see
+    `_mode_uses_bincount`, are counted with ``numpy.bincount``, anything
+    else is sorted per window and its runs counted. Ties go to the smallest
+    value and nodata only wins a window that is entirely nodata.
+
+    Args:
+        block_array (numpy.ndarray): 2D array to reduce. It is padded up to
+            a multiple of `integer_factor` with its edge values, which
+            always fit its type, and the padding is left out of the counts.
+        integer_factor (int): width and height of the windows to reduce.
+        nodata (numeric): value to exclude from the count, or None.
+
+    Returns:
+        array of the mode of each window, reduced by `integer_factor` in
+        each dimension.
+
+    """
+    n_rows, n_cols = block_array.shape
+    k = int(numpy.ceil(n_rows / integer_factor))
+    j = int(numpy.ceil(n_cols / integer_factor))
+    if block_array.size == 0:
+        return numpy.empty((k, j), dtype=block_array.dtype)
+    pad_width = (
+        (0, k * integer_factor - n_rows), (0, j * integer_factor - n_cols))
+
+    def _windows(array):
+        return array.reshape(
+            k, integer_factor, j, integer_factor).swapaxes(1, 2).reshape(
+                k * j, integer_factor**2)
+
+    window_array = _windows(numpy.pad(block_array, pad_width, mode='edge'))
+    real_array = None
+    n_real = numpy.full(k * j, integer_factor**2)
+    if pad_width != ((0, 0), (0, 0)):
+        real_array = _windows(numpy.pad(
+            numpy.ones(block_array.shape, dtype=bool), pad_width))
+        n_real = real_array.sum(axis=1)
+    is_integer = numpy.issubdtype(window_array.dtype, numpy.integer)
+    if is_integer:
+        min_value = int(window_array.min())
+        n_classes = int(window_array.max()) - min_value + 1
+        if _mode_uses_bincount(n_classes, integer_factor):
+            nodata_index = None
+            if (nodata is not None and float(nodata).is_integer() and
+                    0 <= nodata - min_value < n_classes):
+                nodata_index = int(nodata - min_value)
+            # the last bin of each window collects its padding
+            n_bins = n_classes + 1
+            mode_array = numpy.empty(k * j, dtype=block_array.dtype)
+            # count in chunks of windows to bound the count array's size
+            n_chunk = max(1, MODE_BINCOUNT_CHUNK_SIZE // n_bins)
+            for chunk_offset in range(0, k * j, n_chunk):
+                chunk_slice = slice(chunk_offset, chunk_offset+n_chunk)
+                chunk_array = window_array[chunk_slice]
+                n_windows = chunk_array.shape[0]
+                window_offset = numpy.arange(n_windows)[:, None] * n_bins
+                class_index = chunk_array.astype(numpy.intp)
+                class_index += window_offset - min_value
+                if real_array is not None:
+                    class_index = numpy.where(
+                        real_array[chunk_slice], class_index,
+                        window_offset + n_classes)
+                count_array = numpy.bincount(
+                    class_index.ravel(),
+                    minlength=n_windows * n_bins).reshape(
+                        n_windows, n_bins)[:, :n_classes]
+                if nodata_index is not None:
+                    # nodata only counts in windows that are all nodata
+                    count_array[:, nodata_index] = (
+                        count_array[:, nodata_index] == n_real[chunk_slice])
+                mode_array[chunk_slice] = (
+                    numpy.argmax(count_array, axis=1) + min_value)
+            return mode_array.reshape(k, j)
+
+    n_window = window_array.shape[1]
+    position_array = numpy.arange(n_window)
+    if real_array is None:
+        sorted_array = numpy.sort(window_array, axis=1)
+    else:
+        sort_index = numpy.argsort(window_array, axis=1)
+        sorted_array = numpy.take_along_axis(window_array, sort_index, 1)
+        real_array = numpy.take_along_axis(real_array, sort_index, 1)
+    run_start = numpy.empty(sorted_array.shape, dtype=numpy.intp)
+    run_start[:, 0] = 0
+    # each position records where its run started so its run length so far
+    # is its distance from there, the mode ends the longest run
+    run_start[:, 1:] = numpy.where(
+        sorted_array[:, 1:] != sorted_array[:, :-1], position_array[1:], 0)
+    numpy.maximum.accumulate(run_start, axis=1, out=run_start)
+    if real_array is None:
+        run_length = position_array - run_start + 1
+    else:
+        # only count the cells of each run that aren't padding
+        real_count = numpy.cumsum(real_array, axis=1)
+        run_length = (
+            real_count - numpy.take_along_axis(real_count, run_start, 1) +
+            numpy.take_along_axis(real_array, run_start, 1))
+    if nodata is not None:
+        if is_integer:
+            run_length[sorted_array == nodata] = 0
+        else:
+            run_length[numpy.isclose(sorted_array, nodata)] = 0
+    if not is_integer:
+        # NaN never equals itself, so don't let NaN runs of 1 win
+        run_length[numpy.isnan(sorted_array)] = 0
+    mode_index = numpy.argmax(run_length, axis=1)
+    return sorted_array[numpy.arange(k * j), mode_index].reshape(k, j)
 
 
 def search(
@@ -621,10 +4032,14 @@ def search(
             'salo,nasa,joe'
 
     Returns:
-        None
+        list of matching STAC features, each a dictionary with at least
+        'id', 'bbox', 'utc_datetime' and 'description'.
 
     """
-    post_url = f'http://{host_port}/api/v1/search'
+    if '://' in host_port:
+        post_url = f'{host_port}/api/v1/search'
+    else:
+        post_url = f'http://{host_port}/api/v1/search'
 
     if bounding_box:
         bounding_box_str = ','.join([str(val) for val in bounding_box])
@@ -654,6 +4069,7 @@ def search(
             f"bbox: {feature['bbox']}, "
             f"utc_datetime: {feature['utc_datetime']}, "
             f"description: {feature['description']}")
+    return response_dict['features']
 
 
 @retrying.retry(
@@ -1,8 +1,18 @@
 """Ecoshard test suite."""
+import errno
+import functools
+import gzip
+import hashlib
+import http.server
+import json
 import os
+import tarfile
 import tempfile
+import threading
 import shutil
 import unittest
+import unittest.mock
+import zipfile
 
 import ecoshard
 import numpy
@@ -31,15 +41,103 @@ def _build_test_raster(raster_path):
     new_raster = None
 
 
+class _QuietHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """Serve files without logging every request to stderr."""
+
+    def log_message(self, *args):
+        pass
+
+
+class _RangeHTTPRequestHandler(_QuietHTTPRequestHandler):
+    """Serve files with support for single `bytes=start-[end]` ranges."""
+
+    def do_GET(self):
+        """Answer a Range request with a 206 partial response."""
+        range_header = self.headers.get('Range')
+        if not range_header:
+            return super().do_GET()
+        with open(self.translate_path(self.path), 'rb') as served_file:
+            data = served_file.read()
+        start, end = range_header.split('=')[1].split('-')
+        start = int(start)
+        end = min(int(end) if end else len(data) - 1, len(data) - 1)
+        if start >= len(data):
+            self.send_response(416)
+            self.send_header('Content-Range', 'bytes */%d' % len(data))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(206)
+        self.send_header(
+            'Content-Range', 'bytes %d-%d/%d' % (start, end, len(data)))
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        self.wfile.write(data[start:end+1])
+
+
+class _GzipHTTPRequestHandler(_QuietHTTPRequestHandler):
+    """Serve files as a gzip `Content-Encoding` whatever the client asks."""
+
+    def do_GET(self):
+        """Answer with the gzip compressed file."""
+        with open(self.translate_path(self.path), 'rb') as served_file:
+            data = gzip.compress(served_file.read())
+        self.send_response(200)
+        self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class _FetchHTTPRequestHandler(_QuietHTTPRequestHandler):
+    """Answer ecoshard server fetch requests with links to served files."""
+
+    def do_POST(self):
+        """Link to the served file named by the requested asset id."""
+        body = json.loads(json.loads(self.rfile.read(
+            int(self.headers['Content-Length']))))
+        response = json.dumps({
+            'type': body['type'],
+            'link': 'http://%s:%d/%s' % (
+                *self.server.server_address, body['asset_id']),
+        }).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+
+def _start_http_server(directory, handler=_QuietHTTPRequestHandler):
+    """Serve `directory` over http in a background thread.
+
+    Returns:
+        (server, base url) tuple, call server.shutdown() when done.
+
+    """
+    server = http.server.ThreadingHTTPServer(
+        ('127.0.0.1', 0), functools.partial(handler, directory=directory))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:%d' % server.server_address[1]
+
+
 class EcoShardTests(unittest.TestCase):
     """Tests for the PyGeoprocesing 1.0 refactor."""
 
     def setUp(self):
         """Create a temporary workspace that's deleted later."""
         self.workspace_dir = tempfile.mkdtemp()
+        # keep the hash cache out of the user's cache directory
+        self.original_cache_dir = os.environ.get('ECOSHARD_CACHE_DIR')
+        os.environ['ECOSHARD_CACHE_DIR'] = os.path.join(
+            self.workspace_dir, 'ecoshard_cache')
 
     def tearDown(self):
         """Clean up remaining files."""
+        if self.original_cache_dir is None:
+            del os.environ['ECOSHARD_CACHE_DIR']
+        else:
+            os.environ['ECOSHARD_CACHE_DIR'] = self.original_cache_dir
         shutil.rmtree(self.workspace_dir)
 
     def test_hash_file(self):
@@ -62,6 +160,60 @@ class EcoShardTests(unittest.TestCase):
             target_dir, 'test_file_md5_098f6bcd4621d373cade4e832627b4f6.txt')
         self.assertTrue(os.path.exists(expected_file_path))
         self.assertTrue(os.path.exists(target_token_path))
+        # the copy is written under a temporary name then renamed
+        self.assertEqual(
+            os.listdir(target_dir),
+            ['test_file_md5_098f6bcd4621d373cade4e832627b4f6.txt'])
+
+    def test_hash_file_materialize(self):
+        """Test ecoshard.hash_file materialize strategies."""
+        working_dir = self.workspace_dir
+        base_path = os.path.join(working_dir, 'test_file.txt')
+        with open(base_path, 'w') as base_file:
+            base_file.write('test')
+
+        for materialize in ['copy', 'hardlink', 'reflink', 'symlink']:
+            target_dir = os.path.join(working_dir, materialize)
+            ecoshard.hash_file(
+                base_path, target_dir=target_dir, hash_algorithm='md5',
+                materialize=materialize)
+            expected_file_path = os.path.join(
+                target_dir,
+                'test_file_md5_098f6bcd4621d373cade4e832627b4f6.txt')
+            with open(expected_file_path, 'r') as ecoshard_file:
+                self.assertEqual(ecoshard_file.read(), 'test')
+
+        self.assertTrue(os.path.samefile(base_path, os.path.join(
+            working_dir, 'hardlink',
+            'test_file_md5_098f6bcd4621d373cade4e832627b4f6.txt')))
+        self.assertTrue(os.path.islink(os.path.join(
+            working_dir, 'symlink',
+            'test_file_md5_098f6bcd4621d373cade4e832627b4f6.txt')))
+
+        with self.assertRaises(ValueError) as cm:
+            ecoshard.hash_file(
+                base_path, target_dir=working_dir, materialize='teleport')
+        self.assertTrue('unknown materialize' in str(cm.exception))
+
+    def test_hash_file_already_ecoshard(self):
+        """Test ecoshard.hash_file leaves a file named with its hash."""
+        ecoshard_path = os.path.join(
+            self.workspace_dir,
+            'test_file_md5_098f6bcd4621d373cade4e832627b4f6.txt')
+        with open(ecoshard_path, 'w') as ecoshard_file:
+            ecoshard_file.write('test')
+
+        for materialize in ['copy', 'hardlink', 'reflink', 'symlink']:
+            ecoshard.hash_file(
+                ecoshard_path, hash_algorithm='md5', force=True,
+                materialize=materialize)
+            self.assertFalse(os.path.islink(ecoshard_path))
+            with open(ecoshard_path, 'r') as ecoshard_file:
+                self.assertEqual(ecoshard_file.read(), 'test')
+            # no temporary file is left behind
+            self.assertEqual(
+                [path for path in os.listdir(self.workspace_dir)
+                 if path.endswith('.tmp')], [])
 
     def test_hash_file_rename(self):
         """Test ecoshard.hash_file with a rename."""
@@ -131,6 +283,117 @@ class EcoShardTests(unittest.TestCase):
                 hash_algorithm='md5', force=False)
         self.assertTrue('already be an ecoshard' in str(cm.exception))
 
+    def test_hash_file_multiple_algorithms(self):
+        """Test ecoshard.hash_file with several hash algorithms."""
+        working_dir = self.workspace_dir
+        base_path = os.path.join(working_dir, 'test_file.txt')
+
+        with open(base_path, 'w') as base_file:
+            base_file.write('test')
+
+        hash_dict = ecoshard.hash_file(
+            base_path, target_token_path=None, target_dir=None, rename=True,
+            hash_algorithm='md5,sha256', force=False)
+
+        self.assertEqual(
+            hash_dict['md5'], '098f6bcd4621d373cade4e832627b4f6')
+        self.assertEqual(
+            hash_dict['sha256'],
+            '9f86d081884c7d659a2feaa0c55ad015'
+            'a3bf4f1b2b0b822cd15d6c15b0f00a08')
+        # the first algorithm names the ecoshard
+        expected_file_path = os.path.join(
+            working_dir, 'test_file_md5_098f6bcd4621d373cade4e832627b4f6.txt')
+        self.assertTrue(os.path.exists(expected_file_path))
+        self.assertEqual(
+            ecoshard.calculate_hashes(expected_file_path, ['sha256', 'md5']),
+            hash_dict)
+
+        with self.assertRaises(ValueError) as cm:
+            ecoshard.calculate_hashes(expected_file_path, ['not_a_hash'])
+        self.assertTrue('unknown hash algorithm' in str(cm.exception))
+
+    def test_calculate_hash_buffer_size(self):
+        """Test ecoshard.calculate_hash is independent of buffer size."""
+        base_path = os.path.join(self.workspace_dir, 'test_file.bin')
+        with open(base_path, 'wb') as base_file:
+            base_file.write(os.urandom(2**16 + 17))
+
+        expected_hash = ecoshard.calculate_hash(base_path, 'sha256')
+        for buf_size in [1, 4096, 2**16, 2**20]:
+            self.assertEqual(
+                ecoshard.calculate_hash(
+                    base_path, 'sha256', buf_size=buf_size,
+                    drop_page_cache=True), expected_hash)
+
+    def test_tree_hash(self):
+        """Test ecoshard tree hash is independent of workers and reads."""
+        base_path = os.path.join(self.workspace_dir, 'test_file.bin')
+        with open(base_path, 'wb') as base_file:
+            base_file.write(os.urandom(
+                2 * ecoshard.ecoshard.TREE_HASH_LEAF_SIZE + 17))
+
+        tree_hash = ecoshard.calculate_hash(
+            base_path, 'blake2btree', n_workers=1)
+        self.assertEqual(
+            ecoshard.calculate_hash(base_path, 'blake2btree', n_workers=8),
+            tree_hash)
+        # the sequential single pass path must agree with the parallel one
+        self.assertEqual(
+            ecoshard.calculate_hashes(
+                base_path, ['md5', 'blake2btree'])['blake2btree'],
+            tree_hash)
+
+        # short reads are continued rather than hashed as a whole leaf
+        pread = os.pread
+        with unittest.mock.patch(
+                'os.pread', lambda fd, n_bytes, offset: pread(
+                    fd, max(1, n_bytes // 3), offset)):
+            self.assertEqual(
+                ecoshard.ecoshard._parallel_tree_hash(base_path, 4),
+                tree_hash)
+        # and a file that ends early is an error
+        with unittest.mock.patch(
+                'os.pread', lambda fd, n_bytes, offset: pread(
+                    fd, n_bytes, offset)[:-1] if n_bytes > 17 else b''):
+            with self.assertRaises(OSError):
+                ecoshard.ecoshard._parallel_tree_hash(base_path, 4)
+
+        ecoshard.hash_file(
+            base_path, rename=True, hash_algorithm='blake2btree')
+        ecoshard_path = os.path.join(
+            self.workspace_dir, f'test_file_blake2btree_{tree_hash}.bin')
+        self.assertTrue(ecoshard.validate(ecoshard_path))
+
+    def test_hash_cache(self):
+        """Test ecoshard.calculate_hash uses the persistent hash cache."""
+        base_path = os.path.join(self.workspace_dir, 'test_file.txt')
+        with open(base_path, 'w') as base_file:
+            base_file.write('test')
+        # recently modified files are not cached, so age this one
+        old_time = os.path.getmtime(base_path) - 60
+        os.utime(base_path, (old_time, old_time))
+
+        test_md5 = '098f6bcd4621d373cade4e832627b4f6'
+        self.assertEqual(ecoshard.calculate_hash(base_path, 'md5'), test_md5)
+        self.assertTrue(os.path.exists(ecoshard.get_hash_cache_path()))
+
+        # change the contents without changing size or mtime so only the
+        # cache can produce the old hash
+        with open(base_path, 'w') as base_file:
+            base_file.write('tent')
+        os.utime(base_path, (old_time, old_time))
+        self.assertEqual(ecoshard.calculate_hash(base_path, 'md5'), test_md5)
+
+        tent_md5 = ecoshard.calculate_hash(
+            base_path, 'md5', use_hash_cache=False)
+        self.assertNotEqual(tent_md5, test_md5)
+        self.assertEqual(
+            ecoshard.calculate_hash(base_path, 'md5', reverify=True),
+            tent_md5)
+        # reverify refreshed the cache
+        self.assertEqual(ecoshard.calculate_hash(base_path, 'md5'), tent_md5)
+
     def test_validate_hash(self):
         """Test ecoshard.validate_hash."""
         working_dir = self.workspace_dir
@@ -155,6 +418,701 @@ class EcoShardTests(unittest.TestCase):
             ecoshard.validate(new_file_path)
         self.assertTrue('hash does not match' in str(cm.exception))
 
+    def test_download_url_hash(self):
+        """Test ecoshard.download_url hashes and verifies downloads."""
+        serve_dir = os.path.join(self.workspace_dir, 'serve')
+        os.makedirs(serve_dir)
+        test_md5 = '098f6bcd4621d373cade4e832627b4f6'
+        for filename in [
+                f'test_file_md5_{test_md5}.txt',
+                'test_file_md5_098f6bcd4621d373cade4e832627b4f5.txt']:
+            with open(os.path.join(serve_dir, filename), 'w') as serve_file:
+                serve_file.write('test')
+        server, base_url = _start_http_server(serve_dir)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        target_path = os.path.join(self.workspace_dir, 'test_file.txt')
+        hash_dict = ecoshard.download_url(
+            f'{base_url}/test_file_md5_{test_md5}.txt', target_path,
+            hash_algorithm_list=['sha256'], expected_hash='ecoshard',
+            rename_to_ecoshard=True)
+        self.assertEqual(hash_dict['md5'], test_md5)
+        self.assertEqual(
+            hash_dict['sha256'],
+            '9f86d081884c7d659a2feaa0c55ad015'
+            'a3bf4f1b2b0b822cd15d6c15b0f00a08')
+        # renamed with the first requested algorithm
+        self.assertTrue(os.path.exists(os.path.join(
+            self.workspace_dir, 'test_file_sha256_%s.txt' % (
+                hash_dict['sha256']))))
+        self.assertFalse(os.path.exists(target_path))
+
+        with self.assertRaises(ValueError) as cm:
+            ecoshard.download_url(
+                f'{base_url}/test_file_md5_'
+                '098f6bcd4621d373cade4e832627b4f5.txt', target_path,
+                expected_hash='ecoshard')
+        self.assertTrue('hash does not match' in str(cm.exception))
+        # a download that fails verification is removed
+        self.assertFalse(os.path.exists(target_path))
+
+        ecoshard.download_url(
+            f'{base_url}/test_file_md5_{test_md5}.txt', target_path,
+            expected_hash=f'md5_{test_md5}')
+        self.assertTrue(os.path.exists(target_path))
+
+        # algorithm names can contain an underscore
+        test_sha3 = hashlib.sha3_256(b'test').hexdigest()
+        ecoshard.download_url(
+            f'{base_url}/test_file_md5_{test_md5}.txt', target_path,
+            expected_hash=f'sha3_256_{test_sha3}')
+        shutil.copy(
+            os.path.join(serve_dir, f'test_file_md5_{test_md5}.txt'),
+            os.path.join(serve_dir, f'test_file_sha3_256_{test_sha3}.txt'))
+        hash_dict = ecoshard.download_url(
+            f'{base_url}/test_file_sha3_256_{test_sha3}.txt', target_path,
+            expected_hash='ecoshard')
+        self.assertEqual(hash_dict['sha3_256'], test_sha3)
+
+    def test_download_url_ranges(self):
+        """Test ecoshard.download_url resumes and uses many connections."""
+        serve_dir = os.path.join(self.workspace_dir, 'serve')
+        os.makedirs(serve_dir)
+        data = os.urandom(5 * 2**20 + 17)
+        with open(os.path.join(serve_dir, 'data.bin'), 'wb') as serve_file:
+            serve_file.write(data)
+        expected_hash = 'md5_%s' % ecoshard.calculate_hash(
+            os.path.join(serve_dir, 'data.bin'), 'md5')
+
+        range_server, range_url = _start_http_server(
+            serve_dir, handler=_RangeHTTPRequestHandler)
+        self.addCleanup(range_server.server_close)
+        self.addCleanup(range_server.shutdown)
+        plain_server, plain_url = _start_http_server(serve_dir)
+        self.addCleanup(plain_server.server_close)
+        self.addCleanup(plain_server.shutdown)
+
+        for index, (url, n_connections) in enumerate([
+                (range_url, 1), (range_url, 4), (plain_url, 1),
+                (plain_url, 4)]):
+            target_path = os.path.join(self.workspace_dir, f'{index}.bin')
+            # a partial download is left behind by an earlier attempt
+            with open(f'{target_path}.part', 'wb') as part_file:
+                part_file.write(data[:2**20 + 5])
+            ecoshard.download_url(
+                f'{url}/data.bin', target_path, expected_hash=expected_hash,
+                n_connections=n_connections)
+            with open(target_path, 'rb') as target_file:
+                self.assertEqual(target_file.read(), data)
+            self.assertFalse(os.path.exists(f'{target_path}.part'))
+            self.assertFalse(os.path.exists(f'{target_path}.part.json'))
+
+        # a chunk record without its '.part' file or with a short one is
+        # not trusted, even when there is no hash to catch the damage
+        for index, part_data in enumerate([None, data[:2**20]]):
+            target_path = os.path.join(
+                self.workspace_dir, f'stale_{index}.bin')
+            if part_data is not None:
+                with open(f'{target_path}.part', 'wb') as part_file:
+                    part_file.write(part_data)
+            with open(f'{target_path}.part.json', 'w') as state_file:
+                json.dump({
+                    'file_size': len(data), 'chunk_size': -(-len(data) // 4),
+                    'done': [0, 1, 2, 3]}, state_file)
+            ecoshard.download_url(
+                f'{range_url}/data.bin', target_path, n_connections=4)
+            with open(target_path, 'rb') as target_file:
+                self.assertEqual(target_file.read(), data)
+
+        # a full disk is not retried like a network error
+        self.assertFalse(ecoshard.ecoshard._is_retryable_download_error(
+            OSError(errno.ENOSPC, 'No space left on device')))
+        self.assertTrue(ecoshard.ecoshard._is_retryable_download_error(
+            ConnectionResetError(errno.ECONNRESET, 'reset')))
+
+    def test_download_many(self):
+        """Test ecoshard.download_many reports per url results."""
+        serve_dir = os.path.join(self.workspace_dir, 'serve')
+        os.makedirs(serve_dir)
+        for index in range(10):
+            with open(os.path.join(serve_dir, f'{index}.txt'), 'w') as f:
+                f.write(f'tile {index}')
+        server, base_url = _start_http_server(serve_dir)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        target_dir = os.path.join(self.workspace_dir, 'target')
+        os.makedirs(target_dir)
+        url_target_pairs = [
+            (f'{base_url}/{index}.txt',
+             os.path.join(target_dir, f'{index}.txt'))
+            for index in range(10)]
+        url_target_pairs.append(
+            (f'{base_url}/missing.txt',
+             os.path.join(target_dir, 'missing.txt')))
+        result_list = ecoshard.download_many(
+            url_target_pairs, max_workers=4, per_host_limit=2, n_retries=1)
+
+        self.assertEqual(
+            [result['url'] for result in result_list],
+            [url for url, _ in url_target_pairs])
+        for index, result in enumerate(result_list[:-1]):
+            self.assertEqual(result['status'], 'ok')
+            with open(result['target_path']) as f:
+                self.assertEqual(f.read(), f'tile {index}')
+        # a missing file fails without a retry or stopping the batch
+        self.assertEqual(result_list[-1]['status'], 'failed')
+        self.assertEqual(result_list[-1]['attempts'], 1)
+        self.assertFalse(os.path.exists(result_list[-1]['target_path']))
+
+        result_list = ecoshard.download_many(
+            url_target_pairs[:3], skip_if_target_exists=True)
+        self.assertEqual(
+            [result['status'] for result in result_list], ['skipped'] * 3)
+
+        # a gzip encoded response is saved as sent, like download_url does
+        gzip_server, gzip_url = _start_http_server(
+            serve_dir, handler=_GzipHTTPRequestHandler)
+        self.addCleanup(gzip_server.server_close)
+        self.addCleanup(gzip_server.shutdown)
+        gzip_path = os.path.join(target_dir, 'gzip.txt')
+        result_list = ecoshard.download_many(
+            [(f'{gzip_url}/0.txt', gzip_path)], n_retries=0)
+        self.assertEqual(result_list[0]['status'], 'ok')
+        with open(gzip_path, 'rb') as f:
+            self.assertEqual(gzip.decompress(f.read()), b'tile 0')
+
+    def test_ecoshard_library_cache(self):
+        """Test EcoshardLibrary fetches through a content addressed cache."""
+        serve_dir = os.path.join(self.workspace_dir, 'serve')
+        os.makedirs(serve_dir)
+        asset_id_list = []
+        for index in range(3):
+            data = f'asset {index}'.encode('utf-8') * 100
+            asset_id = 'asset_%d_md5_%s.txt' % (
+                index, hashlib.md5(data).hexdigest())
+            with open(os.path.join(serve_dir, asset_id), 'wb') as f:
+                f.write(data)
+            asset_id_list.append(asset_id)
+        server, base_url = _start_http_server(
+            serve_dir, handler=_FetchHTTPRequestHandler)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        cache_dir = os.path.join(self.workspace_dir, 'library_cache')
+        library = ecoshard.ecoshard.EcoshardLibrary(
+            base_url, None, cache_dir, max_cache_bytes=1400)
+        target_path = os.path.join(self.workspace_dir, 'fetched.txt')
+        hash_id = library.fetch('test', asset_id_list[0], target_path)
+        self.assertEqual(hash_id, 'md5_%s' % (
+            asset_id_list[0].split('_md5_')[1][:-len('.txt')]))
+        with open(target_path, 'rb') as f:
+            self.assertEqual(f.read(), b'asset 0' * 100)
+        self.assertGreater(os.stat(target_path).st_nlink, 1)
+
+        # a second fetch is served from the cache without the server
+        os.remove(os.path.join(serve_dir, asset_id_list[0]))
+        copy_path = os.path.join(self.workspace_dir, 'copy.txt')
+        library.fetch('test', asset_id_list[0], copy_path, materialize='copy')
+        with open(copy_path, 'rb') as f:
+            self.assertEqual(f.read(), b'asset 0' * 100)
+        self.assertEqual(os.stat(copy_path).st_nlink, 1)
+        by_hash_path = os.path.join(self.workspace_dir, 'by_hash.txt')
+        library.fetch_by_hash('test', hash_id, by_hash_path)
+        self.assertTrue(os.path.exists(by_hash_path))
+
+        # the pinned asset survives eviction of least recently used ones
+        library.pin(hash_id)
+        hash_id_list = [hash_id] + [
+            library.fetch(
+                'test', asset_id,
+                os.path.join(self.workspace_dir, f'{index}.txt'))
+            for index, asset_id in enumerate(asset_id_list[1:])]
+        blob_path_list = [
+            os.path.join(cache_dir, 'blobs', 'md5', hash_id[4:6],
+                         hash_id[4:] + '.txt') for hash_id in hash_id_list]
+        self.assertEqual(
+            [os.path.exists(path) for path in blob_path_list],
+            [True, False, True])
+        library.unpin(hash_id)
+        with self.assertRaises(ValueError):
+            library.pin(hash_id_list[1])
+
+    def test_download_and_unzip(self):
+        """Test ecoshard.download_and_unzip with zip and tar.gz archives."""
+        serve_dir = os.path.join(self.workspace_dir, 'serve')
+        os.makedirs(serve_dir)
+        content_dict = {
+            f'tiles/{index}/tile_{index}.txt': f'tile {index}' * index
+            for index in range(20)}
+        with zipfile.ZipFile(
+                os.path.join(serve_dir, 'tiles.zip'), 'w',
+                zipfile.ZIP_DEFLATED) as zip_ref:
+            for member_path, content in content_dict.items():
+                zip_ref.writestr(member_path, content)
+        content_dir = os.path.join(self.workspace_dir, 'content')
+        for member_path, content in content_dict.items():
+            os.makedirs(
+                os.path.join(content_dir, os.path.dirname(member_path)),
+                exist_ok=True)
+            with open(os.path.join(content_dir, member_path), 'w') as f:
+                f.write(content)
+        with tarfile.open(
+                os.path.join(serve_dir, 'tiles.tar.gz'), 'w:gz') as tar_ref:
+            tar_ref.add(os.path.join(content_dir, 'tiles'), arcname='tiles')
+        server, base_url = _start_http_server(serve_dir)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        for archive_filename in ['tiles.zip', 'tiles.tar.gz']:
+            target_dir = os.path.join(
+                self.workspace_dir, archive_filename.replace('.', '_'))
+            os.makedirs(target_dir)
+            target_token_path = os.path.join(target_dir, 'token.txt')
+            ecoshard.download_and_unzip(
+                f'{base_url}/{archive_filename}', target_dir,
+                target_token_path=target_token_path, n_workers=4)
+            self.assertTrue(os.path.exists(target_token_path))
+            for member_path, content in content_dict.items():
+                with open(os.path.join(target_dir, member_path)) as f:
+                    self.assertEqual(f.read(), content)
+
+            # a damaged member is restored on the next incremental call and
+            # the unchanged members are left alone
+            damaged_path = os.path.join(target_dir, 'tiles/3/tile_3.txt')
+            with open(damaged_path, 'w') as f:
+                f.write('damaged')
+            untouched_path = os.path.join(target_dir, 'tiles/5/tile_5.txt')
+            os.utime(untouched_path, ns=(0, 10**9 * 60 * 60 * 24 * 365 * 30))
+            untouched_mtime = os.path.getmtime(untouched_path)
+            if archive_filename.endswith('.tar.gz'):
+                # tar members are matched on mtime, keep this one matching
+                shutil.copystat(
+                    os.path.join(content_dir, 'tiles/5/tile_5.txt'),
+                    untouched_path)
+                untouched_mtime = os.path.getmtime(untouched_path)
+            ecoshard.download_and_unzip(
+                f'{base_url}/{archive_filename}', target_dir, n_workers=4)
+            with open(damaged_path) as f:
+                self.assertEqual(f.read(), content_dict['tiles/3/tile_3.txt'])
+            self.assertEqual(
+                os.path.getmtime(untouched_path), untouched_mtime)
+
+    def test_convolve_layer(self):
+        """Test ecoshard.convolve_layer with and without worker threads."""
+        raster_path = os.path.join(self.workspace_dir, 'test_raster.tif')
+        _build_test_raster(raster_path)
+        base_array = numpy.array(
+            range(100*100), dtype=numpy.int32).reshape((100, 100))
+        # pad to 102x102 by repeating the last row and column
+        padded_array = numpy.pad(base_array, ((0, 2), (0, 2)), mode='edge')
+        expected_max_array = padded_array.reshape(34, 3, 34, 3).max(
+            axis=(1, 3))
+
+        for n_workers in [1, 3]:
+            target_path = os.path.join(
+                self.workspace_dir, f'max_{n_workers}.tif')
+            ecoshard.convolve_layer(
+                raster_path, 3, 'max', target_path, n_workers=n_workers)
+            target_raster = gdal.OpenEx(target_path, gdal.OF_RASTER)
+            self.assertEqual(
+                (target_raster.RasterXSize, target_raster.RasterYSize),
+                (34, 34))
+            numpy.testing.assert_array_equal(
+                target_raster.GetRasterBand(1).ReadAsArray(),
+                expected_max_array)
+            self.assertEqual(target_raster.GetGeoTransform()[1], 3.0)
+            target_raster = None
+
+        # several methods in one pass, as a raster per method or as bands
+        method_list = ['sum', 'max', 'min', 'average', 'mode']
+        target_path_list = [
+            os.path.join(self.workspace_dir, f'{method}.tif')
+            for method in method_list]
+        multiband_path = os.path.join(self.workspace_dir, 'multiband.tif')
+        ecoshard.convolve_layer(raster_path, 3, method_list, target_path_list)
+        ecoshard.convolve_layer(raster_path, 3, method_list, multiband_path)
+        multiband_raster = gdal.OpenEx(multiband_path, gdal.OF_RASTER)
+        for band_index, method in enumerate(method_list):
+            single_path = os.path.join(
+                self.workspace_dir, f'single_{method}.tif')
+            ecoshard.convolve_layer(raster_path, 3, method, single_path)
+            single_array = gdal.OpenEx(
+                single_path, gdal.OF_RASTER).GetRasterBand(1).ReadAsArray()
+            numpy.testing.assert_array_equal(
+                gdal.OpenEx(
+                    target_path_list[band_index],
+                    gdal.OF_RASTER).GetRasterBand(1).ReadAsArray(),
+                single_array)
+            numpy.testing.assert_array_equal(
+                multiband_raster.GetRasterBand(
+                    band_index+1).ReadAsArray(), single_array)
+        multiband_raster = None
+
+        # targets are compressed and tiled as requested
+        target_path = os.path.join(self.workspace_dir, 'lzw.tif')
+        ecoshard.convolve_layer(
+            raster_path, 3, 'max', target_path,
+            raster_driver_creation_tuple=('GTIFF', (
+                'TILED=YES', 'BIGTIFF=YES', 'COMPRESS=LZW', 'PREDICTOR=2',
+                'BLOCKXSIZE=32', 'BLOCKYSIZE=32')))
+        target_raster = gdal.OpenEx(target_path, gdal.OF_RASTER)
+        self.assertEqual(
+            target_raster.GetMetadata('IMAGE_STRUCTURE')['COMPRESSION'],
+            'LZW')
+        target_band = target_raster.GetRasterBand(1)
+        self.assertEqual(list(target_band.GetBlockSize()), [32, 32])
+        numpy.testing.assert_array_equal(
+            target_band.ReadAsArray(), expected_max_array)
+        target_band = None
+        target_raster = None
+
+        with self.assertRaises(ValueError):
+            ecoshard.convolve_layer(
+                raster_path, 3, 'median',
+                os.path.join(self.workspace_dir, 'median.tif'))
+        with self.assertRaises(ValueError):
+            ecoshard.convolve_layer(
+                raster_path, 3, ['max', 'min'], target_path_list)
+
+    def test_convolve_layer_from_overviews(self):
+        """Test convolve_layer reuses overviews only when they match."""
+        raster_path = os.path.join(self.workspace_dir, 'test_raster.tif')
+        _build_test_raster(raster_path)
+        raster = gdal.OpenEx(raster_path, gdal.OF_RASTER | gdal.GA_Update)
+        base_array = numpy.random.RandomState(0).randint(
+            0, 5, size=(100, 100)).astype(numpy.int32)
+        raster.GetRasterBand(1).WriteArray(base_array)
+        raster.GetRasterBand(1).DeleteNoDataValue()
+        raster = None
+        ecoshard.build_overviews(raster_path, interpolation_method='max')
+
+        reduced_path = os.path.join(self.workspace_dir, 'reduced.tif')
+        full_path = os.path.join(self.workspace_dir, 'full.tif')
+        with self.assertLogs('ecoshard.ecoshard', level='INFO') as log:
+            ecoshard.convolve_layer(
+                raster_path, 4, 'max', reduced_path, use_overviews=True)
+        self.assertTrue(any(
+            'existing overview' in line for line in log.output))
+        ecoshard.convolve_layer(raster_path, 4, 'max', full_path)
+        numpy.testing.assert_array_equal(*[
+            gdal.OpenEx(path, gdal.OF_RASTER).GetRasterBand(1).ReadAsArray()
+            for path in [reduced_path, full_path]])
+        with self.assertLogs('ecoshard.ecoshard', level='INFO') as log:
+            ecoshard.convolve_layer(
+                raster_path, 3, 'max', full_path, use_overviews=True)
+        self.assertTrue(any(
+            'is not a multiple of 3' in line for line in log.output))
+
+        # with nodata, which GDAL's resampling skips, the overview is not
+        # used and the result is the same as reducing the full raster
+        raster = gdal.OpenEx(raster_path, gdal.OF_RASTER | gdal.GA_Update)
+        raster.GetRasterBand(1).SetNoDataValue(4)
+        raster = None
+        with self.assertLogs('ecoshard.ecoshard', level='INFO') as log:
+            ecoshard.convolve_layer(
+                raster_path, 4, 'max', reduced_path, use_overviews=True)
+            # other methods, factors and the default are reduced
+            ecoshard.convolve_layer(
+                raster_path, 3, 'max', full_path, use_overviews=True)
+            ecoshard.convolve_layer(
+                raster_path, 4, 'average', full_path, use_overviews=True)
+            ecoshard.convolve_layer(raster_path, 4, 'max', full_path)
+        self.assertFalse(any(
+            'existing overview' in line for line in log.output))
+        # each overview that is passed over says why
+        for reason in ['it has nodata', 'resamples average differently']:
+            self.assertTrue(any(reason in line for line in log.output))
+        numpy.testing.assert_array_equal(*[
+            gdal.OpenEx(path, gdal.OF_RASTER).GetRasterBand(1).ReadAsArray()
+            for path in [reduced_path, full_path]])
+
+    def test_plan_blocks(self):
+        """Test ecoshard.plan_blocks aligns windows to tiles and factors."""
+        raster_path = os.path.join(self.workspace_dir, 'test_raster.tif')
+        _build_test_raster(raster_path)
+        self.assertEqual(
+            ecoshard.plan_blocks(raster_path), [{
+                'xoff': 0, 'yoff': 0, 'win_xsize': 100, 'win_ysize': 100}])
+
+        # 16x16 tiles and a factor of 3 align to 48 pixels
+        offset_list = ecoshard.plan_blocks(
+            raster_path, max_block_bytes=4*48*48, integer_factor=3)
+        self.assertEqual(len(offset_list), 9)
+        coverage_array = numpy.zeros((100, 100), dtype=numpy.int32)
+        for offset_dict in offset_list:
+            self.assertEqual(offset_dict['xoff'] % 48, 0)
+            self.assertEqual(offset_dict['yoff'] % 48, 0)
+            coverage_array[
+                offset_dict['yoff']:
+                offset_dict['yoff']+offset_dict['win_ysize'],
+                offset_dict['xoff']:
+                offset_dict['xoff']+offset_dict['win_xsize']] += 1
+        numpy.testing.assert_array_equal(coverage_array, 1)
+        # whole 32x32 target tiles reduced by 3 are over budget so windows
+        # only align to the source tiles and the factor
+        for offset_dict in ecoshard.plan_blocks(
+                raster_path, max_block_bytes=4*48*48, integer_factor=3,
+                target_block_size=(32, 32)):
+            self.assertEqual(offset_dict['xoff'] % 48, 0)
+            self.assertEqual(offset_dict['yoff'] % 48, 0)
+            self.assertLessEqual(
+                offset_dict['win_xsize'] * offset_dict['win_ysize'], 48*48)
+        # a 48 pixel unit is over budget so windows align to the factor
+        for offset_dict in ecoshard.plan_blocks(
+                raster_path, max_block_bytes=4*100, integer_factor=3):
+            self.assertEqual(offset_dict['xoff'] % 3, 0)
+            self.assertEqual(offset_dict['yoff'] % 3, 0)
+            self.assertLessEqual(
+                offset_dict['win_xsize'] * offset_dict['win_ysize'], 100)
+        for offset_dict in ecoshard.plan_blocks(
+                raster_path, max_block_bytes=4*1600, full_width=True):
+            self.assertEqual(offset_dict['win_xsize'], 100)
+
+        # reducing in small blocks gives the same result
+        target_path_list = []
+        for max_block_bytes in [4*1600, 2**20]:
+            target_path_list.append(os.path.join(
+                self.workspace_dir, f'average_{max_block_bytes}.tif'))
+            ecoshard.convolve_layer(
+                raster_path, 3, 'average', target_path_list[-1],
+                max_block_bytes=max_block_bytes)
+        numpy.testing.assert_array_equal(*[
+            gdal.OpenEx(path, gdal.OF_RASTER).GetRasterBand(1).ReadAsArray()
+            for path in target_path_list])
+
+    def test_convolve_kernel(self):
+        """Test ecoshard.convolve_kernel renormalizes around nodata."""
+        raster_path = os.path.join(self.workspace_dir, 'test_raster.tif')
+        _build_test_raster(raster_path)
+        base_array = numpy.full((100, 100), 5, dtype=numpy.int32)
+        base_array[40:60, 20:30] = -1
+        raster = gdal.OpenEx(raster_path, gdal.OF_RASTER | gdal.GA_Update)
+        raster.GetRasterBand(1).WriteArray(base_array)
+        raster = None
+
+        target_nodata = numpy.finfo(numpy.float32).min
+        # a small kernel is convolved directly and a large one with FFTs
+        for kernel_array in [
+                ecoshard.make_kernel('exponential', 2),
+                ecoshard.make_kernel('gaussian', 15)]:
+            for n_workers in [1, 2]:
+                target_path = os.path.join(
+                    self.workspace_dir, f'smooth_{n_workers}.tif')
+                ecoshard.convolve_kernel(
+                    raster_path, kernel_array, target_path,
+                    n_workers=n_workers, max_block_bytes=4*50*100)
+                target_array = gdal.OpenEx(
+                    target_path,
+                    gdal.OF_RASTER).GetRasterBand(1).ReadAsArray()
+                # valid neighbors are all 5 so renormalizing keeps it 5,
+                # even at the raster's edges and next to nodata
+                numpy.testing.assert_allclose(
+                    target_array[base_array != -1], 5, rtol=1e-5)
+                numpy.testing.assert_array_equal(
+                    target_array[base_array == -1], target_nodata)
+
+        with self.assertRaises(ValueError):
+            ecoshard.convolve_kernel(
+                raster_path, numpy.ones((2, 3)), target_path)
+
+    def test_sparse_blocks(self):
+        """Test blocks that are entirely nodata are not written."""
+        raster_path = os.path.join(self.workspace_dir, 'sparse.tif')
+        gtiff_driver = gdal.GetDriverByName('GTiff')
+        raster = gtiff_driver.Create(
+            raster_path, 1024, 1024, 1, gdal.GDT_Int32, options=[
+                'TILED=YES', 'BLOCKXSIZE=256', 'BLOCKYSIZE=256'])
+        raster.SetGeoTransform([0.0, 1.0, 0.0, 0.0, 0.0, -1.0])
+        band = raster.GetRasterBand(1)
+        band.SetNoDataValue(-1)
+        base_array = numpy.full((1024, 1024), 3, dtype=numpy.int32)
+        base_array[:, :512] = -1
+        band.WriteArray(base_array)
+        band = None
+        raster = None
+
+        reduced_path = os.path.join(self.workspace_dir, 'reduced.tif')
+        ecoshard.convolve_layer(
+            raster_path, 2, 'max', reduced_path, max_block_bytes=4*512*512)
+        smooth_path = os.path.join(self.workspace_dir, 'smooth.tif')
+        ecoshard.convolve_kernel(
+            raster_path, ecoshard.make_kernel('gaussian', 2), smooth_path,
+            max_block_bytes=4*256*256)
+        for target_path, expected_written in [
+                (reduced_path, [False, True]),
+                (smooth_path, [False, True, True, True])]:
+            target_raster = gdal.OpenEx(target_path, gdal.OF_RASTER)
+            target_band = target_raster.GetRasterBand(1)
+            self.assertEqual(
+                [bool(target_band.GetMetadataItem(
+                    f'BLOCK_OFFSET_{block_col}_0', 'TIFF'))
+                 for block_col in range(len(expected_written))],
+                expected_written)
+            target_array = target_band.ReadAsArray()
+            target_nodata = target_band.GetNoDataValue()
+            half_width = target_array.shape[1] // 2
+            numpy.testing.assert_array_equal(
+                target_array[:, :half_width], target_nodata)
+            numpy.testing.assert_allclose(
+                target_array[:, half_width:], 3, rtol=1e-5)
+            target_band = None
+            target_raster = None
+
+        # only floating point blocks need a work array to test sparsity
+        for dtype, expect_work_array in [
+                (numpy.uint8, False), (numpy.float32, True)]:
+            buffer_dict = {}
+            block_array = numpy.full((16, 16), 255, dtype=dtype)
+            self.assertTrue(ecoshard.ecoshard._all_nodata(
+                block_array, 255, buffer_dict))
+            block_array[3, 4] = 1
+            self.assertFalse(ecoshard.ecoshard._all_nodata(
+                block_array, 255, buffer_dict))
+            self.assertEqual(
+                'sparse_work' in buffer_dict, expect_work_array)
+
+    def test_convolve_layer_pyramid(self):
+        """Test ecoshard.convolve_layer_pyramid matches convolve_layer."""
+        raster_path = os.path.join(self.workspace_dir, 'test_raster.tif')
+        _build_test_raster(raster_path)
+        integer_factor_list = [2, 4]
+        for method in ['max', 'min', 'sum', 'average']:
+            target_path_list = [
+                os.path.join(self.workspace_dir, f'{method}_{factor}.tif')
+                for factor in integer_factor_list]
+            ecoshard.convolve_layer_pyramid(
+                raster_path, integer_factor_list, method, target_path_list)
+            for integer_factor, target_path in zip(
+                    integer_factor_list, target_path_list):
+                expected_path = os.path.join(
+                    self.workspace_dir, 'expected.tif')
+                ecoshard.convolve_layer(
+                    raster_path, integer_factor, method, expected_path)
+                target_raster = gdal.OpenEx(target_path, gdal.OF_RASTER)
+                numpy.testing.assert_array_equal(
+                    target_raster.GetRasterBand(1).ReadAsArray(),
+                    gdal.OpenEx(
+                        expected_path,
+                        gdal.OF_RASTER).GetRasterBand(1).ReadAsArray())
+                self.assertEqual(
+                    target_raster.GetGeoTransform()[1], integer_factor)
+                target_raster = None
+
+        with self.assertRaises(ValueError):
+            ecoshard.convolve_layer_pyramid(
+                raster_path, [2, 3], 'max', target_path_list)
+
+    def test_reduce_block_average_sum(self):
+        """Test average and sum only include valid pixels."""
+        reduce_block = ecoshard.ecoshard._reduce_block
+        block_array = numpy.array([
+            [1, 3, -1, -1, 5],
+            [-1, 8, -1, -1, 7],
+            [2, 2, 4, -1, 1]])
+        expected_sum = numpy.array([[12, -1, 12], [4, 4, 1]])
+        expected_average = numpy.array([[4, -1, 6], [2, 4, 1]])
+        buffer_dict = {}
+        for dtype in [numpy.int16, numpy.float32]:
+            # reuse the buffers between calls
+            reduced_sum, reduced_average = reduce_block(
+                block_array.astype(dtype), 2, ['sum', 'average'], -1,
+                buffer_dict=buffer_dict)
+            numpy.testing.assert_array_equal(reduced_sum, expected_sum)
+            numpy.testing.assert_array_equal(
+                reduced_average, expected_average)
+
+        # small integer blocks are summed through a working array of their
+        # own type without overflowing the window sums
+        buffer_dict = {}
+        reduced_sum = reduce_block(
+            numpy.full((64, 64), 255, dtype=numpy.uint8), 32, ['sum'], None,
+            buffer_dict=buffer_dict)[0]
+        numpy.testing.assert_array_equal(reduced_sum, 255 * 32**2)
+        self.assertEqual(reduced_sum.dtype, numpy.int64)
+        self.assertEqual(buffer_dict['value'].dtype, numpy.uint8)
+        # and so are pyramid carries
+        carry = ecoshard.ecoshard._pyramid_carry(
+            numpy.full((64, 64), 255, dtype=numpy.uint8), 'sum', None)
+        self.assertEqual(
+            [carry_array.dtype for carry_array in carry],
+            [numpy.uint8, bool])
+        reduced_sum, reduced_count = ecoshard.ecoshard._pyramid_reduce(
+            carry, 32, 'sum', None)
+        numpy.testing.assert_array_equal(reduced_sum, 255 * 32**2)
+        numpy.testing.assert_array_equal(reduced_count, 32**2)
+
+        nan_array = numpy.where(
+            block_array == -1, numpy.nan, block_array).astype(numpy.float32)
+        reduced_average = reduce_block(
+            nan_array, 2, ['average'], float('nan'))[0]
+        numpy.testing.assert_array_equal(
+            reduced_average, numpy.where(
+                expected_average == -1, numpy.nan, expected_average))
+
+    def test_mode_reduce(self):
+        """Test the mode reducer used by convolve_layer."""
+        mode_reduce = ecoshard.ecoshard._mode_reduce
+        block_array = numpy.array([
+            [1, 1, 5, 6, 9, 9],
+            [2, 3, 5, 6, 9, 9],
+            [7, 7, 0, 0, 4, 0],
+            [8, 8, 0, 0, 0, 2]])
+        expected_array = numpy.array([[1, 5, 9], [7, 0, 2]])
+        for dtype in [numpy.uint8, numpy.int32, numpy.float32]:
+            numpy.testing.assert_array_equal(
+                mode_reduce(block_array.astype(dtype), 2, 0),
+                expected_array.astype(dtype))
+        # values spanning many classes take the sorting path
+        numpy.testing.assert_array_equal(
+            mode_reduce(block_array * 1000, 2, 0), expected_array * 1000)
+        # without nodata, 0 is an ordinary value
+        numpy.testing.assert_array_equal(
+            mode_reduce(block_array, 2, None)[1], [7, 0, 0])
+        # padding at the edges doesn't count, even when nodata is out of
+        # the range of the block's type
+        edge_array = numpy.arange(1, 10).reshape((3, 3))
+        expected_array = numpy.array([[1, 3], [7, 9]])
+        for dtype, scale in [
+                (numpy.uint8, 1), (numpy.int32, 1000), (numpy.float32, 1)]:
+            for nodata in [-1.0, None]:
+                numpy.testing.assert_array_equal(
+                    ecoshard.ecoshard._reduce_block(
+                        (edge_array * scale).astype(dtype), 2, ['mode'],
+                        nodata)[0], expected_array * scale)
+                numpy.testing.assert_array_equal(
+                    ecoshard.ecoshard._pyramid_reduce(
+                        ((edge_array * scale).astype(dtype),), 2, 'mode',
+                        nodata)[0], expected_array * scale)
+        # an edge window of only nodata is nodata
+        numpy.testing.assert_array_equal(
+            mode_reduce(numpy.array([[1, 1, 0]], dtype=numpy.uint8), 2, 0),
+            [[1, 0]])
+
+        # bincount is only used when the value range is small next to the
+        # window, land cover codes spread over 10..220 are sorted
+        mode_uses_bincount = ecoshard.ecoshard._mode_uses_bincount
+        self.assertTrue(mode_uses_bincount(12, 2))
+        self.assertTrue(mode_uses_bincount(36, 4))
+        self.assertTrue(mode_uses_bincount(211, 8))
+        self.assertFalse(mode_uses_bincount(211, 2))
+        self.assertFalse(mode_uses_bincount(211, 3))
+        self.assertFalse(mode_uses_bincount(36, 2))
+        # and both paths agree
+        random_array = numpy.random.RandomState(0).randint(
+            10, 221, (37, 41)).astype(numpy.uint8)
+        for nodata in [None, 10]:
+            with unittest.mock.patch.object(
+                    ecoshard.ecoshard, '_mode_uses_bincount',
+                    return_value=True):
+                bincount_array = mode_reduce(random_array, 3, nodata)
+            with unittest.mock.patch.object(
+                    ecoshard.ecoshard, '_mode_uses_bincount',
+                    return_value=False):
+                sort_array = mode_reduce(random_array, 3, nodata)
+            numpy.testing.assert_array_equal(bincount_array, sort_array)
+
     def test_build_overviews(self):
         """Test ecoshard.build_overviews."""
         raster_path = os.path.join(self.workspace_dir, 'test_raster.tif')
@@ -186,3 +1144,196 @@ class EcoShardTests(unittest.TestCase):
         self.assertTrue(
             os.path.getsize(compressed_raster_path) <
             os.path.getsize(raster_path))
+
+    def test_compress_raster_options(self):
+        """Test ecoshard.compress_raster honors its creation options."""
+        raster_path = os.path.join(self.workspace_dir, 'test_raster.tif')
+        _build_test_raster(raster_path)
+        compressed_raster_path = os.path.join(
+            self.workspace_dir, 'test_raster_compressed.tif')
+
+        ecoshard.compress_raster(
+            raster_path, compressed_raster_path,
+            compression_algorithm='DEFLATE', compression_predictor=2,
+            compression_level=9, n_threads=2, block_size=(32, 64),
+            interleave='band')
+        compressed_raster = gdal.OpenEx(
+            compressed_raster_path, gdal.OF_RASTER)
+        compressed_band = compressed_raster.GetRasterBand(1)
+        self.assertEqual(compressed_band.GetBlockSize(), [32, 64])
+        image_structure = compressed_raster.GetMetadata('IMAGE_STRUCTURE')
+        self.assertEqual(image_structure['COMPRESSION'], 'DEFLATE')
+        self.assertEqual(image_structure['PREDICTOR'], '2')
+        numpy.testing.assert_array_equal(
+            compressed_band.ReadAsArray(),
+            gdal.OpenEx(
+                raster_path, gdal.OF_RASTER).GetRasterBand(1).ReadAsArray())
+        compressed_band = None
+        compressed_raster = None
+
+        # the floating point predictor only applies to float rasters
+        with self.assertRaises(ValueError):
+            ecoshard.compress_raster(
+                raster_path, compressed_raster_path,
+                compression_algorithm='DEFLATE', compression_predictor=3)
+        with self.assertRaises(ValueError):
+            ecoshard.compress_raster(
+                raster_path, compressed_raster_path,
+                compression_algorithm='LZW', compression_level=9)
+        with self.assertRaises(ValueError):
+            ecoshard.compress_raster(
+                raster_path, compressed_raster_path, block_size=(100, 100))
+
+    def test_compress_raster_auto(self):
+        """Test ecoshard.compress_raster picks and records a profile."""
+        raster_path = os.path.join(self.workspace_dir, 'test_raster.tif')
+        _build_test_raster(raster_path)
+        compressed_raster_path = os.path.join(
+            self.workspace_dir, 'test_raster_compressed.tif')
+
+        ecoshard.compress_raster(
+            raster_path, compressed_raster_path, compression_algorithm='auto',
+            block_size=(32, 32), compression_objective='smallest')
+        compressed_raster = gdal.OpenEx(
+            compressed_raster_path, gdal.OF_RASTER)
+        compression_profile = json.loads(compressed_raster.GetMetadataItem(
+            ecoshard.ecoshard.COMPRESSION_PROFILE_METADATA_KEY))
+        self.assertEqual(compression_profile['objective'], 'smallest')
+        self.assertEqual(
+            compressed_raster.GetMetadata('IMAGE_STRUCTURE')['COMPRESSION'],
+            compression_profile['algorithm'])
+        # the test raster increases by 1 along each row so differencing
+        # compresses it best
+        self.assertEqual(compression_profile['predictor'], 2)
+        numpy.testing.assert_array_equal(
+            compressed_raster.GetRasterBand(1).ReadAsArray(),
+            gdal.OpenEx(
+                raster_path, gdal.OF_RASTER).GetRasterBand(1).ReadAsArray())
+        compressed_raster = None
+
+        with self.assertRaises(ValueError):
+            ecoshard.compress_raster(
+                raster_path, compressed_raster_path,
+                compression_algorithm='auto', compression_objective='cheap')
+
+        # decode times within the tolerance of the fastest are ties, so
+        # timer noise does not pick a larger candidate
+        candidate_list = [
+            ('LZW', 2, None, 1000, 1.00e-3),
+            ('DEFLATE', 2, 6, 800, 1.05e-3),
+            ('ZSTD', 2, 9, 900, 2.00e-3)]
+        for compression_objective, expected_algorithm in [
+                ('smallest', 'DEFLATE'), ('fastest-decode', 'DEFLATE'),
+                ('balanced', 'DEFLATE')]:
+            self.assertEqual(
+                ecoshard.ecoshard._pick_compression_candidate(
+                    candidate_list, compression_objective)[0],
+                expected_algorithm)
+        self.assertEqual(
+            ecoshard.ecoshard._pick_compression_candidate(
+                candidate_list[::2], 'fastest-decode')[0], 'LZW')
+
+    def test_compress_raster_minimize_dtype(self):
+        """Test ecoshard.compress_raster shrinks types without loss."""
+        gtiff_driver = gdal.GetDriverByName('GTiff')
+        base_array = numpy.arange(100*100).reshape((100, 100)) % 201
+        base_array[10:20, 10:20] = -9999
+        for (base_type, base_values, expected_type,
+                expected_nodata) in [
+                # -9999 can't be a byte but no valid pixel is 255
+                (gdal.GDT_Float32, base_array, gdal.GDT_Byte, 255),
+                (gdal.GDT_Int32, base_array * 100 - 10000, gdal.GDT_Int16,
+                 -9999),
+                (gdal.GDT_Float64, base_array + 0.5, gdal.GDT_Float32,
+                 -9999)]:
+            raster_path = os.path.join(self.workspace_dir, 'base.tif')
+            raster = gtiff_driver.Create(
+                raster_path, 100, 100, 1, base_type, options=[
+                    'TILED=YES', 'BLOCKXSIZE=16', 'BLOCKYSIZE=16'])
+            raster.SetGeoTransform([0.0, 1.0, 0.0, 0.0, 0.0, -1.0])
+            band = raster.GetRasterBand(1)
+            band.SetNoDataValue(-9999)
+            band.WriteArray(numpy.where(
+                base_array == -9999, -9999, base_values))
+            band = None
+            raster = None
+
+            compressed_raster_path = os.path.join(
+                self.workspace_dir, 'compressed.tif')
+            ecoshard.compress_raster(
+                raster_path, compressed_raster_path,
+                block_size=(32, 32), minimize_dtype=True)
+            compressed_band = gdal.OpenEx(
+                compressed_raster_path, gdal.OF_RASTER).GetRasterBand(1)
+            self.assertEqual(compressed_band.DataType, expected_type)
+            self.assertEqual(
+                compressed_band.GetNoDataValue(), expected_nodata)
+            compressed_array = compressed_band.ReadAsArray()
+            valid_mask = base_array != -9999
+            numpy.testing.assert_array_equal(
+                compressed_array[valid_mask], base_values[valid_mask])
+            numpy.testing.assert_array_equal(
+                compressed_array[~valid_mask], expected_nodata)
+            compressed_band = None
+
+        # values that need all of float32 are left as is
+        raster = gtiff_driver.Create(
+            raster_path, 100, 100, 1, gdal.GDT_Float32)
+        raster.GetRasterBand(1).WriteArray(base_array / 3)
+        raster = None
+        ecoshard.compress_raster(
+            raster_path, compressed_raster_path, minimize_dtype=True)
+        self.assertEqual(
+            gdal.OpenEx(compressed_raster_path, gdal.OF_RASTER).GetRasterBand(
+                1).DataType, gdal.GDT_Float32)
+
+        # stale statistics don't make values wrap around
+        raster = gtiff_driver.Create(
+            raster_path, 100, 100, 1, gdal.GDT_Int32)
+        stale_array = base_array % 201 + 100
+        band = raster.GetRasterBand(1)
+        band.WriteArray(stale_array)
+        band.SetMetadataItem('STATISTICS_MINIMUM', '0')
+        band.SetMetadataItem('STATISTICS_MAXIMUM', '100')
+        band = None
+        raster = None
+        ecoshard.compress_raster(
+            raster_path, compressed_raster_path, minimize_dtype=True)
+        compressed_band = gdal.OpenEx(
+            compressed_raster_path, gdal.OF_RASTER).GetRasterBand(1)
+        self.assertEqual(compressed_band.DataType, gdal.GDT_UInt16)
+        numpy.testing.assert_array_equal(
+            compressed_band.ReadAsArray(), stale_array)
+        compressed_band = None
+        # band properties are kept with the values
+        raster = gtiff_driver.Create(
+            raster_path, 100, 100, 1, gdal.GDT_UInt16)
+        band = raster.GetRasterBand(1)
+        band.WriteArray(base_array % 3)
+        band.SetScale(0.5)
+        band.SetOffset(10)
+        band.SetUnitType('m')
+        band.SetCategoryNames(['water', 'forest', 'urban'])
+        color_table = gdal.ColorTable()
+        color_table.SetColorEntry(2, (255, 0, 0, 255))
+        band.SetRasterColorTable(color_table)
+        band = None
+        raster = None
+        ecoshard.compress_raster(
+            raster_path, compressed_raster_path, minimize_dtype=True)
+        compressed_band = gdal.OpenEx(
+            compressed_raster_path, gdal.OF_RASTER).GetRasterBand(1)
+        self.assertEqual(compressed_band.DataType, gdal.GDT_Byte)
+        self.assertEqual(compressed_band.GetScale(), 0.5)
+        self.assertEqual(compressed_band.GetOffset(), 10)
+        self.assertEqual(compressed_band.GetUnitType(), 'm')
+        self.assertEqual(
+            compressed_band.GetCategoryNames(), ['water', 'forest', 'urban'])
+        self.assertEqual(
+            tuple(compressed_band.GetRasterColorTable().GetColorEntry(2)),
+            (255, 0, 0, 255))
+        compressed_band = None
+
+        with self.assertRaises(ValueError):
+            ecoshard.ecoshard._cast_block(
+                numpy.array([1, 300]), None, None, numpy.uint8)